@@ -14,6 +14,7 @@
 
 """Tests for init_ddk.py"""
 
+import io
 import json
 import logging
 import pathlib
@@ -25,7 +26,9 @@ import xml.dom.minidom
 
 from absl.testing import absltest
 from absl.testing import parameterized
+from repo_manifest_parser import ProjectState, RepoManifestParser
 from repo_wrapper import ProjectAbsState, ProjectSyncStates
+from init.init_errors import KleafProjectSetterError
 import init_ddk
 
 # pylint: disable=protected-access
@@ -429,6 +432,100 @@ class KleafProjectSetterTest(parameterized.TestCase):
                 self.assertListEqual(include_names, ["kleaf.xml"])
 
 
+
+class RepoManifestParserTest(absltest.TestCase):
+
+    def _transform(self, manifest: str, fixup_groups: set[str] | None,
+                   preserve_groups: set[str] | None = None) \
+            -> tuple[set[ProjectState], xml.dom.minidom.Element]:
+        parser = RepoManifestParser(
+            manifest=manifest,
+            project_prefix=pathlib.Path("external/kleaf"),
+            fixup_groups=fixup_groups,
+            preserve_groups=preserve_groups,
+        )
+        out = io.StringIO()
+        project_states = parser.write_transformed_manifest(out)
+        return project_states, \
+            xml.dom.minidom.parseString(out.getvalue()).documentElement
+
+    def test_default_inheritance(self):
+        _, root = self._transform(textwrap.dedent("""\
+            <manifest>
+              <default revision="main" remote="aosp" />
+              <default sync-j="4" />
+              <project path="build/kernel" name="kernel/build" />
+              <project name="kernel/common" revision="android-mainline" />
+            </manifest>
+        """), fixup_groups=None, preserve_groups=set())
+        self.assertFalse(root.getElementsByTagName("default"))
+        projects = {
+            project.getAttribute("name"): project
+            for project in root.getElementsByTagName("project")
+        }
+        build = projects["kernel/build"]
+        self.assertEqual(build.getAttribute("revision"), "main")
+        self.assertEqual(build.getAttribute("remote"), "aosp")
+        self.assertEqual(build.getAttribute("sync-j"), "4")
+        self.assertEqual(build.getAttribute("path"),
+                         "external/kleaf/build/kernel")
+        common = projects["kernel/common"]
+        # Attributes of the project take precedence.
+        self.assertEqual(common.getAttribute("revision"), "android-mainline")
+        self.assertEqual(common.getAttribute("remote"), "aosp")
+        self.assertEqual(common.getAttribute("path"),
+                         "external/kleaf/kernel/common")
+
+    def test_groups(self):
+        project_states, root = self._transform(textwrap.dedent("""\
+            <manifest>
+              <project path="build/kernel" name="kernel/build" groups="ddk,pdk" />
+              <project path="prebuilts/clang" name="clang" groups="pdk ddk-prebuilts" />
+              <project path="common" name="kernel/common" />
+            </manifest>
+        """), fixup_groups={"ddk"}, preserve_groups={"ddk-prebuilts"})
+        self.assertEqual(project_states, {
+            ProjectState(pathlib.Path("build/kernel"),
+                         pathlib.Path("external/kleaf/build/kernel")),
+            ProjectState(pathlib.Path("prebuilts/clang"),
+                         pathlib.Path("prebuilts/clang")),
+        })
+        self.assertCountEqual(
+            [project.getAttribute("path")
+             for project in root.getElementsByTagName("project")],
+            ["external/kleaf/build/kernel", "prebuilts/clang"])
+
+    def test_default_after_project(self):
+        out = io.StringIO()
+        parser = RepoManifestParser(
+            manifest=textwrap.dedent("""\
+                <manifest>
+                  <project path="build/kernel" name="kernel/build" />
+                  <default revision="main" remote="aosp" />
+                </manifest>
+            """),
+            project_prefix=pathlib.Path("external/kleaf"),
+            fixup_groups=None,
+            preserve_groups=None,
+        )
+        with self.assertRaisesRegex(KleafProjectSetterError,
+                                    "<default> must precede"):
+            parser.write_transformed_manifest(out)
+        # Nothing is written.
+        self.assertEqual(out.getvalue(), "")
+
+    def test_malformed(self):
+        parser = RepoManifestParser(
+            manifest="<manifest><project></manifest>",
+            project_prefix=pathlib.Path("external/kleaf"),
+            fixup_groups=None,
+            preserve_groups=None,
+        )
+        with self.assertRaisesRegex(KleafProjectSetterError,
+                                    "Unable to parse repo manifest"):
+            parser.write_transformed_manifest(io.StringIO())
+
+
 # This could be run as: tools/bazel test //build/kernel:init_ddk_test --test_output=all
 if __name__ == "__main__":
     logging.basicConfig(
@@ -15,12 +15,12 @@
 """Parses the repo manifest from a build."""
 
 import dataclasses
+import io
 import pathlib
-import re
-import xml.dom.minidom
-import xml.parsers.expat
+import xml.etree.ElementTree as ET
 from typing import TextIO
 
+import repo_manifest
 from init.init_errors import KleafProjectSetterError
 
 
@@ -49,96 +49,127 @@ class RepoManifestParser:
     # list of projects with paths untouched
     preserve_groups: set[str] | None
 
-    def write_transformed_dom(self, file: TextIO) \
+    def write_transformed_manifest(self, file: TextIO) \
             -> set[ProjectState]:
         """Transforms manifest from the build and write result to file.
 
         Returns:
             set of ProjectState objects describing old and new paths.
         """
+        # Buffer the result so nothing is written if the manifest turns
+        # out to be malformed halfway.
+        buffer = io.StringIO()
         try:
-            with xml.dom.minidom.parseString(self.manifest) as dom:
-                project_states = self._transform_dom(dom)
-                dom.writexml(file)
-                return project_states
-        except xml.parsers.expat.ExpatError as err:
+            project_states = self._transform(buffer)
+        except repo_manifest.ParseError as err:
             raise KleafProjectSetterError("Unable to parse repo manifest") \
                 from err
+        file.write(buffer.getvalue())
+        return project_states
 
-    def _transform_dom(self, dom: xml.dom.minidom.Document) \
-            -> set[ProjectState]:
+    def _transform(self, file: TextIO) -> set[ProjectState]:
         """Transforms manifest from the build.
 
         - Append project_prefix to each project.
         - Filter out projects of mismatching groups
-        - Drop elements that may conflict with the main manifest
+        - Drop elements that may conflict with the main manifest, i.e.
+          <superproject> and <default>
+
+        Elements are transformed and written one at a time. Like
+        `repo manifest`, <default> must precede <project>s.
 
         Returns:
             set of ProjectState objects describing old and new paths.
+
+        Raises:
+            KleafProjectSetterError: <default> follows a <project>.
         """
-        root: xml.dom.minidom.Element = dom.documentElement
-        projects = root.getElementsByTagName("project")
-        defaults = self._parse_repo_manifest_defaults(root)
+        stream = repo_manifest.ManifestStream(io.StringIO(self.manifest))
+        defaults = dict[str, str]()
         project_states = set()
-        for project in projects:
-            category = self._match_group(project)
-            if category == "delete":
-                root.removeChild(project).unlink()
-                continue
-
-            for key, value in defaults.items():
-                if not project.hasAttribute(key):
-                    project.setAttribute(key, value)
-
-            # https://gerrit.googlesource.com/git-repo/+/master/docs/manifest-format.md#element-project
-            orig_path_below_repo = pathlib.Path(project.getAttribute("path") or
-                                                project.getAttribute("name"))
-
-            if category == "preserve":
-                project_states.add(ProjectState(orig_path_below_repo,
-                                                orig_path_below_repo))
-                continue
-
-            path_below_repo = self.project_prefix / orig_path_below_repo
-            project_states.add(ProjectState(
-                orig_path_below_repo, path_below_repo))
-            project.setAttribute("path", str(path_below_repo))
-
-            for link in project.getElementsByTagName("linkfile"):
-                orig_dest = pathlib.Path(link.getAttribute("dest"))
-                link.setAttribute("dest", str(self.project_prefix / orig_dest))
-
-        # Avoid <superproject> and <default> in Kleaf manifest conflicting with
-        # the one in main manifest
-        for superproject in root.getElementsByTagName("superproject"):
-            root.removeChild(superproject).unlink()
-        for default_element in root.getElementsByTagName("default"):
-            root.removeChild(default_element).unlink()
+        project_seen = False
+        root_written = False
+        file.write('<?xml version="1.0" ?>')
+        for element in stream:
+            if not root_written:
+                self._write_root_start_tag(stream.root, file)
+                root_written = True
+
+            keep = True
+            match element.tag:
+                case "project":
+                    project_seen = True
+                    project_state = self._transform_project(element,
+                                                            defaults)
+                    if project_state is None:
+                        keep = False
+                    else:
+                        project_states.add(project_state)
+                case "default":
+                    if project_seen:
+                        raise KleafProjectSetterError(
+                            "<default> must precede all <project>s in the "
+                            "repo manifest")
+                    defaults |= element.attrib
+                    keep = False
+                case "superproject":
+                    keep = False
+
+            if keep:
+                file.write(ET.tostring(element, encoding="unicode"))
+            else:
+                # Keep the surrounding whitespace.
+                file.write(element.tail or "")
+
+        if not root_written:
+            self._write_root_start_tag(stream.root, file)
+        file.write(f"</{stream.root.tag}>")
         return project_states
 
-    def _match_group(self, project: xml.dom.minidom.Element) -> str:
+    @staticmethod
+    def _write_root_start_tag(root: ET.Element, file: TextIO):
+        """Writes <manifest ...> and the whitespace after it."""
+        start_tag = ET.tostring(ET.Element(root.tag, root.attrib),
+                                encoding="unicode")
+        # <manifest ... /> -> <manifest ...>
+        file.write(start_tag.removesuffix(" />") + ">")
+        file.write(root.text or "")
+
+    def _transform_project(self, project: ET.Element,
+                           defaults: dict[str, str]) -> ProjectState | None:
+        """Transforms a <project> in place.
+
+        Returns:
+            ProjectState describing old and new paths, or None if the
+            project should be dropped.
+        """
+        category = self._match_group(project)
+        if category == "delete":
+            return None
+
+        for key, value in defaults.items():
+            if key not in project.attrib:
+                project.set(key, value)
+
+        orig_path_below_repo = repo_manifest.get_project_path(project)
+
+        if category == "preserve":
+            return ProjectState(orig_path_below_repo, orig_path_below_repo)
+
+        path_below_repo = self.project_prefix / orig_path_below_repo
+        project.set("path", str(path_below_repo))
+
+        for link in project.iter("linkfile"):
+            orig_dest = pathlib.Path(link.get("dest"))
+            link.set("dest", str(self.project_prefix / orig_dest))
+
+        return ProjectState(orig_path_below_repo, path_below_repo)
+
+    def _match_group(self, project: ET.Element) -> str:
         """Returns category of the groups if project matches any of groups."""
         # preserve_groups has higher priority.
-        if self._match_group_internal(project, self.preserve_groups):
+        if repo_manifest.match_groups(project, self.preserve_groups):
             return "preserve"
-        if self._match_group_internal(project, self.fixup_groups):
+        if repo_manifest.match_groups(project, self.fixup_groups):
             return "fixup"
         return "delete"
-
-    def _match_group_internal(self, project: xml.dom.minidom.Element,
-                              expect_groups: set[str] | None):
-        if expect_groups is None:
-            return True
-        project_groups = re.split(r",| ", project.getAttribute("groups"))
-        return bool(set(project_groups) & expect_groups)
-
-    def _parse_repo_manifest_defaults(self, root: xml.dom.minidom.Element):
-        """Parses <default> in a repo manifest. """
-        ret = dict[str, str]()
-        for default_element in root.getElementsByTagName("default"):
-            attrs = default_element.attributes
-            for index in range(attrs.length):
-                attr = attrs.item(index)
-                assert isinstance(attr, xml.dom.minidom.Attr)
-                ret[attr.name] = attr.value
-        return ret
@@ -134,7 +134,7 @@ class RepoWrapper:
                 manifest=self.repo_manifest_of_build,
                 fixup_groups=fixup_groups,
                 preserve_groups=preserve_groups,
-            ).write_transformed_dom(kleaf_manifest)
+            ).write_transformed_manifest(kleaf_manifest)
 
     def _modify_main_repo_manifest(self):
         manifest_path = (self._superproject_root /
@@ -26,16 +26,41 @@ build/kernel/kleaf/analysis/inputs.py -- --config=fast \\
     'mnemonic("KernelModule.*", //common-modules/virtual-device:x86_64/goldfish_drivers/goldfish_pipe)'
 # do some change to the code base that you don't expect it will affect this target
 # then re-execute these two commands, and look for differences.
+
+With --baseline, the first run records the hashes to the given file, and
+later runs print only the inputs that are added, removed or changed since
+then, grouped by the mnemonic of the actions that use them.
 """
 
 import argparse
+import array
+import bisect
+import concurrent.futures
 import dataclasses
-import errno
+import hashlib
 import json
+import mmap
 import os
 import pathlib
+import posixpath
+import re
 import subprocess
-from typing import Any
+import sys
+import threading
+import time
+from typing import Any, TextIO
+
+# Files at least this large are mapped into memory instead of read.
+_MMAP_THRESHOLD = 2**20
+
+# Files modified this recently are not cached. See _RACY_MTIME_NS in
+# kleaf/kernel_sbom.py.
+_RACY_MTIME_NS = 2_000_000_000
+
+_DEFAULT_HASH_CACHE = pathlib.Path("out/analysis/inputs_hash_cache.json")
+
+_WHITESPACE = re.compile(r"[ \t\n\r]*")
+_ELEMENT_END = re.compile(r"[ \t\n\r]*([,\]])[ \t\n\r]*")
 
 
 @dataclasses.dataclass(frozen=True, order=True)
@@ -45,156 +70,464 @@ class ArtifactPath(object):
     is_tree_artifact: bool
 
 
-def analyze_inputs(aquery_args):
+def analyze_inputs(aquery_args, hash_cache: pathlib.Path | None = None):
     """Main entry point to the program.
 
     Args:
         aquery_args: arguments to `bazel aquery`
+        hash_cache: JSON file to cache hashes of files across runs. If None,
+            all files are hashed.
     Returns:
         A dictionary, where keys are file paths, and values are hashes.
     """
-    text_result = subprocess.check_output(
-        [
-            "tools/bazel",
-            "aquery",
-            "--output=jsonproto"
-        ] + aquery_args,
-        text=True,
-    )
-    json_result = json.loads(text_result)
+    graph = run_aquery(aquery_args)
 
-    # https://github.com/bazelbuild/bazel/blob/master/src/main/protobuf/analysis_v2.proto
+    inputs = load_all_inputs(graph)
 
-    actions = json_result["actions"]
-    artifacts = id_object_list_to_dict(json_result.get("artifacts", []))
-    dep_set_of_files = id_object_list_to_dict(json_result.get("depSetOfFiles", []))
-    path_fragments = id_object_list_to_dict(json_result.get("pathFragments", []))
+    inputs = resolve_inputs(inputs)
 
-    inputs: set[ArtifactPath] = set()
-    for action in actions:
-        inputs |= load_inputs(action,
-                              dep_set_of_files=dep_set_of_files,
-                              artifacts=artifacts,
-                              path_fragments=path_fragments)
+    cache = HashCache(hash_cache)
+    ret = hash_all(inputs, cache)
+    cache.save()
+    return ret
 
-    inputs = resolve_inputs(inputs)
 
-    return hash_all(inputs)
+def analyze_inputs_against_baseline(
+        aquery_args,
+        baseline: pathlib.Path,
+        hash_cache: pathlib.Path | None = None,
+) -> dict[str, dict[str, list[str]]] | None:
+    """Compares inputs of an aquery against a baseline snapshot.
+
+    Args:
+        aquery_args: arguments to `bazel aquery`
+        baseline: the snapshot file. If it does not exist, it is created.
+        hash_cache: JSON file to cache hashes of files across runs. If None,
+            all files are hashed.
+    Returns:
+        None if the baseline is created. Otherwise, the changes from
+        the baseline; see diff_snapshots.
+    """
+    graph = run_aquery(aquery_args)
+
+    output_base = get_output_base()
+    inputs_by_mnemonic = {
+        mnemonic: resolve_inputs(inputs, output_base)
+        for mnemonic, inputs in load_inputs_by_mnemonic(graph).items()
+    }
+    all_inputs = set().union(*inputs_by_mnemonic.values())
 
+    cache = HashCache(hash_cache)
+    hashes = hash_all(all_inputs, cache)
+    cache.save()
 
-def id_object_list_to_dict(l: list[dict[str, Any]]) -> dict[int, dict[str, Any]]:
-    """Turns a list of objects to a dictionary from IDs to these objects."""
-    ret = {}
-    for elem in l:
-        ret[elem["id"]] = elem
-    return ret
+    snapshot = Snapshot.create(hashes, inputs_by_mnemonic)
+    if not baseline.exists():
+        snapshot.save(baseline)
+        return None
+    return diff_snapshots(Snapshot.load(baseline), snapshot)
 
 
-def load_inputs(action: dict[str, Any],
-                dep_set_of_files: dict[int, dict[str, Any]],
-                artifacts: dict[int, dict[str, Any]],
-                path_fragments: dict[int, dict[str, Any]],
-                ) -> set[ArtifactPath]:
-    """Returns the list of input paths to an action.
+def run_aquery(aquery_args) -> "ActionGraph":
+    """Returns the action graph of `bazel aquery --output=jsonproto`.
 
-    Args:
-        action: the action to look at.
-        dep_set_of_files: global dict of depsets
-        artifacts: global dict of artifacts
-        path_fragments: global dict of path fragments
+    The output is decoded while it is streamed from bazel.
 
-    Returns:
-        the set of input paths to the given action
+    Raises:
+        subprocess.CalledProcessError: if bazel fails. Its output is usually
+          empty or truncated then, so errors decoding it are not raised.
+    """
+    with subprocess.Popen(
+        [
+            "tools/bazel",
+            "aquery",
+            "--output=jsonproto"
+        ] + aquery_args,
+        stdout=subprocess.PIPE,
+        text=True,
+    ) as proc:
+        try:
+            graph = ActionGraph.load(proc.stdout)
+        except ValueError:
+            # Drain the output so that bazel does not block on writing it.
+            while proc.stdout.read(2**20):
+                pass
+            if proc.wait() != 0:
+                raise subprocess.CalledProcessError(proc.returncode, proc.args)
+            raise
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, proc.args)
+    return graph
+
+
+class ActionGraph(object):
+    """Compact form of the output of `bazel aquery --output=jsonproto`.
+
+    Only fields that are needed to look up inputs of actions are kept.
+    Objects are stored in lists indexed by their IDs, which bazel assigns
+    sequentially, instead of dicts of dicts.
+
+    See
+    https://github.com/bazelbuild/bazel/blob/master/src/main/protobuf/analysis_v2.proto
+    """
+
+    def __init__(self):
+        # [(mnemonic, input depset IDs)]
+        self.actions: list[tuple[str, tuple[int, ...]]] = []
+        # Indexed by artifact ID.
+        self.artifact_path_fragment_ids = array.array("q")
+        self.tree_artifact_ids: set[int] = set()
+        # Indexed by depset ID.
+        self.dep_set_direct_artifact_ids: list[tuple[int, ...]] = []
+        self.dep_set_transitive_dep_set_ids: list[tuple[int, ...]] = []
+        # Indexed by path fragment ID. The parent ID of top-level fragments
+        # is 0.
+        self.path_fragment_labels: list[str | None] = []
+        self.path_fragment_parent_ids = array.array("q")
+
+    @staticmethod
+    def from_json(json_result: dict[str, Any]) -> "ActionGraph":
+        """Creates the graph from the decoded output of aquery."""
+        graph = ActionGraph()
+        for key, elems in json_result.items():
+            if isinstance(elems, list):
+                for elem in elems:
+                    graph.add(key, elem)
+        return graph
+
+    @staticmethod
+    def load(f: TextIO, chunk_size: int = 2**20) -> "ActionGraph":
+        """Creates the graph from the output of aquery in a file.
+
+        Elements are decoded one by one, so the whole output is never in
+        memory.
+        """
+        graph = ActionGraph()
+        for key, elem in _iter_json_array_elements(f, chunk_size):
+            graph.add(key, elem)
+        return graph
+
+    def add(self, key: str, elem: dict[str, Any]):
+        """Adds an element of a top-level list in the output of aquery."""
+        if key == "actions":
+            self.actions.append((sys.intern(elem.get("mnemonic", "")),
+                                 tuple(elem.get("inputDepSetIds", ()))))
+        elif key == "artifacts":
+            _set_by_id(self.artifact_path_fragment_ids, elem["id"],
+                       elem["pathFragmentId"], 0)
+            if elem.get("isTreeArtifact"):
+                self.tree_artifact_ids.add(elem["id"])
+        elif key == "depSetOfFiles":
+            _set_by_id(self.dep_set_direct_artifact_ids, elem["id"],
+                       tuple(elem.get("directArtifactIds", ())), ())
+            _set_by_id(self.dep_set_transitive_dep_set_ids, elem["id"],
+                       tuple(elem.get("transitiveDepSetIds", ())), ())
+        elif key == "pathFragments":
+            _set_by_id(self.path_fragment_labels, elem["id"],
+                       sys.intern(elem["label"]), None)
+            _set_by_id(self.path_fragment_parent_ids, elem["id"],
+                       elem.get("parentId", 0), 0)
+
+
+def _set_by_id(seq, id: int, value, default):
+    """Sets seq[id], growing it with default values if needed."""
+    # IDs are usually sequential.
+    if id == len(seq):
+        seq.append(value)
+        return
+    if id > len(seq):
+        seq.extend([default] * (id + 1 - len(seq)))
+    seq[id] = value
+
+
+def _iter_json_array_elements(f: TextIO, chunk_size: int):
+    """Yields (key, element) of top-level lists of a JSON object in a file.
+
+    Values that are not lists are skipped.
+    """
+    decoder = json.JSONDecoder()
+    buf = ""
+    pos = 0
+    eof = False
+
+    def peek() -> str:
+        """Skips whitespaces, and returns the next character or ""."""
+        nonlocal buf, pos, eof
+        while True:
+            pos = _WHITESPACE.match(buf, pos).end()
+            if pos < len(buf) or eof:
+                return buf[pos:pos + 1]
+            read_more()
+
+    def read_more():
+        nonlocal buf, pos, eof
+        chunk = f.read(chunk_size)
+        eof = not chunk
+        buf = buf[pos:] + chunk
+        pos = 0
+
+    def expect(chars: str) -> str:
+        nonlocal pos
+        char = peek()
+        if not char or char not in chars:
+            raise ValueError(f"Expected {chars!r}, got {char!r}")
+        pos += 1
+        return char
+
+    def decode() -> Any:
+        nonlocal pos
+        peek()
+        while True:
+            try:
+                value, end = decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                read_more()
+                continue
+            # A number may continue in the next chunk.
+            if end == len(buf) and not eof:
+                read_more()
+                continue
+            pos = end
+            return value
+
+    expect("{")
+    if peek() == "}":
+        return
+    while True:
+        key = decode()
+        expect(":")
+        if peek() == "[":
+            pos += 1
+            if peek() == "]":
+                pos += 1
+            else:
+                while True:
+                    try:
+                        value, end = decoder.raw_decode(buf, pos)
+                        match = _ELEMENT_END.match(buf, end)
+                    except json.JSONDecodeError:
+                        match = None
+                    # The element, or whitespaces after it, may continue in
+                    # the next chunk.
+                    if match is None or (match.end() == len(buf) and not eof):
+                        if eof:
+                            raise ValueError(f"Malformed element of {key}")
+                        read_more()
+                        continue
+                    pos = match.end()
+                    yield key, value
+                    if match.group(1) == "]":
+                        break
+        else:
+            decode()
+        if expect(",}") == "}":
+            return
+
+
+def load_all_inputs(graph: ActionGraph) -> set[ArtifactPath]:
+    """Returns the union of input paths to all actions of an aquery.
+
+    Args:
+        graph: the action graph
     """
+    # Actions share most of their transitive depsets, so flatten them all at
+    # once to visit each depset only once.
     all_inputs_artifact_ids = dep_set_to_artifact_ids(
-        dep_set_ids=action.get("inputDepSetIds", []),
-        dep_set_of_files=dep_set_of_files,
+        dep_set_ids=[dep_set_id for _, dep_set_ids in graph.actions
+                     for dep_set_id in dep_set_ids],
+        graph=graph,
     )
 
     return artifacts_to_paths(
         artifact_ids=all_inputs_artifact_ids,
-        artifacts=artifacts,
-        path_fragments=path_fragments,
+        graph=graph,
     )
 
 
-# TODO(b/250646733): Ignore visited
+def load_inputs_by_mnemonic(graph: ActionGraph) -> dict[str, set[ArtifactPath]]:
+    """Returns input paths of an aquery, grouped by mnemonics of actions.
+
+    Args:
+        graph: the action graph
+    """
+    dep_set_ids_by_mnemonic: dict[str, list[int]] = {}
+    for mnemonic, dep_set_ids in graph.actions:
+        dep_set_ids_by_mnemonic.setdefault(mnemonic, []).extend(dep_set_ids)
+
+    return {
+        mnemonic: artifacts_to_paths(
+            artifact_ids=dep_set_to_artifact_ids(
+                dep_set_ids=dep_set_ids,
+                graph=graph,
+            ),
+            graph=graph,
+        )
+        for mnemonic, dep_set_ids in dep_set_ids_by_mnemonic.items()
+    }
+
+
 def dep_set_to_artifact_ids(
         dep_set_ids: list[int],
-        dep_set_of_files: dict[int, dict[str, Any]]
+        graph: ActionGraph,
 ) -> set[int]:
     """Flattens the list of depsets.
 
+    Each depset is visited once, even if it is shared by several parents.
+
     Args:
         dep_set_ids: list of depset IDs to look at
-        dep_set_of_files: global dict of depsets
+        graph: the action graph
 
     Returns:
         a set of artifact IDs that these depsets represents.
     """
+    direct_artifact_ids = graph.dep_set_direct_artifact_ids
+    transitive_dep_set_ids = graph.dep_set_transitive_dep_set_ids
     ret = set()
-    for dep_set_id in dep_set_ids:
-        dep_set = dep_set_of_files[dep_set_id]
-        ret |= set(dep_set.get("directArtifactIds", []))
-        if dep_set.get("transitiveDepSetIds"):
-            ret |= dep_set_to_artifact_ids(
-                dep_set_ids=dep_set["transitiveDepSetIds"],
-                dep_set_of_files=dep_set_of_files)
+    visited = set()
+    # Iterate instead of recursing; depsets may be deeply nested.
+    stack = list(dep_set_ids)
+    while stack:
+        dep_set_id = stack.pop()
+        if dep_set_id in visited:
+            continue
+        visited.add(dep_set_id)
+        ret.update(direct_artifact_ids[dep_set_id])
+        stack.extend(transitive_dep_set_ids[dep_set_id])
     return ret
 
 
-# TODO(b/250646733): cache
 def artifacts_to_paths(artifact_ids: set[int],
-                       artifacts: dict[int, dict[str, Any]],
-                       path_fragments: dict[int, dict[str, Any]]) -> set[ArtifactPath]:
+                       graph: ActionGraph) -> set[ArtifactPath]:
     """Maps lists of artifacts to their paths.
 
     Args:
         artifact_ids: list of artifact IDs to look at
-        artifacts: global dict of artifacts
-        path_fragments: global dict of path fragments
+        graph: the action graph
 
     Returns:
         a set of paths of the given artifacts
     """
     ret = set()
+    # Artifacts share most of their parent directories.
+    path_cache: dict[int, str] = {}
     for artifact_id in artifact_ids:
-        artifact = artifacts[artifact_id]
         path = ArtifactPath(
-            path=pathlib.Path(*get_path(
-                path_fragment_id=artifact["pathFragmentId"],
-                path_fragments=path_fragments,
+            path=pathlib.Path(get_path(
+                path_fragment_id=graph.artifact_path_fragment_ids[artifact_id],
+                graph=graph,
+                cache=path_cache,
             )),
-            is_tree_artifact=bool(artifact.get("isTreeArtifact")))
+            is_tree_artifact=artifact_id in graph.tree_artifact_ids)
         ret.add(path)
     return ret
 
 
 def get_path(
         path_fragment_id: int,
-        path_fragments: dict[int, dict[str, Any]]
-) -> list[str]:
+        graph: ActionGraph,
+        cache: dict[int, str] | None = None,
+) -> str:
     """Returns the full path that the given path fragment ID represents.
 
     Args:
         path_fragment_id: the path fragment ID to look at
-        path_fragments: global dict of path fragments
+        graph: the action graph
+        cache: dict from path fragment IDs to paths. Shared across calls
+            so that each fragment is only joined once.
 
     Returns:
-        A list of path fragments of the final path.
+        The final path.
+    """
+    if cache is None:
+        cache = {}
+
+    # Walk up to the closest ancestor with a known path.
+    uncached = []
+    fragment_id = path_fragment_id
+    while fragment_id and fragment_id not in cache:
+        uncached.append(fragment_id)
+        fragment_id = graph.path_fragment_parent_ids[fragment_id]
+    path = cache.get(fragment_id) if fragment_id else None
+
+    for fragment_id in reversed(uncached):
+        label = graph.path_fragment_labels[fragment_id]
+        path = label if path is None else f"{path}/{label}"
+        cache[fragment_id] = path
+    return path
+
+
+class HashCache(object):
+    """Persistent cache of SHA-1 of files.
+
+    Entries are invalidated when the inode, mtime or size of a file changes.
+    Entries of files that are not looked up are dropped when the cache is
+    saved, so it does not grow across investigations.
     """
-    path_fragment = path_fragments[path_fragment_id]
-    if path_fragment.get("parentId"):
-        ret = get_path(
-            path_fragment_id=path_fragment["parentId"],
-            path_fragments=path_fragments)
-    else:
-        ret = []
-    ret.append(path_fragment["label"])
-    return ret
-
 
-def hash_all(paths: set[ArtifactPath]) -> dict[str, str]:
+    def __init__(self, path: pathlib.Path | None):
+        """Loads the cache.
+
+        Args:
+            path: the JSON file. If None, nothing is cached.
+        """
+        self._path = path
+        self._lock = threading.Lock()
+        self._start_ns = time.time_ns()
+        # {str(file): [inode, mtime_ns, size, sha1]}
+        self._entries: dict[str, list] = {}
+        self._looked_up: set[str] = set()
+        if path is None:
+            return
+        try:
+            with open(path) as cache_file:
+                self._entries = json.load(cache_file)
+        except (OSError, json.JSONDecodeError):
+            pass
+
+    def get(self, file: pathlib.Path, stat: os.stat_result) -> str | None:
+        """Returns the cached hash of a file, or None."""
+        self._looked_up.add(str(file))
+        entry = self._entries.get(str(file))
+        if entry is None or entry[:3] != _get_stat_key(stat):
+            return None
+        return entry[3]
+
+    def put(self, file: pathlib.Path, stat: os.stat_result, sha1: str):
+        if stat.st_mtime_ns >= self._start_ns - _RACY_MTIME_NS:
+            return
+        with self._lock:
+            self._entries[str(file)] = _get_stat_key(stat) + [sha1]
+
+    def save(self):
+        if self._path is None:
+            return
+        self._path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self._path.with_name(f"{self._path.name}.{os.getpid()}")
+        entries = {file: entry for file, entry in self._entries.items()
+                   if file in self._looked_up}
+        with open(tmp_path, "w") as cache_file:
+            json.dump(entries, cache_file)
+        os.replace(tmp_path, self._path)
+
+
+def _get_stat_key(stat: os.stat_result) -> list[int]:
+    return [stat.st_ino, stat.st_mtime_ns, stat.st_size]
+
+
+def hash_file(file: pathlib.Path) -> str:
+    """Returns the SHA-1 of a file."""
+    with open(file, "rb") as f:
+        if os.fstat(f.fileno()).st_size < _MMAP_THRESHOLD:
+            return hashlib.sha1(f.read()).hexdigest()
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            return hashlib.sha1(mapped).hexdigest()
+
+
+def hash_all(paths: set[ArtifactPath],
+             cache: HashCache | None = None) -> dict[str, str]:
     """Hashes all the given paths.
 
     For files, their hashes are recorded.
@@ -203,6 +536,7 @@ def hash_all(paths: set[ArtifactPath]) -> dict[str, str]:
 
     Args:
         paths: a set of paths to look at.
+        cache: cache of hashes of files
     Returns:
         a dictionary, where the keys are paths to files, and values are the hashes.
     """
@@ -215,52 +549,49 @@ def hash_all(paths: set[ArtifactPath]) -> dict[str, str]:
 
     exists, missing = split_existing_files(files)
 
-    return hash_all_files(list(exists)) | {
+    return hash_all_files(list(exists), cache) | {
         str(file): None for file in missing
     }
 
 
-def hash_all_files(files: list[pathlib.Path]) -> dict[str, str]:
+def hash_all_files(files: list[pathlib.Path],
+                   cache: HashCache | None = None) -> dict[str, str]:
     """Hashes all the given files.
 
     For files, their hashes are recorded.
-    For non-existing paths, `None` is set in the final value.
+
+    Files are hashed in parallel; hashlib releases the GIL while hashing
+    large buffers.
 
     Args:
         files: a set of paths to look at. They are expected to point to a file.
+        cache: cache of hashes of files
     Returns:
         a dictionary, where the keys are paths to files, and values are the hashes.
     """
 
-    if not files:
-        return {}
-
-    try:
-        output = subprocess.check_output([
-                                             "sha1sum"
-                                         ] + list(str(path) for path in files),
-                                         text=True).splitlines()
-        ret = dict()
-        for line in output:
-            sha1sum, path = line.split(maxsplit=2)
-            ret[path] = sha1sum
-
-        return ret
-    except OSError as e:
-        if e.errno != errno.E2BIG:
-            raise e
-
-        mid = len(files) // 2
-        head = files[:mid]
-        tail = files[mid:]
-
-        if not head or not tail:
-            # A single item is too big already. Continue recursing will
-            # cause infinite recursion. Throwing E2BIG correctly reflects that
-            # a path is too long.
-            raise e
-
-        return hash_all_files(head) | hash_all_files(tail)
+    ret = {}
+    misses = []
+    for file in files:
+        # Stat before hashing, so a concurrent change invalidates the entry.
+        stat = file.stat()
+        sha1 = cache.get(file, stat) if cache else None
+        if sha1 is None:
+            misses.append((file, stat))
+        else:
+            ret[str(file)] = sha1
+
+    def hash_one(file: pathlib.Path, stat: os.stat_result):
+        sha1 = hash_file(file)
+        if cache:
+            cache.put(file, stat, sha1)
+        ret[str(file)] = sha1
+
+    with concurrent.futures.ThreadPoolExecutor() as executor:
+        for future in [executor.submit(hash_one, file, stat)
+                       for file, stat in misses]:
+            future.result()
+    return ret
 
 
 def walk_files(path: pathlib.Path):
@@ -277,7 +608,8 @@ def walk_files(path: pathlib.Path):
     return ret
 
 
-def resolve_inputs(inputs: set[ArtifactPath]) -> set[ArtifactPath]:
+def resolve_inputs(inputs: set[ArtifactPath],
+                   output_base: pathlib.Path | None = None) -> set[ArtifactPath]:
     """Resolves paths returned by bazel aquery.
 
     For input files from sub-workspaces, `bazel aquery` returns the following:
@@ -289,14 +621,14 @@ def resolve_inputs(inputs: set[ArtifactPath]) -> set[ArtifactPath]:
 
     Args:
         inputs: set of inputs returned by `bazel aquery`
-        actions: list of actions
-        targets: global dict of targets
+        output_base: the output base. If None, it is queried from bazel.
 
     Returns:
         set of resolved inputs
     """
     resolved_inputs: set[ArtifactPath] = set()
-    output_base = get_output_base()
+    if output_base is None:
+        output_base = get_output_base()
     for input in inputs:
         if input.path.is_relative_to("external"):
             if (output_base / input.path).exists() and \
@@ -347,12 +679,175 @@ def split_existing_files(files: set[pathlib.Path]):
     return exists, missing
 
 
+@dataclasses.dataclass
+class Snapshot(object):
+    """Hashes of inputs of an aquery, indexed for diffing.
+
+    Directories are hashed as Merkle trees, so that subtrees that have not
+    changed since another snapshot can be skipped without looking at the
+    files under them.
+    """
+
+    # Mnemonics of actions. Files refer to them by index.
+    mnemonics: list[str]
+    # {file: [sha1, [mnemonic index]]}. The hash is None for missing files.
+    files: dict[str, list]
+    # {directory: [merkle hash, [child name]]}. The root is "" for relative
+    # paths, and "/" for absolute paths.
+    dirs: dict[str, list]
+
+    @staticmethod
+    def create(hashes: dict[str, str | None],
+               inputs_by_mnemonic: dict[str, set[ArtifactPath]]) -> "Snapshot":
+        """Creates a snapshot.
+
+        Args:
+            hashes: return value of hash_all(), on the union of all inputs
+            inputs_by_mnemonic: inputs of actions, grouped by mnemonics
+        """
+        mnemonics = sorted(inputs_by_mnemonic)
+        files = {file: [sha1, []] for file, sha1 in hashes.items()}
+        sorted_files = sorted(hashes)
+        for index, mnemonic in enumerate(mnemonics):
+            for input in inputs_by_mnemonic[mnemonic]:
+                for file in _files_of_input(input, files, sorted_files):
+                    indexes = files[file][1]
+                    # A file may be both an input and in a tree artifact.
+                    if not indexes or indexes[-1] != index:
+                        indexes.append(index)
+
+        children: dict[str, set[str]] = {}
+        for file in files:
+            child = file
+            parent = posixpath.dirname(child)
+            while parent != child:
+                siblings = children.setdefault(parent, set())
+                if child in siblings:
+                    break
+                siblings.add(child)
+                child = parent
+                parent = posixpath.dirname(child)
+
+        # Children have longer paths than their parents, so they are hashed
+        # first.
+        dirs: dict[str, list] = {}
+        for dir in sorted(children, key=len, reverse=True):
+            merkle = hashlib.sha1()
+            for child in sorted(children[dir]):
+                child_hash = dirs[child][0] if child in dirs \
+                    else files[child][0]
+                merkle.update(f"{child}\0{child_hash}\n".encode())
+            dirs[dir] = [merkle.hexdigest(),
+                         sorted(posixpath.basename(child)
+                                for child in children[dir])]
+        return Snapshot(mnemonics=mnemonics, files=files, dirs=dirs)
+
+    @staticmethod
+    def load(path: pathlib.Path) -> "Snapshot":
+        with open(path) as snapshot_file:
+            return Snapshot(**json.load(snapshot_file))
+
+    def save(self, path: pathlib.Path):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, "w") as snapshot_file:
+            json.dump(dataclasses.asdict(self), snapshot_file,
+                      separators=(",", ":"))
+
+    def get_mnemonics(self, file: str) -> list[str]:
+        return [self.mnemonics[index] for index in self.files[file][1]]
+
+
+def _files_of_input(input: ArtifactPath, files: dict[str, Any],
+                    sorted_files: list[str]):
+    """Yields hashed files that belong to an input."""
+    path = str(input.path)
+    if not input.is_tree_artifact:
+        if path in files:
+            yield path
+        return
+    prefix = path + "/"
+    for index in range(bisect.bisect_left(sorted_files, prefix),
+                       len(sorted_files)):
+        if not sorted_files[index].startswith(prefix):
+            break
+        yield sorted_files[index]
+
+
+def diff_snapshots(old: Snapshot,
+                   new: Snapshot) -> dict[str, dict[str, list[str]]]:
+    """Compares two snapshots.
+
+    Directories with the same Merkle hash in both snapshots are skipped.
+
+    Returns:
+        A dictionary, where keys are mnemonics, and values are dictionaries
+        from "added", "removed" or "changed" to sorted lists of files. Files
+        are reported under mnemonics of actions that use them; removed files
+        under those of the old snapshot.
+    """
+    ret: dict[str, dict[str, list[str]]] = {}
+
+    def report(kind: str, file: str, snapshot: Snapshot):
+        for mnemonic in snapshot.get_mnemonics(file):
+            ret.setdefault(mnemonic, {}).setdefault(kind, []).append(file)
+
+    stack = [root for root in ("", "/") if root in old.dirs or root in new.dirs]
+    while stack:
+        dir = stack.pop()
+        old_dir = old.dirs.get(dir)
+        new_dir = new.dirs.get(dir)
+        if old_dir and new_dir and old_dir[0] == new_dir[0]:
+            continue
+        names = set(old_dir[1] if old_dir else []) | \
+            set(new_dir[1] if new_dir else [])
+        for name in names:
+            child = posixpath.join(dir, name)
+            if child in old.dirs or child in new.dirs:
+                stack.append(child)
+            old_file = old.files.get(child)
+            new_file = new.files.get(child)
+            if old_file is None and new_file is None:
+                continue
+            if old_file is None:
+                report("added", child, new)
+            elif new_file is None:
+                report("removed", child, old)
+            elif old_file[0] != new_file[0]:
+                report("changed", child, new)
+
+    for changes in ret.values():
+        for files in changes.values():
+            files.sort()
+    return ret
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description=__doc__,
                                      formatter_class=argparse.RawTextHelpFormatter)
     parser.add_argument("aquery_args", nargs="+",
                         help="Args to `bazel aquery`.")
+    parser.add_argument("--hash_cache", type=pathlib.Path,
+                        default=_DEFAULT_HASH_CACHE,
+                        help="JSON file to cache hashes of files across "
+                             "runs. Entries are invalidated when the inode, "
+                             "mtime or size of a file changes, and dropped "
+                             "when the file is not in the run.")
+    parser.add_argument("--nohash_cache", dest="hash_cache",
+                        action="store_const", const=None,
+                        help="Hash all files without a cache.")
+    parser.add_argument("--baseline", type=pathlib.Path,
+                        help="Snapshot of hashes to compare against. If it "
+                             "does not exist, it is created; otherwise, only "
+                             "inputs that are added, removed or changed since "
+                             "the snapshot are printed, grouped by mnemonic.")
     args = parser.parse_args()
 
-    results = analyze_inputs(**vars(args))
+    if args.baseline:
+        results = analyze_inputs_against_baseline(**vars(args))
+        if results is None:
+            print(f"Baseline written to {args.baseline}", file=sys.stderr)
+            sys.exit(0)
+    else:
+        del args.baseline
+        results = analyze_inputs(**vars(args))
     print(json.dumps(results, indent=2, sort_keys=True))
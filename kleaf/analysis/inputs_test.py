@@ -0,0 +1,352 @@
+# Copyright (C) 2024 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import contextlib
+import hashlib
+import io
+import json
+import os
+import pathlib
+import subprocess
+import tempfile
+import textwrap
+import unittest
+
+from absl.testing import absltest
+import inputs
+
+# Output of `bazel aquery --output=jsonproto` with two actions that share
+# depsets 3 and 4.
+_AQUERY_RESULT = {
+    "actions": [
+        {"inputDepSetIds": [1]},
+        {"inputDepSetIds": [2, 4]},
+    ],
+    "artifacts": [
+        {"id": 1, "pathFragmentId": 3},
+        {"id": 2, "pathFragmentId": 4},
+        {"id": 3, "pathFragmentId": 5, "isTreeArtifact": True},
+        {"id": 4, "pathFragmentId": 6},
+    ],
+    "depSetOfFiles": [
+        {"id": 1, "transitiveDepSetIds": [3, 4]},
+        {"id": 2, "directArtifactIds": [4], "transitiveDepSetIds": [3]},
+        {"id": 3, "directArtifactIds": [1], "transitiveDepSetIds": [4]},
+        {"id": 4, "directArtifactIds": [2, 3]},
+    ],
+    "pathFragments": [
+        {"id": 1, "label": "common"},
+        {"id": 2, "label": "include", "parentId": 1},
+        {"id": 3, "label": "a.h", "parentId": 2},
+        {"id": 4, "label": "b.h", "parentId": 2},
+        {"id": 5, "label": "gen", "parentId": 1},
+        {"id": 6, "label": "Makefile"},
+    ],
+}
+
+
+class InputsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.graph = inputs.ActionGraph.from_json(_AQUERY_RESULT)
+
+    def test_dep_set_to_artifact_ids(self):
+        self.assertEqual(
+            inputs.dep_set_to_artifact_ids([1], self.graph), {1, 2, 3})
+        self.assertEqual(
+            inputs.dep_set_to_artifact_ids([2], self.graph), {1, 2, 3, 4})
+
+    def test_deep_dep_sets(self):
+        # Deeper than the recursion limit.
+        dep_set_of_files = [
+            {"id": i, "directArtifactIds": [i],
+             "transitiveDepSetIds": [i + 1]}
+            for i in range(1, 10000)
+        ]
+        dep_set_of_files.append({"id": 10000})
+        graph = inputs.ActionGraph.from_json(
+            {"depSetOfFiles": dep_set_of_files})
+        self.assertEqual(
+            inputs.dep_set_to_artifact_ids([1], graph),
+            set(range(1, 10000)))
+
+    def test_get_path(self):
+        cache = {}
+        self.assertEqual(inputs.get_path(3, self.graph, cache),
+                         "common/include/a.h")
+        self.assertEqual(cache, {1: "common", 2: "common/include",
+                                 3: "common/include/a.h"})
+        self.assertEqual(inputs.get_path(4, self.graph, cache),
+                         "common/include/b.h")
+        self.assertEqual(inputs.get_path(6, self.graph), "Makefile")
+
+    def test_load(self):
+        json_result = dict(_AQUERY_RESULT, empty=[], ruleClasses=[
+            {"id": 1, "name": "kernel_build"}],
+            number=1234567, object={"actions": [1]})
+        for indent in (None, 2):
+            text = json.dumps(json_result, indent=indent)
+            # Small chunks split tokens.
+            for chunk_size in (1, 7, len(text)):
+                graph = inputs.ActionGraph.load(io.StringIO(text), chunk_size)
+                self.assertEqual(vars(graph), vars(self.graph))
+
+    def test_load_empty(self):
+        graph = inputs.ActionGraph.load(io.StringIO("{}\n"))
+        self.assertEqual(graph.actions, [])
+
+    def test_load_truncated(self):
+        text = json.dumps(_AQUERY_RESULT)
+        with self.assertRaises(ValueError):
+            inputs.ActionGraph.load(io.StringIO(text[:-20]), 16)
+
+    def test_load_all_inputs(self):
+        self.assertEqual(inputs.load_all_inputs(self.graph), {
+            inputs.ArtifactPath(pathlib.Path("common/include/a.h"), False),
+            inputs.ArtifactPath(pathlib.Path("common/include/b.h"), False),
+            inputs.ArtifactPath(pathlib.Path("common/gen"), True),
+            inputs.ArtifactPath(pathlib.Path("Makefile"), False),
+        })
+
+    def test_hash_all_files(self):
+        temp_dir = pathlib.Path(
+            self.enterContext(tempfile.TemporaryDirectory()))
+        small = temp_dir / "small"
+        small.write_bytes(b"small")
+        # Larger than the mmap threshold.
+        big = temp_dir / "big"
+        big.write_bytes(b"big" * 2**20)
+        empty = temp_dir / "empty"
+        empty.touch()
+        self.assertEqual(inputs.hash_all_files([small, big, empty]), {
+            str(small): hashlib.sha1(b"small").hexdigest(),
+            str(big): hashlib.sha1(b"big" * 2**20).hexdigest(),
+            str(empty): hashlib.sha1(b"").hexdigest(),
+        })
+
+    def test_hash_cache(self):
+        temp_dir = pathlib.Path(
+            self.enterContext(tempfile.TemporaryDirectory()))
+        cache_path = temp_dir / "cache.json"
+        file = temp_dir / "file"
+        file.write_bytes(b"old")
+        os.utime(file, ns=(1_000_000_000, 1_000_000_000))
+        cache = inputs.HashCache(cache_path)
+        inputs.hash_all_files([file], cache)
+        cache.save()
+
+        # Same inode, size and mtime, so the cached hash is used.
+        file.write_bytes(b"new")
+        os.utime(file, ns=(1_000_000_000, 1_000_000_000))
+        self.assertEqual(
+            inputs.hash_all_files([file], inputs.HashCache(cache_path)),
+            {str(file): hashlib.sha1(b"old").hexdigest()})
+
+        os.utime(file, ns=(2_000_000_000, 2_000_000_000))
+        self.assertEqual(
+            inputs.hash_all_files([file], inputs.HashCache(cache_path)),
+            {str(file): hashlib.sha1(b"new").hexdigest()})
+
+    def test_hash_cache_drops_unused(self):
+        temp_dir = pathlib.Path(
+            self.enterContext(tempfile.TemporaryDirectory()))
+        cache_path = temp_dir / "cache.json"
+        files = [temp_dir / "a", temp_dir / "b"]
+        for file in files:
+            file.write_bytes(file.name.encode())
+            os.utime(file, ns=(1_000_000_000, 1_000_000_000))
+        cache = inputs.HashCache(cache_path)
+        inputs.hash_all_files(files, cache)
+        cache.save()
+        self.assertEqual(json.loads(cache_path.read_text()).keys(),
+                         {str(file) for file in files})
+
+        # Only the file hashed in the last run is kept.
+        cache = inputs.HashCache(cache_path)
+        inputs.hash_all_files(files[:1], cache)
+        cache.save()
+        self.assertEqual(json.loads(cache_path.read_text()).keys(),
+                         {str(files[0])})
+
+    def test_hash_cache_skips_recently_modified(self):
+        temp_dir = pathlib.Path(
+            self.enterContext(tempfile.TemporaryDirectory()))
+        cache_path = temp_dir / "cache.json"
+        file = temp_dir / "file"
+        file.write_bytes(b"content")
+        cache = inputs.HashCache(cache_path)
+        inputs.hash_all_files([file], cache)
+        cache.save()
+        self.assertEqual(cache_path.read_text(), "{}")
+
+    def test_load_inputs_by_mnemonic(self):
+        graph = inputs.ActionGraph.from_json(dict(_AQUERY_RESULT, actions=[
+            {"mnemonic": "KernelBuild", "inputDepSetIds": [1]},
+            {"mnemonic": "KernelModule", "inputDepSetIds": [4]},
+            {"mnemonic": "KernelModule", "inputDepSetIds": [2]},
+        ]))
+        self.assertEqual(inputs.load_inputs_by_mnemonic(graph), {
+            "KernelBuild": {
+                inputs.ArtifactPath(pathlib.Path("common/include/a.h"), False),
+                inputs.ArtifactPath(pathlib.Path("common/include/b.h"), False),
+                inputs.ArtifactPath(pathlib.Path("common/gen"), True),
+            },
+            "KernelModule": {
+                inputs.ArtifactPath(pathlib.Path("common/include/a.h"), False),
+                inputs.ArtifactPath(pathlib.Path("common/include/b.h"), False),
+                inputs.ArtifactPath(pathlib.Path("common/gen"), True),
+                inputs.ArtifactPath(pathlib.Path("Makefile"), False),
+            },
+        })
+
+
+class RunAqueryTest(unittest.TestCase):
+
+    def setUp(self):
+        temp_dir = pathlib.Path(
+            self.enterContext(tempfile.TemporaryDirectory()))
+        self.enterContext(contextlib.chdir(temp_dir))
+        self.bazel = temp_dir / "tools/bazel"
+        self.bazel.parent.mkdir()
+
+    def _write_bazel(self, output: str, exit_code: int):
+        self.bazel.write_text(textwrap.dedent(f"""\
+            #!/bin/sh
+            printf '%s' '{output}'
+            exit {exit_code}
+            """))
+        self.bazel.chmod(0o755)
+
+    def test_run_aquery(self):
+        self._write_bazel(json.dumps(_AQUERY_RESULT), 0)
+        self.assertEqual(vars(inputs.run_aquery(["//common:kernel_aarch64"])),
+                         vars(inputs.ActionGraph.from_json(_AQUERY_RESULT)))
+
+    def test_empty_output_of_failed_aquery(self):
+        self._write_bazel("", 7)
+        with self.assertRaises(subprocess.CalledProcessError) as context:
+            inputs.run_aquery(["//missing:target"])
+        self.assertEqual(context.exception.returncode, 7)
+
+    def test_truncated_output_of_failed_aquery(self):
+        self._write_bazel(json.dumps(_AQUERY_RESULT)[:-20], 1)
+        with self.assertRaises(subprocess.CalledProcessError) as context:
+            inputs.run_aquery(["//common:kernel_aarch64"])
+        self.assertEqual(context.exception.returncode, 1)
+
+    def test_malformed_output(self):
+        self._write_bazel("{]", 0)
+        with self.assertRaises(ValueError):
+            inputs.run_aquery(["//common:kernel_aarch64"])
+
+
+class SnapshotTest(unittest.TestCase):
+
+    _INPUTS_BY_MNEMONIC = {
+        "KernelBuild": {
+            inputs.ArtifactPath(pathlib.Path("common/Makefile"), False),
+            inputs.ArtifactPath(pathlib.Path("common/gen"), True),
+        },
+        "KernelModule": {
+            inputs.ArtifactPath(pathlib.Path("common/Makefile"), False),
+            inputs.ArtifactPath(pathlib.Path("/out/external/a.c"), False),
+        },
+    }
+
+    def _create(self, hashes):
+        return inputs.Snapshot.create(hashes, self._INPUTS_BY_MNEMONIC)
+
+    def test_create(self):
+        snapshot = self._create({
+            "common/Makefile": "1",
+            "common/gen/a.h": "2",
+            "common/gen/sub/b.h": "3",
+            "/out/external/a.c": None,
+        })
+        self.assertEqual(snapshot.mnemonics, ["KernelBuild", "KernelModule"])
+        self.assertEqual(snapshot.get_mnemonics("common/Makefile"),
+                         ["KernelBuild", "KernelModule"])
+        self.assertEqual(snapshot.get_mnemonics("common/gen/sub/b.h"),
+                         ["KernelBuild"])
+        self.assertEqual(snapshot.get_mnemonics("/out/external/a.c"),
+                         ["KernelModule"])
+        self.assertEqual(snapshot.dirs["common"][1], ["Makefile", "gen"])
+        self.assertEqual(snapshot.dirs[""][1], ["common"])
+        self.assertEqual(snapshot.dirs["/"][1], ["out"])
+
+    def test_merkle(self):
+        old = self._create({"common/Makefile": "1", "common/gen/a.h": "2",
+                            "common/gen/sub/b.h": "3"})
+        new = self._create({"common/Makefile": "1", "common/gen/a.h": "2",
+                            "common/gen/sub/b.h": "4"})
+        self.assertNotEqual(old.dirs["common/gen/sub"][0],
+                            new.dirs["common/gen/sub"][0])
+        self.assertNotEqual(old.dirs[""][0], new.dirs[""][0])
+
+        # Only the file name differs.
+        moved = self._create({"common/Makefile": "1", "common/gen/a.h": "2",
+                              "common/gen/sub/c.h": "3"})
+        self.assertNotEqual(old.dirs["common/gen"][0],
+                            moved.dirs["common/gen"][0])
+
+        same = self._create({"common/gen/sub/b.h": "3", "common/gen/a.h": "2",
+                             "common/Makefile": "1"})
+        self.assertEqual(old, same)
+
+    def test_diff(self):
+        old = self._create({
+            "common/Makefile": "1",
+            "common/gen/a.h": "2",
+            "common/gen/sub/b.h": "3",
+            "/out/external/a.c": None,
+        })
+        new = self._create({
+            "common/Makefile": "1",
+            "common/gen/a.h": "2",
+            "common/gen/sub/c.h": "4",
+            "/out/external/a.c": "5",
+        })
+        self.assertEqual(inputs.diff_snapshots(old, new), {
+            "KernelBuild": {
+                "added": ["common/gen/sub/c.h"],
+                "removed": ["common/gen/sub/b.h"],
+            },
+            "KernelModule": {
+                "changed": ["/out/external/a.c"],
+            },
+        })
+        self.assertEqual(inputs.diff_snapshots(old, old), {})
+
+    def test_diff_skips_unchanged_directories(self):
+        old = self._create({"common/Makefile": "1", "common/gen/a.h": "2"})
+        new = self._create({"common/Makefile": "3", "common/gen/a.h": "2"})
+        # Unchanged subtrees are not looked at, even if their files are
+        # not in the snapshot.
+        del old.files["common/gen/a.h"]
+        self.assertEqual(inputs.diff_snapshots(old, new), {
+            "KernelBuild": {"changed": ["common/Makefile"]},
+            "KernelModule": {"changed": ["common/Makefile"]},
+        })
+
+    def test_save_load(self):
+        snapshot = self._create({"common/Makefile": "1",
+                                 "common/gen/a.h": "2"})
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = pathlib.Path(temp_dir) / "baseline.json"
+            snapshot.save(path)
+            self.assertEqual(inputs.Snapshot.load(path), snapshot)
+
+
+if __name__ == "__main__":
+    absltest.main()
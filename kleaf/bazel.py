@@ -12,22 +12,25 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+# This script runs before every Bazel command. To keep startup fast, modules
+# that are only needed by uncommon code paths (e.g. help, clean, errors) are
+# imported where they are used. See bazel_startup_test.py.
+
 import argparse
-import dataclasses
+import collections.abc
+import io
+import json
 import os
 import pathlib
 import re
 import shlex
-import shutil
 import sys
-import textwrap
-from typing import BinaryIO, Generator, Tuple, Optional
-
-from impl.default_host_tools import DEFAULT_HOST_TOOLS
-from kleaf_help import KleafHelpPrinter, FLAGS_BAZEL_RC
 
 _BAZEL_REL_PATH = "prebuilts/kernel-build-tools/bazel/linux-x86_64/bazel"
 
+# Sync with kleaf/kleaf_help.py
+_FLAGS_BAZEL_RC = "build/kernel/kleaf/bazelrc/flags.bazelrc"
+
 # Sync with the following files:
 #   kleaf/impl/kernel_build.bzl
 _QUERY_TARGETS_ARG = 'kind("kernel_build rule", //... except attr("tags", \
@@ -41,6 +44,13 @@ _QUERY_ABI_TARGETS_ARG = 'kind("(update_source_file|abi_update) rule", //... exc
 
 _REPO_BOUNDARY_FILES = ("MODULE.bazel", "REPO.bazel", "WORKSPACE.bazel", "WORKSPACE")
 
+# Size of chunks read from the stdout / stderr of Bazel.
+_OUTPUT_CHUNK_SIZE = 2**16
+
+# Commands that build targets. --kleaf_build_metrics and --kleaf_profile
+# only apply to them.
+_BUILD_COMMANDS = ("build", "test", "run", "coverage")
+
 # Tools added to PATH so actions that does not explicitly
 # use hermetic toolchain still has some level of hermeticity. This is to cover
 # actions and rules out of our control, e.g. external deps.
@@ -61,19 +71,20 @@ _ACTION_EXTRA_HOST_TOOLS = [
     "git",
 ]
 
-@dataclasses.dataclass
 class BazelWrapperException(Exception):
     """A generic Bazel-wrapper error."""
 
-    # error message
-    message: str = ""
-
-    # exit code of the program.
-    # Default is 1, "Build failed". See https://bazel.build/run/scripts
-    code: int = 1
+    def __init__(self, message: str = "", code: int = 1):
+        """Creates a BazelWrapperException.
 
-    def __post_init__(self):
-        super().__init__(self, self.message)
+        Args:
+            message: error message
+            code: exit code of the program.
+                Default is 1, "Build failed". See https://bazel.build/run/scripts
+        """
+        super().__init__(self, message)
+        self.message = message
+        self.code = code
 
 
 class BazelSubprocessException(BazelWrapperException):
@@ -117,6 +128,49 @@ class MultipleBazelWrapperException(BazelWrapperException):
         )
 
 
+class _BazelrcCache:
+    """Remembers the inputs of bazelrc files generated by the wrapper.
+
+    Each generated file is associated with a key derived from its content:
+    - For files rewritten from a source bazelrc, the key is the hash of the
+      rewritten content. Source bazelrc files are tiny, so they are always
+      read; only writing is skipped.
+    - For files generated from a string, the key is the string itself. These
+      strings are small, so this avoids loading hashlib on every invocation.
+
+    If the key of a generated file is unchanged, the file is neither read nor
+    written again.
+    """
+
+    def __init__(self, path: pathlib.Path):
+        self._path = path
+        self._dirty = False
+        try:
+            with open(path) as file:
+                self._entries = json.load(file)
+        except (OSError, json.JSONDecodeError):
+            self._entries = {}
+        self._entries.setdefault("generated", {})
+        self._entries.setdefault("rewritten", {})
+
+    def is_fresh(self, kind: str, dst: pathlib.Path, key: str) -> bool:
+        """Returns whether dst exists and is generated with the given key."""
+        return self._entries[kind].get(str(dst)) == key and dst.is_file()
+
+    def update(self, kind: str, dst: pathlib.Path, key: str):
+        self._entries[kind][str(dst)] = key
+        self._dirty = True
+
+    def save(self):
+        if not self._dirty:
+            return
+        tmp_path = self._path.with_name(self._path.name + ".tmp")
+        with open(tmp_path, "w") as file:
+            json.dump(self._entries, file, indent=2, sort_keys=True)
+        os.replace(tmp_path, self._path)
+        self._dirty = False
+
+
 def _require_absolute_path(p: str | pathlib.Path) -> pathlib.Path:
     p = pathlib.Path(p)
     if not p.is_absolute():
@@ -124,8 +178,13 @@ def _require_absolute_path(p: str | pathlib.Path) -> pathlib.Path:
     return p
 
 
-def _partition(lst: list[str], index: Optional[int]) \
-        -> Tuple[list[str], Optional[str], list[str]]:
+def _parse_size(value: str) -> int:
+    from cache_dir_manager import parse_size
+    return parse_size(value)
+
+
+def _partition(lst: list[str], index: int | None) \
+        -> tuple[list[str], str | None, list[str]]:
     """Returns the triple split by index.
 
     That is, return a tuple:
@@ -138,7 +197,7 @@ def _partition(lst: list[str], index: Optional[int]) \
     return lst[:index], lst[index], lst[index + 1:]
 
 
-class BazelWrapper(KleafHelpPrinter):
+class BazelWrapper:
     def __init__(self, kleaf_repo_dir: pathlib.Path, bazel_args: list[str], env):
         """Splits arguments to the bazel binary based on the functionality.
 
@@ -205,10 +264,9 @@ class BazelWrapper(KleafHelpPrinter):
                 return possible_workspace
             possible_workspace = possible_workspace.parent
 
-        sys.stderr.write(textwrap.dedent("""\
-            ERROR: Unable to determine root of repository. See
-                https://bazel.build/external/overview#repository
-            """))
+        sys.stderr.write(
+            "ERROR: Unable to determine root of repository. See\n"
+            "    https://bazel.build/external/overview#repository\n")
         sys.exit(1)
 
     @staticmethod
@@ -240,11 +298,11 @@ class BazelWrapper(KleafHelpPrinter):
             "--stdout_stderr_regex_allowlist",
             metavar="PATH",
             type=_require_absolute_path,
-            help=textwrap.dedent("""\
+            help="""\
                 If set, enforces that stdout / stderr only contains lines
                 allowed by the list of regular expressions in the file.
                 Lines prefixed with # are ignored."""
-            ))
+            )
         group.add_argument(
             "-h", "--help", action="store_true",
             help="show this help message and exit"
@@ -296,10 +354,10 @@ class BazelWrapper(KleafHelpPrinter):
         group.add_argument(
             "--experimental_strip_sandbox_path",
             action="store_true",
-            help=textwrap.dedent("""\
+            help="""\
                 Deprecated; use --strip_execroot.
                 Strip sandbox path from output.
-                """))
+                """)
         group.add_argument(
             "--strip_execroot", action="store_true",
             help="Strip execroot from output.")
@@ -314,9 +372,19 @@ class BazelWrapper(KleafHelpPrinter):
             type=_require_absolute_path,
             default=absolute_cache_dir,
             help="Cache directory for --config=local.")
+        group.add_argument(
+            "--cache_dir_max_size", metavar="SIZE",
+            type=_parse_size,
+            help="""\
+                If set, remove least recently used entries in --cache_dir
+                in the background until it is at most this size, e.g. 100G.
+                Entries for targets and defconfig fragments that no longer
+                exist are removed as well.
+                See build/kernel/kleaf/docs/sandbox.md.
+                """)
         group.add_argument(
             "--repo_manifest", metavar="<repo_root>:<manifest.xml>",
-            help=textwrap.dedent("""\
+            help="""\
                 One of the following:
                 - <REPO_MANIFEST>, an absolute path to the repo manifest file,
                     generated with `repo manifest -r`. In this case REPO_ROOT is
@@ -332,14 +400,14 @@ class BazelWrapper(KleafHelpPrinter):
                 This is used to gather the list of Git projects under the
                 workspace to get scmversion. If your workspace is not controlled
                 with `repo`, use --extra_git_project.
-                """),
+                """,
             type=self._check_repo_manifest,
             default=(None, None),
         )
         group.add_argument(
             "--extra_git_project", metavar="PATH",
             dest="extra_git_projects", action="append",
-            help=textwrap.dedent("""\
+            help="""\
                 Multiple uses are accumulated. Specify a Git project besides
                 the ones in `repo` or in --repo_manifest. The value should be
                 the path to the root of the Git project relative to the
@@ -348,7 +416,7 @@ class BazelWrapper(KleafHelpPrinter):
                 This is useful if you have an extra Git project not in the
                 repo manifest, but you need to stamp scmversion on the kernel
                 or kernel modules built from this directory.
-            """),
+            """,
             type=self._check_extra_git_project,
             default=[],
         )
@@ -360,12 +428,12 @@ class BazelWrapper(KleafHelpPrinter):
         )
         group.add_argument(
             "--kleaf_localversion",
-            help=textwrap.dedent("""\
+            help="""\
                 Default is true.
                 Use Kleaf's logic to determine localversion, not
                 scripts/setlocalversion. This removes the unstable patch number
                 from scmversion.
-                """),
+                """,
             action="store_true",
             default=True,
         )
@@ -386,11 +454,11 @@ class BazelWrapper(KleafHelpPrinter):
             dest="hermetic_actions",
             action="store_true",
             default=False,
-            help=textwrap.dedent("""\
+            help="""\
                 For actions that does not explicitly use the hermetic toolchain,
                 only allow them to use a limited list of tools.
                 See build/kernel/kleaf/docs/hermeticity.md.
-            """),
+            """,
         )
         group.add_argument(
             "--noincompatible_hermetic_actions",
@@ -399,6 +467,31 @@ class BazelWrapper(KleafHelpPrinter):
             default=False,
             help="Equivalent to --incompatible_hermetic_actions=false",
         )
+        group.add_argument(
+            "--kleaf_build_metrics",
+            action="store_true",
+            default=False,
+            help="""\
+                Parse the Build Event Protocol while building, and print
+                action counts, cache hit rates, the duration of the critical
+                path and the slowest KernelBuild / KernelModule actions at the
+                end. The Build Event Protocol does not say which actions are
+                on the critical path; use --kleaf_profile for that.
+                See build/kernel/kleaf/docs/debugging.md.
+            """,
+        )
+        group.add_argument(
+            "--kleaf_profile",
+            metavar="PATH",
+            type=pathlib.Path,
+            help="""\
+                Write a JSON trace profile to PATH with --profile. Then print
+                the time spent in KernelConfig, KernelBuild, KernelModule,
+                ABI and dist actions, and write folded stacks for flame
+                graphs next to PATH.
+                See build/kernel/kleaf/docs/debugging.md.
+            """,
+        )
 
     def _check_repo_manifest(self, value: str) \
             -> tuple[pathlib.Path | None, pathlib.Path | None]:
@@ -406,6 +499,7 @@ class BazelWrapper(KleafHelpPrinter):
         match len(tokens):
             case 0: return (None, None)
             case 1:
+                import textwrap
                 sys.stderr.write(textwrap.dedent(f"""\
                     WARNING: --repo_manifest=<path> is deprecated. Use
                         --repo_manifest={self.workspace_dir}:{value}
@@ -479,6 +573,12 @@ class BazelWrapper(KleafHelpPrinter):
         repo_root, repo_manifest = self.known_args.repo_manifest
         self.env["KLEAF_REPO_MANIFEST"] = f"{repo_root or ''}:{repo_manifest or ''}"
 
+        # Sync with kleaf/workspace_status_stamp.py
+        self.workspace_status_cache_dir = \
+            self.absolute_out_dir / "bazel/workspace_status"
+        self.env["KLEAF_WORKSPACE_STATUS_CACHE_DIR"] = str(
+            self.workspace_status_cache_dir)
+
         if self.known_args.extra_git_projects:
             self.env["KLEAF_EXTRA_GIT_PROJECTS"] = ":".join(
                 str(path) for path in self.known_args.extra_git_projects)
@@ -492,6 +592,32 @@ class BazelWrapper(KleafHelpPrinter):
         if self.known_args.user_clang_toolchain is not None:
             self.env["KLEAF_USER_CLANG_TOOLCHAIN_PATH"] = self.known_args.user_clang_toolchain
 
+        self.build_event_consumer = None
+        if self.known_args.kleaf_build_metrics:
+            if self.command in _BUILD_COMMANDS:
+                from build_metrics import BuildEventConsumer
+                self.build_event_consumer = BuildEventConsumer(
+                    self.absolute_out_dir / "bazel/build_metrics/build_events.json")
+                self.transformed_command_args += \
+                    self.build_event_consumer.bazel_args()
+            else:
+                sys.stderr.write(
+                    f"WARNING: --kleaf_build_metrics is ignored for {self.command}.\n")
+
+        self.profile_path = None
+        if self.known_args.kleaf_profile is not None:
+            if self.command in _BUILD_COMMANDS:
+                self.profile_path = self.known_args.kleaf_profile.absolute()
+                self.transformed_command_args += [
+                    f"--profile={self.profile_path}",
+                    "--generate_json_trace_profile",
+                    # Adds args.target to action events.
+                    "--experimental_profile_include_target_label",
+                ]
+            else:
+                sys.stderr.write(
+                    f"WARNING: --kleaf_profile is ignored for {self.command}.\n")
+
     def _add_extra_startup_options(self):
         """Adds extra startup options after command args are parsed."""
         self._handle_bazelrc()
@@ -509,6 +635,8 @@ class BazelWrapper(KleafHelpPrinter):
 
         self.gen_bazelrc_dir = self.absolute_out_dir / "bazel/bazelrc"
         os.makedirs(self.gen_bazelrc_dir, exist_ok=True)
+        self._bazelrc_cache = _BazelrcCache(
+            self.gen_bazelrc_dir / "bazelrc_cache.json")
 
         self.transformed_startup_options += self._transform_bazelrc_files([
             # Add support for various configs
@@ -525,32 +653,30 @@ class BazelWrapper(KleafHelpPrinter):
             self.kleaf_repo_dir / "build/kernel/kleaf/bazelrc/stamp.bazelrc",
         ])
         stamp_extra_bazelrc = self.gen_bazelrc_dir / "stamp_extra.bazelrc"
-        with open(stamp_extra_bazelrc, "w") as f:
-            workspace_status_common_sh = self._kleaf_repo_rel() / \
-                "build/kernel/kleaf/workspace_status_common.sh"
-            workspace_status_sh = self._kleaf_repo_rel() / \
-                "build/kernel/kleaf/workspace_status.sh"
-            f.write(textwrap.dedent(f"""\
-                # By default, do not embed scmversion.
-                build --workspace_status_command={shlex.quote(str(workspace_status_common_sh))}
-                # With --config=stamp, embed scmversion.
-                build:stamp --workspace_status_command={shlex.quote(str(workspace_status_sh))}
-            """))
+        workspace_status_common_sh = self._kleaf_repo_rel() / \
+            "build/kernel/kleaf/workspace_status_common.sh"
+        workspace_status_sh = self._kleaf_repo_rel() / \
+            "build/kernel/kleaf/workspace_status.sh"
+        self._write_bazelrc_file(stamp_extra_bazelrc, (
+            "# By default, do not embed scmversion.\n"
+            f"build --workspace_status_command={shlex.quote(str(workspace_status_common_sh))}\n"
+            "# With --config=stamp, embed scmversion.\n"
+            f"build:stamp --workspace_status_command={shlex.quote(str(workspace_status_sh))}\n"
+        ))
         self.transformed_startup_options += self._transform_bazelrc_files([
             stamp_extra_bazelrc,
         ])
 
         self.transformed_startup_options += self._transform_bazelrc_files([
             self.kleaf_repo_dir / "build/kernel/kleaf/bazelrc/release.bazelrc",
-            self.kleaf_repo_dir / FLAGS_BAZEL_RC,
+            self.kleaf_repo_dir / _FLAGS_BAZEL_RC,
         ])
 
         cache_dir_bazelrc = self.gen_bazelrc_dir / "cache_dir.bazelrc"
-        with open(cache_dir_bazelrc, "w") as f:
-            # The label //build/... will be re-written by _transform_bazelrc_files.
-            f.write(textwrap.dedent(f"""\
-                build --//build/kernel/kleaf:cache_dir={shlex.quote(str(self.known_args.cache_dir))}
-            """))
+        # The label //build/... will be re-written by _transform_bazelrc_files.
+        self._write_bazelrc_file(
+            cache_dir_bazelrc,
+            f"build --//build/kernel/kleaf:cache_dir={shlex.quote(str(self.known_args.cache_dir))}\n")
 
         self.transformed_startup_options += self._transform_bazelrc_files([
             cache_dir_bazelrc,
@@ -559,9 +685,8 @@ class BazelWrapper(KleafHelpPrinter):
         if self.known_args.hermetic_actions:
             hermetic_actions_bazelrc = (
                 self.gen_bazelrc_dir / "hermetic_actions.bazelrc")
-            hermetic_actions_bazelrc.write_text(textwrap.dedent("""\
-                build --action_env=PATH
-            """))
+            self._write_bazelrc_file(hermetic_actions_bazelrc,
+                                     "build --action_env=PATH\n")
             self.transformed_startup_options += self._transform_bazelrc_files([
                 hermetic_actions_bazelrc,
             ])
@@ -581,6 +706,8 @@ class BazelWrapper(KleafHelpPrinter):
             self.kleaf_repo_dir / "build/kernel/kleaf/common.bazelrc",
         ])
 
+        self._bazelrc_cache.save()
+
     def _build_final_args(self) -> list[str]:
         """Builds the final arguments for the subprocess."""
         # final_args:
@@ -596,14 +723,71 @@ class BazelWrapper(KleafHelpPrinter):
         final_args += self.target_patterns
 
         if self.command == "clean":
-            sys.stderr.write(
-                f"INFO: Removing cache directory for $OUT_DIR: {self.known_args.cache_dir}\n")
-            shutil.rmtree(self.known_args.cache_dir, ignore_errors=True)
+            self._clean_cache_dir()
         else:
             os.makedirs(self.known_args.cache_dir, exist_ok=True)
+            if self.known_args.cache_dir_max_size is not None:
+                self._start_cache_dir_gc()
 
         return final_args
 
+    def _clean_cache_dir(self):
+        """Empties --cache_dir without waiting for files to be deleted.
+
+        Entries are atomically moved to a trash directory, then deleted by a
+        detached process while Bazel cleans.
+        """
+        from cache_dir_manager import move_all_to_trash
+        sys.stderr.write(
+            f"INFO: Removing cache directory for $OUT_DIR: {self.known_args.cache_dir}\n")
+        if not move_all_to_trash(self.known_args.cache_dir):
+            return
+        self._start_cache_dir_manager(["empty_trash"])
+
+    def _start_cache_dir_gc(self):
+        """Collects garbage in --cache_dir in a detached process.
+
+        The process waits for this process to exit, so entries are not
+        removed while Bazel is using them. This works with os.execve too
+        because the Bazel client keeps the process ID.
+        """
+        from cache_dir_manager import should_collect_garbage
+        if not should_collect_garbage(self.known_args.cache_dir):
+            return
+        log_path = self._start_cache_dir_manager([
+            "gc",
+            f"--max_size={self.known_args.cache_dir_max_size}",
+            f"--wait_pid={os.getpid()}",
+        ])
+        sys.stderr.write(
+            f"INFO: Cleaning up {self.known_args.cache_dir} in the "
+            f"background after this command. See {log_path}\n")
+
+    def _start_cache_dir_manager(self, args: list[str]) -> pathlib.Path:
+        """Runs cache_dir_manager.py in a detached process.
+
+        Returns:
+            path to the log file of the process.
+        """
+        import subprocess
+        log_path = self.absolute_out_dir / "bazel/cache_dir_manager.log"
+        log_path.parent.mkdir(parents=True, exist_ok=True)
+        with open(log_path, "w") as log_file:
+            subprocess.Popen(
+                [
+                    sys.executable,
+                    pathlib.Path(__file__).resolve().with_name(
+                        "cache_dir_manager.py"),
+                    f"--cache_dir={self.known_args.cache_dir}",
+                    f"--workspace={self.workspace_dir}",
+                ] + args,
+                stdin=subprocess.DEVNULL,
+                stdout=log_file,
+                stderr=subprocess.STDOUT,
+                start_new_session=True,
+            )
+        return log_path
+
     def _transform_bazelrc_files(self, bazelrc_files: list[pathlib.Path]) -> list[str]:
         """Given a list of bazelrc files, return startup options."""
         startup_options = []
@@ -612,11 +796,22 @@ class BazelWrapper(KleafHelpPrinter):
             startup_options.append(f"--bazelrc={new_path}")
         return startup_options
 
+    def _write_bazelrc_file(self, path: pathlib.Path, content: str):
+        """Writes content to the generated bazelrc file if it has changed."""
+        if self._bazelrc_cache.is_fresh("generated", path, content):
+            return
+        path.write_text(content)
+        self._bazelrc_cache.update("generated", path, content)
+
     def _rewrite_bazelrc_file(self, old_path: pathlib.Path) -> pathlib.Path:
         """Given a bazelrc file, rewrite and return the path."""
         if self._kleaf_repository_is_top_workspace():
             # common case; Kleaf tooling is in main Bazel workspace
             return old_path
+
+        import hashlib
+
+        new_path = self.gen_bazelrc_dir / old_path.name
         with open(old_path) as old_file:
             content = old_file.read()
 
@@ -624,10 +819,14 @@ class BazelWrapper(KleafHelpPrinter):
         content = content.replace(
             "//build", f"{self._kleaf_repo_name()}//build")
 
-        new_path = self.gen_bazelrc_dir / old_path.name
+        key = hashlib.sha1(content.encode()).hexdigest()
+        if self._bazelrc_cache.is_fresh("rewritten", new_path, key):
+            return new_path
+
         os.makedirs(new_path.parent, exist_ok=True)
         with open(new_path, "w") as new_file:
             new_file.write(content)
+        self._bazelrc_cache.update("rewritten", new_path, key)
         return new_path
 
     def _kleaf_repository_is_top_workspace(self):
@@ -662,8 +861,9 @@ class BazelWrapper(KleafHelpPrinter):
             self.transformed_command_args[0] == "kleaf"
 
         if show_kleaf_help_menu:
+            from kleaf_help import KleafHelpPrinter
             print("Kleaf help menu:")
-            self.print_kleaf_help(self.kleaf_repo_dir)
+            KleafHelpPrinter(self).print_kleaf_help(self.kleaf_repo_dir)
         else:
             print("Kleaf help menu:")
             print("  $ bazel help kleaf")
@@ -713,16 +913,92 @@ class BazelWrapper(KleafHelpPrinter):
     def _add_default_hermetic_path(self):
         self.gen_default_hermetic_path_dir = (
             self.absolute_out_dir / "bazel/default_hermetic_path")
+        self.gen_default_hermetic_path_manifest = (
+            self.absolute_out_dir / "bazel/default_hermetic_path.json")
         if not self.known_args.hermetic_actions:
             return
-        self.gen_default_hermetic_path_dir.mkdir(parents=True, exist_ok=True)
+        from impl.default_host_tools import DEFAULT_HOST_TOOLS
 
         host_tools = DEFAULT_HOST_TOOLS + _ACTION_EXTRA_HOST_TOOLS
+        key = self._get_default_hermetic_path_key(host_tools)
+
+        old_manifest = {}
+        if self.gen_default_hermetic_path_dir.is_dir():
+            try:
+                with open(self.gen_default_hermetic_path_manifest) as file:
+                    old_manifest = json.load(file)
+            except (OSError, json.JSONDecodeError):
+                pass
+
+        is_complete = self._is_default_hermetic_path_complete(host_tools)
+        if old_manifest.get("key") != key or not is_complete:
+            import shutil
+            resolved_host_tools = {tool: shutil.which(tool)
+                                   for tool in host_tools}
+            old_hermetic_tools = old_manifest.get("key", {}).get("hermetic_tools")
+            if not is_complete or \
+                    old_manifest.get("host_tools") != resolved_host_tools or \
+                    old_hermetic_tools != key["hermetic_tools"]:
+                self._create_default_hermetic_path(resolved_host_tools)
+            tmp_manifest = self.gen_default_hermetic_path_manifest.with_suffix(
+                ".json.tmp")
+            with open(tmp_manifest, "w") as file:
+                json.dump({"key": key, "host_tools": resolved_host_tools},
+                          file, indent=2, sort_keys=True)
+            os.replace(tmp_manifest, self.gen_default_hermetic_path_manifest)
+
+        # TODO(b/228105413): Drop provided $PATH after allow list is settled.
+        self.env["PATH"] = str(self.gen_default_hermetic_path_dir)
+
+    def _get_default_hermetic_path_key(self, host_tools: list[str]) -> dict:
+        """Returns the inputs that determine the resolved host tools.
+
+        If the key is unchanged, host tools are not looked up again. The
+        modification time of each directory in $PATH is part of the key so
+        installing or removing a tool is noticed.
+        """
+        path_dirs = []
+        for path_dir in os.environ.get("PATH", os.defpath).split(os.pathsep):
+            try:
+                mtime = os.stat(path_dir).st_mtime_ns
+            except OSError:
+                mtime = None
+            path_dirs.append([path_dir, mtime])
+        return {
+            "path": path_dirs,
+            "host_tools": host_tools,
+            "hermetic_tools": [str(self.kleaf_repo_dir / tool)
+                               for tool in _ACTION_HERMETIC_TOOLS],
+        }
+
+    def _is_default_hermetic_path_complete(self, host_tools: list[str]) -> bool:
+        """Returns whether every tool has an entry in the default hermetic $PATH.
+
+        This notices entries deleted by hand. Only the directory is listed;
+        the entries are not followed.
+        """
+        try:
+            entries = set(os.listdir(self.gen_default_hermetic_path_dir))
+        except OSError:
+            return False
+        return entries.issuperset(host_tools) and entries.issuperset(
+            pathlib.Path(tool).name for tool in _ACTION_HERMETIC_TOOLS)
+
+    def _create_default_hermetic_path(
+            self, resolved_host_tools: dict[str, str | None]):
+        """Populates the directory for the default hermetic $PATH.
+
+        Args:
+            resolved_host_tools: a dictionary from names of host tools to
+                their paths on host, or None if they are not found.
+        """
+        import textwrap
+        self.gen_default_hermetic_path_dir.mkdir(parents=True, exist_ok=True)
+
         all_tools = set()
-        for tool in host_tools:
+        for tool, src_path in resolved_host_tools.items():
             dst_path = self.gen_default_hermetic_path_dir / tool
             all_tools.add(dst_path)
-            src_path = shutil.which(tool)
             if src_path:
                 src_path = pathlib.Path(src_path)
                 if dst_path.is_symlink():
@@ -745,18 +1021,17 @@ class BazelWrapper(KleafHelpPrinter):
             tool = pathlib.Path(tool)
             dst_path = self.gen_default_hermetic_path_dir / tool.name
             all_tools.add(dst_path)
-            if dst_path.exists():
-                continue
             src_path = self.kleaf_repo_dir / tool
+            if dst_path.is_symlink():
+                if dst_path.readlink() == src_path:
+                    continue
+                dst_path.unlink()
             dst_path.symlink_to(src_path)
 
         for file in self.gen_default_hermetic_path_dir.iterdir():
             if file not in all_tools:
                 file.unlink()
 
-        # TODO(b/228105413): Drop provided $PATH after allow list is settled.
-        self.env["PATH"] = str(self.gen_default_hermetic_path_dir)
-
     def run(self) -> int:
         """Runs the wrapper.
 
@@ -777,6 +1052,14 @@ class BazelWrapper(KleafHelpPrinter):
                 self.known_startup_options.stdout_stderr_regex_allowlist,
         )
 
+        if self.build_event_consumer:
+            self.build_event_consumer.prepare()
+
+        if self.profile_path is not None:
+            # Do not summarize the profile of an earlier build if Bazel
+            # fails before writing it.
+            self.profile_path.unlink(missing_ok=True)
+
         import asyncio
         try:
             asyncio.run(run(
@@ -784,6 +1067,7 @@ class BazelWrapper(KleafHelpPrinter):
                 env=self.env,
                 output_mutator=output_mutator,
                 epilog_coroutine=self._get_epilog_coroutine(),
+                build_event_consumer=self.build_event_consumer,
             ))
         except BazelWrapperException as exception:
             if exception.message:
@@ -798,6 +1082,8 @@ class BazelWrapper(KleafHelpPrinter):
         return any([
             self.known_args.strip_execroot,
             self.command == "clean",
+            self.build_event_consumer is not None,
+            self.profile_path is not None,
             (self.known_startup_options.stdout_stderr_regex_allowlist
                 is not None),
         ])
@@ -811,25 +1097,56 @@ class BazelWrapper(KleafHelpPrinter):
         else:
             prefix = str(self.absolute_user_root)
 
-        return re.compile(prefix + r"/\S+?/execroot/__main__/")
+        return re.compile(prefix.encode() + rb"/\S+?/execroot/__main__/")
 
     def _get_epilog_coroutine(self):
         """Returns epilog coroutine after bazel command finishes"""
-        if self.command != "clean":
+        if self.command != "clean" and self.profile_path is None:
             return None
-        return self.remove_gen_dirs()
+        return self._epilog()
+
+    async def _epilog(self):
+        if self.command == "clean":
+            await self.remove_gen_dirs()
+        if self.profile_path is not None:
+            await self.summarize_profile()
+
+    async def summarize_profile(self):
+        if not self.profile_path.is_file():
+            sys.stderr.write(
+                f"WARNING: Profile {self.profile_path} is not found.\n")
+            return
+        import asyncio
+        from build_profile import summarize
+        try:
+            await asyncio.to_thread(summarize, self.profile_path)
+        except (OSError, ValueError, EOFError) as exception:
+            # e.g. the profile is truncated because Bazel is interrupted.
+            sys.stderr.write(
+                f"WARNING: Unable to summarize profile {self.profile_path}: "
+                f"{exception}\n")
 
     async def remove_gen_dirs(self):
+        import asyncio
+        import shutil
         sys.stderr.write("INFO: Deleting generated directories.\n")
-        shutil.rmtree(self.gen_bazelrc_dir, ignore_errors=True)
-        shutil.rmtree(self.gen_default_hermetic_path_dir, ignore_errors=True)
+        await asyncio.gather(
+            asyncio.to_thread(shutil.rmtree, self.gen_bazelrc_dir,
+                              ignore_errors=True),
+            asyncio.to_thread(shutil.rmtree,
+                              self.gen_default_hermetic_path_dir,
+                              ignore_errors=True),
+            asyncio.to_thread(shutil.rmtree, self.workspace_status_cache_dir,
+                              ignore_errors=True),
+        )
+        self.gen_default_hermetic_path_manifest.unlink(missing_ok=True)
 
 
 class OutputMutator:
     """Helper class to filter and mutate an output stream."""
     def __init__(
             self,
-            filter_regex: re.Pattern | None,
+            filter_regex: re.Pattern[bytes] | None,
             regex_allowlist_path: pathlib.Path | None,
         ):
         self._regex_allowlist_path = regex_allowlist_path
@@ -839,9 +1156,11 @@ class OutputMutator:
         if regex_allowlist_path:
             with open(regex_allowlist_path, encoding="utf-8") as file:
                 self._regex_allowlist = list(self._parse_regex_lines(file))
+        self._regex_allowlist_match = self._combine_regexes(
+            self._regex_allowlist)
 
     def _parse_regex_lines(self, lines) -> \
-            Generator[re.Pattern, None, None]:
+            collections.abc.Generator[re.Pattern, None, None]:
         """Parses lines from stdout_stderr_regex_allowlist file."""
         for line in lines:
             line = line.strip()
@@ -851,14 +1170,42 @@ class OutputMutator:
                 continue
             yield re.compile(line)
 
+    @staticmethod
+    def _combine_regexes(regexes: list[re.Pattern]) \
+            -> collections.abc.Callable[[str], bool] | None:
+        """Returns a function that checks if a line matches any of regexes.
+
+        If possible, regexes are combined into a single alternation so each
+        line is matched once. Patterns that cannot be combined safely (e.g.
+        numbered back references, or global flags not at the start) fall back
+        to matching each regex in turn.
+        """
+        if not regexes:
+            return None
+        if not any(regex.groups and re.search(r"\\\d", regex.pattern)
+                   for regex in regexes):
+            try:
+                combined = re.compile("|".join(
+                    f"(?:{regex.pattern})" for regex in regexes))
+                return lambda line: combined.match(line) is not None
+            except re.error:
+                pass
+        return lambda line: any(regex.match(line) for regex in regexes)
+
     async def mutate_stream(
         self,
-        input_stream: BinaryIO,
-        output_stream: BinaryIO,
+        input_stream,
+        output_stream: io.TextIOWrapper,
         stream_name: str,
     ):
         """Pipes input to output, optionally mutating lines.
 
+        input_stream is an asyncio.StreamReader.
+
+        Output is read in chunks, but only complete lines are written, so
+        lines of stdout and stderr are not interleaved. An incomplete line at
+        the end of a chunk is carried over to the next chunk.
+
         If filter_regex is None, don't filter lines.
 
         If regex_allowlist is not empty, require each line to be matching at
@@ -866,25 +1213,30 @@ class OutputMutator:
         """
         unexpected_line_count = 0
         first_unexpected_line = None
+        should_mutate = self._filter_regex or self._regex_allowlist_match
+        pending = bytearray()
 
         while not input_stream.at_eof():
-            output = await input_stream.readline()
-            if self._filter_regex or self._regex_allowlist:
-                output_decoded = output.decode()
-                if self._filter_regex:
-                    output_decoded = re.sub(
-                        self._filter_regex, "", output_decoded)
-                if self._regex_allowlist:
-                    if not any(regex.match(output_decoded)
-                               for regex in self._regex_allowlist):
-                        unexpected_line_count += 1
-                        if first_unexpected_line is None:
-                            first_unexpected_line = output_decoded
-                output = output_decoded.encode()
+            pending += await input_stream.read(_OUTPUT_CHUNK_SIZE)
+            if input_stream.at_eof():
+                end = len(pending)
+            else:
+                end = pending.rfind(b"\n") + 1
+            if not end:
+                continue
+            output = bytes(pending[:end])
+            del pending[:end]
+
+            if should_mutate:
+                output, count, first_line = self._mutate_lines(output)
+                unexpected_line_count += count
+                if first_unexpected_line is None:
+                    first_unexpected_line = first_line
             output_stream.buffer.write(output)
             output_stream.flush()
 
         if unexpected_line_count:
+            import textwrap
             raise UnexpectedOutputLinesException(textwrap.dedent(f"""\
                 ERROR: Found {unexpected_line_count} unexpected lines \
 in {stream_name}, the first one is:
@@ -893,6 +1245,32 @@ in {stream_name}, the first one is:
 allowlist:
                     {self._regex_allowlist_path}"""))
 
+    def _mutate_lines(self, output: bytes) -> tuple[bytes, int, str | None]:
+        """Mutates and checks a chunk of complete lines.
+
+        Returns:
+            A tuple of (the mutated output, the number of unexpected lines,
+            the first unexpected line or None).
+        """
+        if self._filter_regex:
+            output = self._filter_regex.sub(b"", output)
+        if not self._regex_allowlist_match:
+            return output, 0, None
+
+        unexpected_line_count = 0
+        first_unexpected_line = None
+        output_decoded = output.decode()
+        start = 0
+        while start < len(output_decoded):
+            end = output_decoded.find("\n", start) + 1 or len(output_decoded)
+            line = output_decoded[start:end]
+            start = end
+            if not self._regex_allowlist_match(line):
+                unexpected_line_count += 1
+                if first_unexpected_line is None:
+                    first_unexpected_line = line
+        return output, unexpected_line_count, first_unexpected_line
+
 
 async def _wait_for_subprocess(process):
     """Wraps process.wait() and raises if exit code is non-zero."""
@@ -901,11 +1279,15 @@ async def _wait_for_subprocess(process):
         raise BazelSubprocessException(code=return_code)
 
 
-async def run(command, env, epilog_coroutine, output_mutator):
+async def run(command, env, epilog_coroutine, output_mutator,
+              build_event_consumer=None):
     """Runs command with env asynchronously.
 
     Outputs are mutated with output_mutator.
 
+    If build_event_consumer is not None, it parses the Build Event Protocol
+    concurrently, and prints a summary after the process finishes.
+
     At the end, run the coroutine epilog_coroutine if it is not None.
     """
     import asyncio
@@ -931,10 +1313,15 @@ async def run(command, env, epilog_coroutine, output_mutator):
         stdout_coroutine,
         _wait_for_subprocess(process),
     ]
+    if build_event_consumer:
+        coroutines.append(build_event_consumer.consume(process))
     tasks = [asyncio.Task(coroutine) for coroutine in coroutines]
     done, _ = await asyncio.wait(tasks, return_when=asyncio.ALL_COMPLETED)
     exceptions = [task.exception() for task in done if task.exception()]
 
+    if build_event_consumer:
+        build_event_consumer.print_summary()
+
     # epilog_coroutine needs to run after process finishes, so it cannot
     # be in the coroutines list.
     if epilog_coroutine:
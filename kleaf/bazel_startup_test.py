@@ -0,0 +1,126 @@
+# Copyright (C) 2024 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Checks the startup time of the Bazel wrapper.
+
+The wrapper runs before every Bazel command, so modules that are only needed
+by uncommon code paths should be imported lazily. The wrapper is run through
+_bazel_wrapper_main with a stub Bazel binary that exits immediately.
+"""
+
+import os
+import pathlib
+import re
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+from absl.testing import absltest
+
+_BAZEL_PY_DIR = pathlib.Path(__file__).resolve().parent
+
+# Budget for running the wrapper with a no-op command, in seconds, including
+# the startup of the interpreter. This is generous to tolerate slow machines;
+# it is meant to catch heavy modules being imported unconditionally again.
+_RUN_TIME_BUDGET_S = 0.5
+
+# Take the fastest of a few runs to reduce noise.
+_RUNS = 5
+
+# Modules that must not be imported when running a no-op command.
+_LAZY_MODULES = (
+    "kleaf_help",
+    "textwrap",
+)
+
+# Runs the wrapper as if bazel.py were in the Kleaf repository at argv[1].
+_RUN_WRAPPER = """
+import sys
+import bazel
+bazel.__file__ = sys.argv[1] + "/build/kernel/kleaf/bazel.py"
+sys.argv = ["bazel.py"] + sys.argv[2:]
+sys.exit(bazel._bazel_wrapper_main())
+"""
+
+# Format: "import time: <self us> | <cumulative us> | <indent><module>"
+_IMPORT_TIME_PATTERN = re.compile(
+    r"^import time:\s*(?P<self>\d+)\s*\|\s*(?P<cumulative>\d+)\s*\|\s*(?P<module>\S+)$")
+
+
+def _create_workspace(workspace: pathlib.Path):
+    """Creates a workspace with a stub Bazel binary that exits immediately."""
+    (workspace / "MODULE.bazel").touch()
+    stub_bazel = workspace / "prebuilts/kernel-build-tools/bazel/linux-x86_64/bazel"
+    stub_bazel.parent.mkdir(parents=True)
+    stub_bazel.write_text("#!/bin/sh\nexit 0\n")
+    stub_bazel.chmod(0o755)
+
+
+def _run_wrapper(workspace: pathlib.Path, *args: str) -> tuple[float, set[str]]:
+    """Runs the wrapper in a fresh interpreter.
+
+    Returns:
+        A tuple of the wall time of the run in seconds, and the names of
+        modules imported by the wrapper.
+    """
+    start = time.perf_counter()
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", _RUN_WRAPPER, str(workspace),
+         *args],
+        cwd=workspace,
+        env=dict(os.environ, PYTHONPATH=str(_BAZEL_PY_DIR)),
+        stderr=subprocess.PIPE,
+        text=True,
+        check=True,
+    )
+    elapsed = time.perf_counter() - start
+    modules = set()
+    for line in proc.stderr.splitlines():
+        mo = _IMPORT_TIME_PATTERN.match(line)
+        if mo:
+            modules.add(mo.group("module"))
+    return elapsed, modules
+
+
+class BazelStartupTest(unittest.TestCase):
+    def setUp(self):
+        self.workspace = pathlib.Path(
+            self.enterContext(tempfile.TemporaryDirectory()))
+        _create_workspace(self.workspace)
+        # The first run may need to compile bytecode; discard it.
+        _run_wrapper(self.workspace, "version")
+        self.results = [_run_wrapper(self.workspace, "version")
+                        for _ in range(_RUNS)]
+
+    def test_lazy_modules(self):
+        _, modules = self.results[0]
+        self.assertIn("bazel", modules)
+        for module in _LAZY_MODULES:
+            with self.subTest(module=module):
+                self.assertNotIn(module, modules)
+
+    def test_run_time_budget(self):
+        run_time = min(elapsed for elapsed, _ in self.results)
+        self.assertLessEqual(
+            run_time, _RUN_TIME_BUDGET_S,
+            f"Running `bazel version` with a stub Bazel takes {run_time:.3f}s, "
+            f"exceeding the budget of {_RUN_TIME_BUDGET_S}s. Run\n"
+            f"  python3 -X importtime {_BAZEL_PY_DIR / 'bazel.py'} version\n"
+            "to find out which modules are slow to import.")
+
+
+if __name__ == "__main__":
+    absltest.main()
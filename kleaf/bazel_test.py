@@ -0,0 +1,321 @@
+# Copyright (C) 2024 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for the Bazel wrapper."""
+
+import argparse
+import asyncio
+import gzip
+import io
+import json
+import os
+import pathlib
+import re
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from absl.testing import absltest
+import bazel
+
+_OUT_DIR = "/home/user/kernel/out"
+
+_OUTPUT = (
+    f"INFO: From KernelBuild {_OUT_DIR}/bazel/output_user_root/0123/"
+    "execroot/__main__/common/kernel_aarch64:\n"
+    f"  CC [M]  {_OUT_DIR}/bazel/output_user_root/0123/"
+    "execroot/__main__/common/drivers/foo/bar.o\n"
+    "  LD [M]  drivers/foo/bar.ko\n"
+    "\n"
+    "WARNING: unexpected\n"
+    "[1,234 / 5,678] 8 actions running\n"
+    "Another unexpected line\n"
+    "[1,235 / 5,678] no newline at the end"
+).encode()
+
+_FILTER_PATTERN = re.escape(_OUT_DIR) + r"/\S+?/execroot/__main__/"
+
+_ALLOWLIST = """\
+# Comments and empty lines are ignored.
+
+INFO: From .*
+\\s+(CC|LD)( \\[M\\])?\\s+.*
+\\[[\\d,]+ / [\\d,]+\\] .*
+$
+"""
+
+
+def _mutate_by_line(data: bytes, filter_pattern: str | None,
+                    allowlist: list[str]) -> tuple[bytes, int, str | None]:
+    """Mutates output one line at a time, as OutputMutator used to.
+
+    Returns:
+        A tuple of (the mutated output, the number of unexpected lines,
+        the first unexpected line or None).
+    """
+    output = b""
+    unexpected_line_count = 0
+    first_unexpected_line = None
+    regexes = [re.compile(pattern) for pattern in allowlist]
+    for line in io.BytesIO(data).readlines():
+        line_decoded = line.decode()
+        if filter_pattern:
+            line_decoded = re.sub(filter_pattern, "", line_decoded)
+        if regexes and not any(regex.match(line_decoded) for regex in regexes):
+            unexpected_line_count += 1
+            if first_unexpected_line is None:
+                first_unexpected_line = line_decoded
+        output += line_decoded.encode()
+    return output, unexpected_line_count, first_unexpected_line
+
+
+class _RecordingOutput:
+    """A text stream that records writes to its buffer."""
+
+    def __init__(self):
+        self.buffer = self
+        self.writes: list[bytes] = []
+
+    def write(self, data: bytes):
+        self.writes.append(data)
+
+    def flush(self):
+        pass
+
+
+async def _mutate(output_mutator: bazel.OutputMutator, data: bytes,
+                  read_size: int, output: _RecordingOutput):
+    stream = asyncio.StreamReader()
+
+    async def feed():
+        for start in range(0, len(data), read_size):
+            stream.feed_data(data[start:start + read_size])
+            # Let mutate_stream read each chunk as it arrives.
+            await asyncio.sleep(0)
+        stream.feed_eof()
+
+    await asyncio.gather(feed(), output_mutator.mutate_stream(
+        input_stream=stream,
+        output_stream=output,
+        stream_name="stdout",
+    ))
+
+
+def _new_wrapper(**attrs) -> bazel.BazelWrapper:
+    """Returns a BazelWrapper with only the given attributes set."""
+    wrapper = bazel.BazelWrapper.__new__(bazel.BazelWrapper)
+    vars(wrapper).update(attrs)
+    return wrapper
+
+
+class BazelrcCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = pathlib.Path(
+            self.enterContext(tempfile.TemporaryDirectory()))
+        self.gen_bazelrc_dir = self.temp_dir / "out/bazel/bazelrc"
+        self.gen_bazelrc_dir.mkdir(parents=True)
+        self.cache_path = self.gen_bazelrc_dir / "bazelrc_cache.json"
+
+    def _new_wrapper(self) -> bazel.BazelWrapper:
+        # Like a new invocation, the cache is loaded again.
+        return _new_wrapper(
+            workspace_dir=self.temp_dir,
+            kleaf_repo_dir=self.temp_dir / "external/kleaf",
+            gen_bazelrc_dir=self.gen_bazelrc_dir,
+            _bazelrc_cache=bazel._BazelrcCache(self.cache_path),
+        )
+
+    def test_write_bazelrc_file(self):
+        path = self.gen_bazelrc_dir / "stamp_extra.bazelrc"
+        wrapper = self._new_wrapper()
+        wrapper._write_bazelrc_file(path, "build --config=a\n")
+        wrapper._bazelrc_cache.save()
+        self.assertEqual(path.read_text(), "build --config=a\n")
+
+        # Same content, so the file is not written again.
+        path.write_text("modified\n")
+        wrapper = self._new_wrapper()
+        wrapper._write_bazelrc_file(path, "build --config=a\n")
+        self.assertEqual(path.read_text(), "modified\n")
+
+        wrapper._write_bazelrc_file(path, "build --config=b\n")
+        self.assertEqual(path.read_text(), "build --config=b\n")
+
+    def test_write_bazelrc_file_deleted(self):
+        path = self.gen_bazelrc_dir / "stamp_extra.bazelrc"
+        wrapper = self._new_wrapper()
+        wrapper._write_bazelrc_file(path, "build --config=a\n")
+        wrapper._bazelrc_cache.save()
+
+        path.unlink()
+        self._new_wrapper()._write_bazelrc_file(path, "build --config=a\n")
+        self.assertEqual(path.read_text(), "build --config=a\n")
+
+    def test_rewrite_bazelrc_file(self):
+        old_path = self.temp_dir / "external/kleaf/build/kernel/kleaf/bazelrc/x.bazelrc"
+        old_path.parent.mkdir(parents=True)
+        old_path.write_text("build --//build/kernel/kleaf:a\n")
+        os.utime(old_path, ns=(1_000_000_000, 1_000_000_000))
+
+        wrapper = self._new_wrapper()
+        new_path = wrapper._rewrite_bazelrc_file(old_path)
+        wrapper._bazelrc_cache.save()
+        self.assertEqual(new_path, self.gen_bazelrc_dir / "x.bazelrc")
+        self.assertEqual(new_path.read_text(),
+                         "build --@kleaf//build/kernel/kleaf:a\n")
+
+        # Same content, so the file is not written again.
+        new_path.write_text("modified\n")
+        wrapper = self._new_wrapper()
+        wrapper._rewrite_bazelrc_file(old_path)
+        wrapper._bazelrc_cache.save()
+        self.assertEqual(new_path.read_text(), "modified\n")
+
+        # An edit that keeps the size and mtime is still noticed.
+        old_path.write_text("build --//build/kernel/kleaf:b\n")
+        os.utime(old_path, ns=(1_000_000_000, 1_000_000_000))
+        self._new_wrapper()._rewrite_bazelrc_file(old_path)
+        self.assertEqual(new_path.read_text(),
+                         "build --@kleaf//build/kernel/kleaf:b\n")
+
+
+class DefaultHermeticPathTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = pathlib.Path(
+            self.enterContext(tempfile.TemporaryDirectory()))
+        self.hermetic_path_dir = self.temp_dir / "out/bazel/default_hermetic_path"
+
+    def _add_default_hermetic_path(self) -> int:
+        """Runs _add_default_hermetic_path like a new invocation.
+
+        Returns:
+            the number of host tools looked up.
+        """
+        wrapper = _new_wrapper(
+            absolute_out_dir=self.temp_dir / "out",
+            kleaf_repo_dir=self.temp_dir,
+            known_args=argparse.Namespace(hermetic_actions=True),
+            env={},
+        )
+        with mock.patch.object(shutil, "which", wraps=shutil.which) as which:
+            wrapper._add_default_hermetic_path()
+        self.assertEqual(wrapper.env["PATH"], str(self.hermetic_path_dir))
+        return which.call_count
+
+    def test_cached(self):
+        self.assertGreater(self._add_default_hermetic_path(), 0)
+        entries = sorted(os.listdir(self.hermetic_path_dir))
+        self.assertIn("python3", entries)
+
+        self.assertEqual(self._add_default_hermetic_path(), 0)
+        self.assertEqual(sorted(os.listdir(self.hermetic_path_dir)), entries)
+
+    def test_restores_deleted_entries(self):
+        self._add_default_hermetic_path()
+        entries = sorted(os.listdir(self.hermetic_path_dir))
+        (self.hermetic_path_dir / "python3").unlink()
+
+        self.assertGreater(self._add_default_hermetic_path(), 0)
+        self.assertEqual(sorted(os.listdir(self.hermetic_path_dir)), entries)
+
+    def test_deleted_directory(self):
+        self._add_default_hermetic_path()
+        shutil.rmtree(self.hermetic_path_dir)
+
+        self.assertGreater(self._add_default_hermetic_path(), 0)
+        self.assertTrue((self.hermetic_path_dir / "python3").is_symlink())
+
+
+class SummarizeProfileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = pathlib.Path(
+            self.enterContext(tempfile.TemporaryDirectory()))
+
+    def _summarize_profile(self, content: bytes) -> str:
+        profile_path = self.temp_dir / "profile.json.gz"
+        profile_path.write_bytes(content)
+        wrapper = _new_wrapper(profile_path=profile_path)
+        with mock.patch("sys.stderr", new_callable=io.StringIO) as stderr:
+            asyncio.run(wrapper.summarize_profile())
+        return stderr.getvalue()
+
+    def test_summarize(self):
+        content = gzip.compress(json.dumps({"traceEvents": []}).encode())
+        self.assertNotIn("WARNING", self._summarize_profile(content))
+        self.assertTrue((self.temp_dir / "profile.json.folded").is_file())
+
+    def test_broken_profile(self):
+        content = gzip.compress(json.dumps({"traceEvents": []}).encode())
+        for name, broken in (
+            ("truncated", content[:len(content) // 2]),
+            ("bad gzip", content[:2] + b"garbage"),
+            ("bad json", gzip.compress(b'{"traceEvents": [')),
+        ):
+            with self.subTest(name):
+                self.assertRegex(self._summarize_profile(broken),
+                                 "^WARNING: Unable to summarize profile ")
+
+
+class OutputMutatorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = pathlib.Path(
+            self.enterContext(tempfile.TemporaryDirectory()))
+        self.allowlist_path = self.temp_dir / "allowlist.txt"
+        self.allowlist_path.write_text(_ALLOWLIST)
+
+    def _check(self, filter_pattern: str | None, use_allowlist: bool):
+        allowlist = [line for line in _ALLOWLIST.splitlines()
+                     if line and not line.startswith("#")] if use_allowlist else []
+        expected, count, first_line = _mutate_by_line(
+            _OUTPUT, filter_pattern, allowlist)
+        output_mutator = bazel.OutputMutator(
+            filter_regex=re.compile(filter_pattern.encode()) if filter_pattern else None,
+            regex_allowlist_path=self.allowlist_path if use_allowlist else None,
+        )
+        # Chunks that split lines, and chunks with several lines.
+        for read_size in (1, 7, 100, len(_OUTPUT)):
+            with self.subTest(read_size=read_size):
+                output = _RecordingOutput()
+                try:
+                    asyncio.run(_mutate(output_mutator, _OUTPUT, read_size, output))
+                    self.assertEqual(count, 0)
+                except bazel.UnexpectedOutputLinesException as exception:
+                    self.assertIn(f"Found {count} unexpected lines in stdout",
+                                  exception.message)
+                    self.assertIn(first_line.strip(), exception.message)
+                self.assertEqual(b"".join(output.writes), expected)
+                # Only the final partial line is written without a newline.
+                for write in output.writes[:-1]:
+                    self.assertTrue(write.endswith(b"\n"), write)
+
+    def test_passthrough(self):
+        self._check(filter_pattern=None, use_allowlist=False)
+
+    def test_filter(self):
+        self._check(filter_pattern=_FILTER_PATTERN, use_allowlist=False)
+
+    def test_allowlist(self):
+        self._check(filter_pattern=None, use_allowlist=True)
+
+    def test_filter_and_allowlist(self):
+        self._check(filter_pattern=_FILTER_PATTERN, use_allowlist=True)
+
+
+if __name__ == "__main__":
+    absltest.main()
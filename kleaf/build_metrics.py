@@ -0,0 +1,254 @@
+# Copyright (C) 2024 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Summarizes build performance from the Build Event Protocol (BEP).
+
+Used by the Bazel wrapper with --kleaf_build_metrics.
+
+See https://bazel.build/remote/bep and
+https://github.com/bazelbuild/bazel/blob/master/src/main/java/com/google/devtools/build/lib/buildeventstream/proto/build_event_stream.proto
+"""
+
+import asyncio
+import collections
+import dataclasses
+import datetime
+import json
+import pathlib
+import sys
+from typing import Any, TextIO
+
+# Interval to poll the BEP file while Bazel is running, in seconds.
+_POLL_INTERVAL = 0.5
+
+# Mnemonic prefixes of actions whose durations are reported.
+_SLOW_ACTION_MNEMONIC_PREFIXES = ("KernelBuild", "KernelModule")
+
+# Number of slowest actions to report.
+_NUM_SLOWEST_ACTIONS = 10
+
+# Runner names in BuildMetrics.ActionSummary.runner_count that are cache hits.
+_REMOTE_CACHE_HIT_RUNNER = "remote cache hit"
+_DISK_CACHE_HIT_RUNNER = "disk cache hit"
+_TOTAL_RUNNER = "total"
+
+
+@dataclasses.dataclass(frozen=True, order=True)
+class ActionTiming:
+    """Duration of an executed action."""
+    duration: datetime.timedelta
+    mnemonic: str
+    label: str
+
+
+def _parse_timestamp(value: str | None) -> datetime.datetime | None:
+    """Parses a google.protobuf.Timestamp in JSON."""
+    if not value:
+        return None
+    try:
+        return datetime.datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except ValueError:
+        return None
+
+
+def _parse_duration(value: str | None) -> datetime.timedelta | None:
+    """Parses a google.protobuf.Duration in JSON, e.g. "1.5s"."""
+    if not value or not value.endswith("s"):
+        return None
+    try:
+        return datetime.timedelta(seconds=float(value.removesuffix("s")))
+    except ValueError:
+        return None
+
+
+def _format_duration(duration: datetime.timedelta) -> str:
+    return f"{duration.total_seconds():.1f}s"
+
+
+def _format_rate(count: int, total: int) -> str:
+    if not total:
+        return f"{count}"
+    return f"{count} ({count * 100 / total:.1f}%)"
+
+
+class BuildEventConsumer:
+    """Consumes the BEP JSON file written by Bazel with --build_event_json_file.
+
+    The file is parsed while Bazel is still running.
+    """
+
+    def __init__(self, path: pathlib.Path):
+        self._path = path
+        self._pending = b""
+        self._last_message = False
+
+        # mnemonic -> number of actions executed
+        self._action_counts = collections.Counter[str]()
+        self._runner_counts = collections.Counter[str]()
+        self._action_cache_hits = 0
+        self._actions_created = None
+        self._critical_path_time: datetime.timedelta | None = None
+        self._wall_time: datetime.timedelta | None = None
+        self._action_timings: list[ActionTiming] = []
+
+    def prepare(self):
+        """Removes the BEP file from a previous invocation."""
+        self._path.parent.mkdir(parents=True, exist_ok=True)
+        self._path.unlink(missing_ok=True)
+
+    def bazel_args(self) -> list[str]:
+        """Returns the arguments to the Bazel command to produce the BEP."""
+        return [
+            f"--build_event_json_file={self._path}",
+            # Needed for timings of successful actions.
+            "--build_event_publish_all_actions",
+        ]
+
+    async def consume(self, process: asyncio.subprocess.Process):
+        """Parses the BEP file until Bazel finishes writing to it.
+
+        Args:
+            process: the Bazel process that writes to the BEP file.
+        """
+        file = None
+        try:
+            while not self._last_message:
+                # Check before reading so everything written before the
+                # process exits is read.
+                process_finished = process.returncode is not None
+                if file is None and self._path.exists():
+                    file = open(self._path, "rb")
+                if file is not None:
+                    self._handle_data(file.read())
+                if process_finished:
+                    break
+                await asyncio.sleep(_POLL_INTERVAL)
+        finally:
+            if file is not None:
+                file.close()
+
+    def _handle_data(self, data: bytes):
+        """Handles newly written data. Each complete line is an event."""
+        if not data:
+            return
+        lines = (self._pending + data).split(b"\n")
+        self._pending = lines.pop()
+        for line in lines:
+            if not line.strip():
+                continue
+            try:
+                event = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            self.handle_event(event)
+
+    def handle_event(self, event: dict[str, Any]):
+        """Handles a single BuildEvent."""
+        if event.get("lastMessage"):
+            self._last_message = True
+        if "action" in event:
+            self._handle_action(event["action"])
+        if "buildMetrics" in event:
+            self._handle_build_metrics(event["buildMetrics"])
+
+    def _handle_action(self, action: dict[str, Any]):
+        mnemonic = action.get("type", "")
+        if not mnemonic.startswith(_SLOW_ACTION_MNEMONIC_PREFIXES):
+            return
+        start_time = _parse_timestamp(action.get("startTime"))
+        end_time = _parse_timestamp(action.get("endTime"))
+        if start_time is None or end_time is None:
+            return
+        self._action_timings.append(ActionTiming(
+            duration=end_time - start_time,
+            mnemonic=mnemonic,
+            label=action.get("label", ""),
+        ))
+
+    def _handle_build_metrics(self, build_metrics: dict[str, Any]):
+        action_summary = build_metrics.get("actionSummary", {})
+        self._actions_created = action_summary.get("actionsCreated")
+        for action_data in action_summary.get("actionData", []):
+            self._action_counts[action_data.get("mnemonic", "")] += int(
+                action_data.get("actionsExecuted", 0))
+        for runner_count in action_summary.get("runnerCount", []):
+            self._runner_counts[runner_count.get("name", "")] += int(
+                runner_count.get("count", 0))
+        action_cache_statistics = action_summary.get(
+            "actionCacheStatistics", {})
+        self._action_cache_hits = int(action_cache_statistics.get("hits", 0))
+
+        timing_metrics = build_metrics.get("timingMetrics", {})
+        self._critical_path_time = _parse_duration(
+            timing_metrics.get("criticalPathTime"))
+        wall_time_ms = timing_metrics.get("wallTimeInMs")
+        if wall_time_ms is not None:
+            self._wall_time = datetime.timedelta(
+                milliseconds=int(wall_time_ms))
+
+    def print_summary(self, file: TextIO = sys.stderr):
+        """Prints the summary of build metrics.
+
+        Nothing is printed if the build did not report metrics, e.g. it
+        failed before they were written.
+        """
+        if (self._wall_time is None and self._critical_path_time is None
+                and not self._runner_counts):
+            return
+        print("INFO: Kleaf build metrics:", file=file)
+        if self._wall_time is not None:
+            print(f"  Wall time: {_format_duration(self._wall_time)}",
+                  file=file)
+        if self._critical_path_time is not None:
+            print("  Critical path duration: "
+                  f"{_format_duration(self._critical_path_time)}", file=file)
+
+        # Actions skipped entirely because of the local action cache are
+        # not in runner_count.
+        local_cache_hits = (self._action_cache_hits +
+                            self._runner_counts[_DISK_CACHE_HIT_RUNNER])
+        remote_cache_hits = self._runner_counts[_REMOTE_CACHE_HIT_RUNNER]
+        executed = sum(
+            count for name, count in self._runner_counts.items()
+            if name not in (_TOTAL_RUNNER, _DISK_CACHE_HIT_RUNNER,
+                            _REMOTE_CACHE_HIT_RUNNER))
+        total = local_cache_hits + remote_cache_hits + executed
+        if total:
+            print("  Actions:", file=file)
+            if self._actions_created is not None:
+                print(f"    created: {self._actions_created}", file=file)
+            print("    local cache hits: "
+                  f"{_format_rate(local_cache_hits, total)}", file=file)
+            print("    remote cache hits: "
+                  f"{_format_rate(remote_cache_hits, total)}", file=file)
+            print(f"    executed: {_format_rate(executed, total)}", file=file)
+            for name, count in sorted(self._runner_counts.items()):
+                if name in (_TOTAL_RUNNER, _DISK_CACHE_HIT_RUNNER,
+                            _REMOTE_CACHE_HIT_RUNNER):
+                    continue
+                print(f"      {name}: {count}", file=file)
+
+        if self._action_counts:
+            print("  Actions executed by mnemonic:", file=file)
+            for mnemonic, count in sorted(self._action_counts.items(),
+                                          key=lambda item: (-item[1], item[0])):
+                print(f"    {mnemonic}: {count}", file=file)
+
+        if self._action_timings:
+            print(f"  Slowest {'/'.join(_SLOW_ACTION_MNEMONIC_PREFIXES)} "
+                  "actions:", file=file)
+            slowest = sorted(self._action_timings, reverse=True)
+            for timing in slowest[:_NUM_SLOWEST_ACTIONS]:
+                print(f"    {_format_duration(timing.duration)} "
+                      f"{timing.mnemonic} {timing.label}", file=file)
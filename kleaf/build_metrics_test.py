@@ -0,0 +1,95 @@
+# Copyright (C) 2024 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for build_metrics."""
+
+import io
+import json
+import pathlib
+import unittest
+
+from absl.testing import absltest
+import build_metrics
+
+# Events from a --build_event_json_file, trimmed to the fields that matter.
+_BEP = b"""\
+{"id":{"started":{}},"children":[{"progress":{}}],"started":{"uuid":"0123","startTimeMillis":"1714557600000","buildToolVersion":"7.1.0","command":"build"}}
+{"id":{"actionCompleted":{"primaryOutput":"bazel-out/k8-fastbuild/bin/common/kernel_aarch64_config/out_dir","label":"//common:kernel_aarch64_config"}},"action":{"success":true,"label":"//common:kernel_aarch64_config","type":"KernelConfig","startTime":"2024-05-01T10:00:01.000Z","endTime":"2024-05-01T10:00:31.000Z"}}
+{"id":{"actionCompleted":{"primaryOutput":"bazel-out/k8-fastbuild/bin/common/kernel_aarch64/vmlinux","label":"//common:kernel_aarch64"}},"action":{"success":true,"label":"//common:kernel_aarch64","type":"KernelBuild","startTime":"2024-05-01T10:00:31.000Z","endTime":"2024-05-01T10:10:31.500Z"}}
+{"id":{"actionCompleted":{"primaryOutput":"bazel-out/k8-fastbuild/bin/vendor/foo/foo.ko","label":"//vendor:foo"}},"action":{"success":true,"label":"//vendor:foo","type":"KernelModule","startTime":"2024-05-01T10:10:32.000Z","endTime":"2024-05-01T10:11:02.250Z"}}
+{"id":{"actionCompleted":{"primaryOutput":"bazel-out/k8-fastbuild/bin/vendor/bar/bar.ko","label":"//vendor:bar"}},"action":{"success":true,"label":"//vendor:bar","type":"KernelModule","startTime":"2024-05-01T10:10:32.000Z"}}
+{"id":{"buildMetrics":{}},"buildMetrics":{"actionSummary":{"actionsCreated":"1234","actionsExecuted":"20","actionData":[{"mnemonic":"KernelBuild","actionsExecuted":"1","firstStartedMs":"1714557631000","lastEndedMs":"1714558231500"},{"mnemonic":"KernelModule","actionsExecuted":"2"},{"mnemonic":"Genrule","actionsExecuted":"2"},{"mnemonic":"FileWrite","actionsExecuted":"15"}],"runnerCount":[{"name":"total","count":20},{"name":"remote cache hit","count":5,"execKind":"Remote"},{"name":"disk cache hit","count":3},{"name":"linux-sandbox","count":10,"execKind":"Local"},{"name":"local","count":2,"execKind":"Local"}],"actionCacheStatistics":{"sizeInBytes":"1000","hits":100,"misses":20}},"timingMetrics":{"cpuTimeInMs":"1000000","wallTimeInMs":"672500","analysisPhaseTimeInMs":"2000","criticalPathTime":"661.25s"}}}
+{"id":{"buildFinished":{}},"lastMessage":true,"finished":{"exitCode":{"name":"SUCCESS"}}}
+"""
+
+_SUMMARY = """\
+INFO: Kleaf build metrics:
+  Wall time: 672.5s
+  Critical path duration: 661.2s
+  Actions:
+    created: 1234
+    local cache hits: 103 (85.8%)
+    remote cache hits: 5 (4.2%)
+    executed: 12 (10.0%)
+      linux-sandbox: 10
+      local: 2
+  Actions executed by mnemonic:
+    FileWrite: 15
+    Genrule: 2
+    KernelModule: 2
+    KernelBuild: 1
+  Slowest KernelBuild/KernelModule actions:
+    600.5s KernelBuild //common:kernel_aarch64
+    30.2s KernelModule //vendor:foo
+"""
+
+
+class BuildEventConsumerTest(unittest.TestCase):
+
+    def _get_summary(self, consumer: build_metrics.BuildEventConsumer) -> str:
+        out = io.StringIO()
+        consumer.print_summary(file=out)
+        return out.getvalue()
+
+    def test_summary(self):
+        # Chunks split events, as Bazel may still be writing an event when
+        # the file is read.
+        for chunk_size in (1, 100, len(_BEP)):
+            with self.subTest(chunk_size=chunk_size):
+                consumer = build_metrics.BuildEventConsumer(pathlib.Path())
+                for start in range(0, len(_BEP), chunk_size):
+                    consumer._handle_data(_BEP[start:start + chunk_size])
+                self.assertTrue(consumer._last_message)
+                self.assertEqual(self._get_summary(consumer), _SUMMARY)
+
+    def test_ignores_malformed_events(self):
+        consumer = build_metrics.BuildEventConsumer(pathlib.Path())
+        consumer._handle_data(b'{"id":\n\n' + _BEP)
+        self.assertEqual(self._get_summary(consumer), _SUMMARY)
+
+    def test_no_events(self):
+        consumer = build_metrics.BuildEventConsumer(pathlib.Path())
+        self.assertEqual(self._get_summary(consumer), "")
+
+    def test_no_build_metrics(self):
+        # An aborted build reports actions, but not the build metrics.
+        consumer = build_metrics.BuildEventConsumer(pathlib.Path())
+        for line in _BEP.splitlines():
+            if b'"buildMetrics"' not in line:
+                consumer.handle_event(json.loads(line))
+        self.assertEqual(self._get_summary(consumer), "")
+
+
+if __name__ == "__main__":
+    absltest.main()
@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+#
+# Copyright (C) 2024 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Summarizes Kleaf actions in a Bazel JSON trace profile.
+
+Used by the Bazel wrapper with --kleaf_profile. May also be run on an
+existing profile:
+
+    build/kernel/kleaf/build_profile.py /tmp/profile.json.gz
+
+See https://bazel.build/advanced/performance/json-trace-profile
+"""
+
+import argparse
+import collections
+import dataclasses
+import gzip
+import json
+import pathlib
+import sys
+from typing import Any, TextIO
+
+# Event category of actions in the profile.
+_ACTION_CATEGORY = "action processing"
+
+# Kleaf action categories in the summary and the mnemonic prefixes that
+# belong to them. The first match wins.
+_KLEAF_CATEGORIES = (
+    ("ABI", (
+        "Abi",
+        "KernelBuildKmiSymbolListStrictMode",
+        "KernelDependencyGraph",
+        "KernelDiffAbi",
+        "KernelExtractedSymbols",
+        "KernelProtectedExports",
+        "KmiSymbolList",
+        "RawKmiSymbolList",
+    )),
+    ("KernelConfig", (
+        "DdkConfig",
+        "KernelConfig",
+        "KernelEnv",
+    )),
+    ("KernelModule", (
+        "KernelModule",
+        "DdkHeaders",
+        "DdkMakefiles",
+        "ModulesPrepare",
+    )),
+    ("KernelBuild", (
+        "KernelBuild",
+    )),
+    ("dist", (
+        "BootImages",
+        "Dtbo",
+        "GkiArtifacts",
+        "Initramfs",
+        "KernelSbom",
+        "KernelUnstrippedModulesArchive",
+        "MergedKernelUapiHeaders",
+        "SuperImage",
+        "SystemDlkmImage",
+        "UnsparsedSuperImage",
+        "VendorDlkmImage",
+    )),
+)
+_OTHER_CATEGORY = "other"
+
+
+def _get_category(mnemonic: str) -> str:
+    for category, prefixes in _KLEAF_CATEGORIES:
+        if mnemonic.startswith(prefixes):
+            return category
+    return _OTHER_CATEGORY
+
+
+def _format_us(us: float) -> str:
+    return f"{us / 1_000_000:.1f}s"
+
+
+@dataclasses.dataclass
+class _CategoryStats:
+    count: int = 0
+    # Sum of action durations, in microseconds.
+    total_us: int = 0
+    longest_us: int = 0
+    longest_name: str = ""
+
+    def add(self, dur: int, name: str):
+        self.count += 1
+        self.total_us += dur
+        if dur > self.longest_us:
+            self.longest_us = dur
+            self.longest_name = name
+
+
+def load_trace_events(path: pathlib.Path) -> list[dict[str, Any]]:
+    """Loads events from a JSON trace profile, optionally gzipped."""
+    with open(path, "rb") as file:
+        gzipped = file.read(2) == b"\x1f\x8b"
+    opener = gzip.open if gzipped else open
+    with opener(path, "rt") as file:
+        trace = json.load(file)
+    if isinstance(trace, list):
+        return trace
+    return trace.get("traceEvents", [])
+
+
+def _get_frame(event: dict[str, Any]) -> str:
+    """Returns the name of the frame of an event in the folded stacks.
+
+    Actions are named by mnemonic and target so that actions of the same
+    kind are merged.
+    """
+    args = event.get("args") or {}
+    if event.get("cat") == _ACTION_CATEGORY and "mnemonic" in args:
+        frame = args["mnemonic"]
+        if "target" in args:
+            frame += " " + args["target"]
+    else:
+        frame = event.get("name", "")
+    # ";" separates frames, and the count follows the last space.
+    return frame.replace(";", ":").replace("\n", " ")
+
+
+def get_folded_stacks(events: list[dict[str, Any]]) -> dict[str, int]:
+    """Computes the self time of each stack of nested events.
+
+    Events on the same thread are nested by their time spans.
+
+    Returns:
+        A dictionary from stacks of frames joined by ";" to the self time in
+        microseconds, i.e. the format of flamegraph.pl and speedscope.
+    """
+    events_by_thread = collections.defaultdict(list)
+    for event in events:
+        if event.get("ph") != "X" or "dur" not in event:
+            continue
+        events_by_thread[(event.get("pid"), event.get("tid"))].append(event)
+
+    folded = collections.Counter[str]()
+    for thread_events in events_by_thread.values():
+        # Parents start no later than their children and last longer.
+        thread_events.sort(key=lambda event: (event["ts"], -event["dur"]))
+        # Each item is [end, frame, duration, time of children]
+        stack = []
+
+        def pop():
+            end, frame, dur, children_us = stack.pop()
+            stack_key = ";".join(item[1] for item in stack + [[end, frame]])
+            folded[stack_key] += max(0, dur - children_us)
+            if stack:
+                stack[-1][3] += dur
+
+        for event in thread_events:
+            while stack and stack[-1][0] <= event["ts"]:
+                pop()
+            stack.append([event["ts"] + event["dur"], _get_frame(event),
+                          event["dur"], 0])
+        while stack:
+            pop()
+
+    return {key: value for key, value in folded.items() if value > 0}
+
+
+def write_folded_stacks(folded: dict[str, int], dest: pathlib.Path):
+    with open(dest, "w") as file:
+        for stack_key, self_us in sorted(folded.items()):
+            file.write(f"{stack_key} {self_us}\n")
+
+
+def print_summary(events: list[dict[str, Any]], file: TextIO = sys.stderr):
+    """Prints the time spent in each category of Kleaf actions."""
+    stats = collections.defaultdict(_CategoryStats)
+    for event in events:
+        if event.get("cat") != _ACTION_CATEGORY or "dur" not in event:
+            continue
+        args = event.get("args") or {}
+        mnemonic = args.get("mnemonic", "")
+        name = f"{mnemonic} {args.get('target', event.get('name', ''))}"
+        stats[_get_category(mnemonic)].add(event["dur"], name)
+
+    all_us = sum(category_stats.total_us for category_stats in stats.values())
+    if not all_us:
+        print("INFO: No actions found in the profile.", file=file)
+        return
+
+    print("INFO: Kleaf profile summary (sum of action durations):",
+          file=file)
+    for category in [category for category, _ in _KLEAF_CATEGORIES] + \
+            [_OTHER_CATEGORY]:
+        if category not in stats:
+            continue
+        category_stats = stats[category]
+        print(f"  {category}: {_format_us(category_stats.total_us)} "
+              f"({category_stats.total_us * 100 / all_us:.1f}%) in "
+              f"{category_stats.count} actions", file=file)
+        if category != _OTHER_CATEGORY:
+            print(f"    longest: {_format_us(category_stats.longest_us)} "
+                  f"{category_stats.longest_name}", file=file)
+
+
+def get_folded_stacks_path(profile: pathlib.Path) -> pathlib.Path:
+    """Returns the path to the folded stacks next to the profile."""
+    return profile.with_name(profile.name.removesuffix(".gz") + ".folded")
+
+
+def summarize(profile: pathlib.Path, file: TextIO = sys.stderr):
+    """Prints the summary of a profile and writes its folded stacks."""
+    events = load_trace_events(profile)
+    print_summary(events, file=file)
+    folded_stacks_path = get_folded_stacks_path(profile)
+    write_folded_stacks(get_folded_stacks(events), folded_stacks_path)
+    print(f"INFO: Folded stacks for flame graphs: {folded_stacks_path}",
+          file=file)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("profile", type=pathlib.Path,
+                        help="Profile from --profile with "
+                             "--generate_json_trace_profile.")
+    summarize(**vars(parser.parse_args()), file=sys.stdout)
@@ -0,0 +1,136 @@
+# Copyright (C) 2024 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for build_profile."""
+
+import gzip
+import io
+import json
+import pathlib
+import tempfile
+import unittest
+
+from absl.testing import absltest
+import build_profile
+
+
+def _action(mnemonic: str, target: str, ts: int, dur: int, tid: int) -> dict:
+    return {
+        "cat": "action processing",
+        "name": f"Action {target}",
+        "ph": "X",
+        "ts": ts,
+        "dur": dur,
+        "pid": 1,
+        "tid": tid,
+        "args": {"mnemonic": mnemonic, "target": target},
+    }
+
+
+# Times are in microseconds.
+_EVENTS = [
+    {"name": "thread_name", "ph": "M", "pid": 1, "tid": 1,
+     "args": {"name": "skyframe-evaluator-0"}},
+    {"cat": "general information", "name": "execute;phase", "ph": "X",
+     "ts": 0, "dur": 10_000_000, "pid": 1, "tid": 1},
+    _action("KernelBuild", "//common:kernel_aarch64",
+            ts=1_000_000, dur=6_000_000, tid=1),
+    {"cat": "local action execution", "name": "subprocess.run", "ph": "X",
+     "ts": 2_000_000, "dur": 4_000_000, "pid": 1, "tid": 1},
+    _action("KernelModule", "//vendor:foo",
+            ts=0, dur=3_000_000, tid=2),
+    _action("KernelConfig", "//common:kernel_aarch64_config",
+            ts=3_000_000, dur=1_000_000, tid=2),
+    _action("Genrule", "//common:gen",
+            ts=4_000_000, dur=500_000, tid=2),
+    _action("DdkHeaders", "//vendor:foo_headers",
+            ts=4_500_000, dur=500_000, tid=2),
+    # Matches ABI before KernelBuild.
+    _action("KernelBuildKmiSymbolListStrictMode", "//common:kernel_aarch64_abi",
+            ts=5_000_000, dur=1_000_000, tid=2),
+    {"cat": "general information", "name": "instant", "ph": "i",
+     "ts": 5_000_000, "pid": 1, "tid": 2},
+]
+
+_SUMMARY = """\
+INFO: Kleaf profile summary (sum of action durations):
+  ABI: 1.0s (8.3%) in 1 actions
+    longest: 1.0s KernelBuildKmiSymbolListStrictMode //common:kernel_aarch64_abi
+  KernelConfig: 1.0s (8.3%) in 1 actions
+    longest: 1.0s KernelConfig //common:kernel_aarch64_config
+  KernelModule: 3.5s (29.2%) in 2 actions
+    longest: 3.0s KernelModule //vendor:foo
+  KernelBuild: 6.0s (50.0%) in 1 actions
+    longest: 6.0s KernelBuild //common:kernel_aarch64
+  other: 0.5s (4.2%) in 1 actions
+"""
+
+_FOLDED_STACKS = {
+    "execute:phase": 4_000_000,
+    "execute:phase;KernelBuild //common:kernel_aarch64": 2_000_000,
+    "execute:phase;KernelBuild //common:kernel_aarch64;subprocess.run": 4_000_000,
+    "KernelModule //vendor:foo": 3_000_000,
+    "KernelConfig //common:kernel_aarch64_config": 1_000_000,
+    "Genrule //common:gen": 500_000,
+    "DdkHeaders //vendor:foo_headers": 500_000,
+    "KernelBuildKmiSymbolListStrictMode //common:kernel_aarch64_abi": 1_000_000,
+}
+
+
+class BuildProfileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = pathlib.Path(
+            self.enterContext(tempfile.TemporaryDirectory()))
+
+    def test_print_summary(self):
+        out = io.StringIO()
+        build_profile.print_summary(_EVENTS, file=out)
+        self.assertEqual(out.getvalue(), _SUMMARY)
+
+    def test_print_summary_no_actions(self):
+        out = io.StringIO()
+        build_profile.print_summary(_EVENTS[:2], file=out)
+        self.assertEqual(out.getvalue(),
+                         "INFO: No actions found in the profile.\n")
+
+    def test_get_folded_stacks(self):
+        self.assertEqual(build_profile.get_folded_stacks(_EVENTS),
+                         _FOLDED_STACKS)
+
+    def test_summarize(self):
+        profile = self.temp_dir / "profile.json.gz"
+        with gzip.open(profile, "wt") as file:
+            json.dump({"otherData": {}, "traceEvents": _EVENTS}, file)
+
+        out = io.StringIO()
+        build_profile.summarize(profile, file=out)
+        folded_stacks_path = self.temp_dir / "profile.json.folded"
+        self.assertEqual(
+            out.getvalue(),
+            _SUMMARY +
+            f"INFO: Folded stacks for flame graphs: {folded_stacks_path}\n")
+        self.assertEqual(
+            folded_stacks_path.read_text(),
+            "".join(f"{key} {value}\n"
+                    for key, value in sorted(_FOLDED_STACKS.items())))
+
+    def test_load_uncompressed(self):
+        profile = self.temp_dir / "profile.json"
+        profile.write_text(json.dumps(_EVENTS))
+        self.assertEqual(build_profile.load_trace_events(profile), _EVENTS)
+
+
+if __name__ == "__main__":
+    absltest.main()
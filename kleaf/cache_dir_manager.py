@@ -0,0 +1,555 @@
+#!/usr/bin/env python3
+#
+# Copyright (C) 2024 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Reports and bounds the size of --cache_dir for --config=local builds.
+
+Each subdirectory of --cache_dir is a $COMMON_OUT_DIR identified by its
+kleaf_config_tags.json. See kleaf/impl/cache_dir.bzl.
+
+Examples:
+
+    # List entries with their size, last use and configuration.
+    build/kernel/kleaf/cache_dir_manager.py report
+
+    # Remove stale entries, then least recently used entries until the
+    # cache directory is below 100G.
+    build/kernel/kleaf/cache_dir_manager.py gc --max_size 100G
+"""
+
+import argparse
+import concurrent.futures
+import dataclasses
+import datetime
+import fcntl
+import json
+import os
+import pathlib
+import shutil
+import sys
+import tempfile
+import time
+
+from impl.cache_dir_config_tags import DEFCONFIG_FRAGMENTS_KEY, TARGET_KEY
+
+# Sync with kleaf/impl/cache_dir.bzl
+CONFIG_TAGS_FILE_NAME = "kleaf_config_tags.json"
+_LAST_SYMLINK_PREFIX = "last_"
+
+# Directory under --cache_dir that holds entries being deleted.
+_TRASH_DIR_NAME = ".kleaf_trash"
+
+# Touched when a garbage collection starts. See should_collect_garbage().
+_GC_STAMP_FILE_NAME = ".kleaf_gc_stamp"
+
+# Minimum interval between garbage collections started by the Bazel wrapper.
+_GC_INTERVAL = datetime.timedelta(hours=1)
+
+# Entries used within this period are never evicted, because a build may be
+# using them right now.
+_DEFAULT_MIN_AGE = datetime.timedelta(hours=1)
+
+# When deleting, split trees into at least this many subtrees if they are
+# found within _MAX_SPLIT_DEPTH levels.
+_MIN_PARALLEL_SUBTREES = 64
+_MAX_SPLIT_DEPTH = 4
+
+# Interval to check whether the process given by --wait_pid has exited.
+_WAIT_PID_INTERVAL = datetime.timedelta(seconds=1)
+
+_SIZE_SUFFIXES = {
+    "": 1,
+    "K": 2**10,
+    "M": 2**20,
+    "G": 2**30,
+    "T": 2**40,
+}
+
+
+def parse_size(value: str) -> int:
+    """Parses a size like 500M or 100G into number of bytes."""
+    value = value.strip().upper().removesuffix("B")
+    suffix = value[-1:] if value[-1:] in _SIZE_SUFFIXES else ""
+    try:
+        number = float(value.removesuffix(suffix))
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            f"Invalid size {value!r}; expected e.g. 500M, 100G") from None
+    if number < 0:
+        raise argparse.ArgumentTypeError(f"Invalid size {value!r}")
+    return int(number * _SIZE_SUFFIXES[suffix])
+
+
+def format_size(size: int) -> str:
+    """Formats number of bytes for humans."""
+    for suffix in ("", "K", "M", "G"):
+        if size < 1024:
+            return f"{size:.0f}{suffix}" if not suffix else \
+                f"{size:.1f}{suffix}"
+        size /= 1024
+    return f"{size:.1f}T"
+
+
+@dataclasses.dataclass
+class CacheEntry:
+    """A subdirectory of --cache_dir."""
+    path: pathlib.Path
+    config_tags: dict
+    # Disk usage in bytes.
+    size: int = 0
+    # Last modification time of anything in the entry, or of a last_*
+    # symlink pointing to it, in seconds since the epoch.
+    last_used: float = 0
+    # Names of last_* symlinks pointing to this entry.
+    symlinks: list[str] = dataclasses.field(default_factory=list)
+    # Reason why this entry is stale, if any.
+    stale_reason: str | None = None
+
+    @property
+    def target(self) -> str | None:
+        return self.config_tags.get(TARGET_KEY)
+
+
+def _walk_size(path: pathlib.Path) -> tuple[int, float]:
+    """Returns disk usage and latest mtime of everything under path.
+
+    Symlinks are not followed.
+    """
+    size = 0
+    last_modified = 0.0
+    stack = [path]
+    while stack:
+        try:
+            it = os.scandir(stack.pop())
+        except OSError:
+            continue
+        with it:
+            for dir_entry in it:
+                try:
+                    st = dir_entry.stat(follow_symlinks=False)
+                except OSError:
+                    continue
+                size += st.st_blocks * 512
+                last_modified = max(last_modified, st.st_mtime)
+                if dir_entry.is_dir(follow_symlinks=False):
+                    stack.append(dir_entry.path)
+    return size, last_modified
+
+
+def _label_package(label: str) -> str | None:
+    """Returns the package of a label in the main repository, or None."""
+    for prefix in ("@@//", "@//", "//"):
+        if label.startswith(prefix):
+            return label.removeprefix(prefix).partition(":")[0]
+    return None
+
+
+def _get_stale_reason(config_tags: dict, workspace: pathlib.Path) -> str | None:
+    """Returns why the target or defconfig fragments of an entry are gone."""
+    target = config_tags.get(TARGET_KEY)
+    if target:
+        package = _label_package(target)
+        if package is not None and not any(
+                (workspace / package / build_file).is_file()
+                for build_file in ("BUILD.bazel", "BUILD")):
+            return f"package of {target} no longer exists"
+    for fragment in config_tags.get(DEFCONFIG_FRAGMENTS_KEY, []):
+        # Generated or external fragments can't be checked without Bazel.
+        if fragment.startswith(("bazel-out/", "external/", "/")):
+            continue
+        if not (workspace / fragment).exists():
+            return f"defconfig fragment {fragment} no longer exists"
+    return None
+
+
+def _load_entry(path: pathlib.Path, workspace: pathlib.Path | None) \
+        -> CacheEntry | None:
+    """Loads and measures an entry. Returns None if path is not an entry."""
+    try:
+        with open(path / CONFIG_TAGS_FILE_NAME) as config_tags_file:
+            config_tags = json.load(config_tags_file)
+    except (OSError, json.JSONDecodeError):
+        return None
+    entry = CacheEntry(path=path, config_tags=config_tags)
+    entry.size, entry.last_used = _walk_size(path)
+    if workspace is not None:
+        entry.stale_reason = _get_stale_reason(config_tags, workspace)
+    return entry
+
+
+def scan(
+    cache_dir: pathlib.Path,
+    workspace: pathlib.Path | None,
+    executor: concurrent.futures.Executor,
+) -> list[CacheEntry]:
+    """Loads all entries under cache_dir in parallel.
+
+    Args:
+        cache_dir: the --cache_dir
+        workspace: root of the workspace, to detect stale entries. If None,
+            stale entries are not detected.
+        executor: executor to measure entries in parallel.
+
+    Returns:
+        Entries, most recently used first.
+    """
+    if not cache_dir.is_dir():
+        return []
+
+    candidates = []
+    symlinks = []
+    for child in cache_dir.iterdir():
+        if child.name.startswith(_LAST_SYMLINK_PREFIX) and child.is_symlink():
+            symlinks.append(child)
+        elif child.is_dir() and not child.is_symlink():
+            candidates.append(child)
+
+    entries = {}
+    for entry in executor.map(lambda path: _load_entry(path, workspace),
+                              candidates):
+        if entry is not None:
+            entries[entry.path.name] = entry
+
+    # ln -sfT ${OUT_DIR_SUFFIX} {cache_dir}/last_{symlink_name}
+    for symlink in symlinks:
+        entry = entries.get(os.readlink(symlink))
+        if entry is None:
+            continue
+        entry.symlinks.append(symlink.name)
+        entry.last_used = max(entry.last_used, symlink.lstat().st_mtime)
+
+    return sorted(entries.values(), key=lambda entry: entry.last_used,
+                  reverse=True)
+
+
+def _is_in_use(entry: CacheEntry) -> bool:
+    """Returns whether a build holds the lock on the entry.
+
+    Builds lock kleaf_config_tags.json with --debug_cache_dir_conflict.
+    """
+    try:
+        with open(entry.path / CONFIG_TAGS_FILE_NAME) as config_tags_file:
+            try:
+                fcntl.flock(config_tags_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return True
+            fcntl.flock(config_tags_file, fcntl.LOCK_UN)
+    except FileNotFoundError:
+        pass
+    return False
+
+
+def move_to_trash(path: pathlib.Path, trash_dir: pathlib.Path) \
+        -> pathlib.Path | None:
+    """Atomically moves path into trash_dir so it can be deleted later.
+
+    trash_dir must be on the same file system as path.
+
+    Returns:
+        The new path, or None if path does not exist.
+    """
+    trash_dir.mkdir(parents=True, exist_ok=True)
+    dest = pathlib.Path(tempfile.mkdtemp(dir=trash_dir, prefix=path.name + "."))
+    try:
+        path.rename(dest / path.name)
+    except FileNotFoundError:
+        dest.rmdir()
+        return None
+    return dest
+
+
+def remove_trees(paths: list[pathlib.Path],
+                 executor: concurrent.futures.Executor):
+    """Deletes directory trees in parallel.
+
+    Directories are expanded breadth-first until there are enough subtrees
+    to keep the executor busy. Each subtree is then removed with
+    shutil.rmtree in the executor.
+    """
+    frontier = list(paths)
+    expanded = []
+    for _ in range(_MAX_SPLIT_DEPTH):
+        if len(frontier) >= _MIN_PARALLEL_SUBTREES:
+            break
+        next_frontier = []
+        for path in frontier:
+            try:
+                with os.scandir(path) as it:
+                    dir_entries = list(it)
+            except OSError:
+                continue
+            for dir_entry in dir_entries:
+                if dir_entry.is_dir(follow_symlinks=False):
+                    next_frontier.append(dir_entry.path)
+                    continue
+                # Like shutil.rmtree(ignore_errors=True), keep removing
+                # other files, e.g. if a concurrent build removed this one.
+                try:
+                    os.unlink(dir_entry.path)
+                except OSError:
+                    pass
+            expanded.append(path)
+        frontier = next_frontier
+
+    futures = [executor.submit(shutil.rmtree, path, ignore_errors=True)
+               for path in frontier]
+    concurrent.futures.wait(futures)
+    # Parents are expanded before children, so delete in reverse order.
+    for path in reversed(expanded):
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def move_all_to_trash(cache_dir: pathlib.Path) -> bool:
+    """Atomically moves everything in cache_dir to its trash directory.
+
+    Returns:
+        whether anything was moved.
+    """
+    if not cache_dir.is_dir():
+        return False
+    trash_dir = cache_dir / _TRASH_DIR_NAME
+    moved = False
+    for child in cache_dir.iterdir():
+        if child.name != _TRASH_DIR_NAME:
+            moved = move_to_trash(child, trash_dir) is not None or moved
+    return moved or trash_dir.is_dir()
+
+
+def empty_trash(trash_dir: pathlib.Path, executor: concurrent.futures.Executor):
+    """Deletes everything in trash_dir in parallel."""
+    if not trash_dir.is_dir():
+        return
+    remove_trees(list(trash_dir.iterdir()), executor)
+    shutil.rmtree(trash_dir, ignore_errors=True)
+
+
+def select_victims(
+    entries: list[CacheEntry],
+    max_size: int | None,
+    min_age: datetime.timedelta,
+    now: float,
+) -> list[CacheEntry]:
+    """Returns entries to evict.
+
+    Stale entries are always evicted. Then the least recently used entries
+    are evicted until the total size is at most max_size. Entries used
+    within min_age are never evicted.
+
+    Args:
+        entries: entries, most recently used first.
+        max_size: size budget in bytes, or None for no limit.
+        min_age: entries used within this period are kept.
+        now: current time in seconds since the epoch.
+    """
+    cutoff = now - min_age.total_seconds()
+    victims = []
+    kept = []
+    for entry in entries:
+        if entry.stale_reason is not None and entry.last_used < cutoff:
+            victims.append(entry)
+        else:
+            kept.append(entry)
+
+    if max_size is None:
+        return victims
+
+    total = sum(entry.size for entry in kept)
+    for entry in reversed(kept):
+        if total <= max_size:
+            break
+        if entry.last_used >= cutoff:
+            # The rest are even more recent.
+            break
+        victims.append(entry)
+        total -= entry.size
+    return victims
+
+
+def should_collect_garbage(cache_dir: pathlib.Path) -> bool:
+    """Returns whether enough time has passed since the last collection."""
+    try:
+        last_collected = (cache_dir / _GC_STAMP_FILE_NAME).stat().st_mtime
+    except FileNotFoundError:
+        return True
+    return time.time() - last_collected >= _GC_INTERVAL.total_seconds()
+
+
+def _print_entry(entry: CacheEntry, file=sys.stdout):
+    last_used = datetime.datetime.fromtimestamp(entry.last_used)
+    print(f"{entry.path.name}  {format_size(entry.size):>7}  "
+          f"{last_used:%Y-%m-%d %H:%M}  {entry.target or '<unknown target>'}",
+          file=file)
+    for symlink in sorted(entry.symlinks):
+        print(f"    <- {symlink}", file=file)
+    if entry.stale_reason:
+        print(f"    stale: {entry.stale_reason}", file=file)
+
+
+def report(cache_dir: pathlib.Path, workspace: pathlib.Path, jobs: int):
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        entries = scan(cache_dir, workspace, executor)
+    for entry in entries:
+        _print_entry(entry)
+    total = sum(entry.size for entry in entries)
+    print(f"Total: {format_size(total)} in {len(entries)} entries under "
+          f"{cache_dir}")
+
+
+def _wait_for_process(pid: int):
+    """Waits until a process that is not a child of this process exits."""
+    while True:
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return
+        time.sleep(_WAIT_PID_INTERVAL.total_seconds())
+
+
+def gc(
+    cache_dir: pathlib.Path,
+    workspace: pathlib.Path,
+    jobs: int,
+    max_size: int | None,
+    min_age: datetime.timedelta,
+    dry_run: bool,
+    wait_pid: int | None,
+):
+    if not cache_dir.is_dir():
+        return
+    # The stamp file also serves as a lock so only one collection runs at a
+    # time.
+    with open(cache_dir / _GC_STAMP_FILE_NAME, "a") as stamp_file:
+        try:
+            fcntl.flock(stamp_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            print(f"INFO: Another garbage collection of {cache_dir} is "
+                  "running", file=sys.stderr)
+            return
+        if not dry_run:
+            os.utime(stamp_file.fileno())
+        if wait_pid is not None:
+            _wait_for_process(wait_pid)
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=jobs) as executor:
+            _collect_garbage(cache_dir, workspace, executor, max_size,
+                             min_age, dry_run)
+
+
+def _collect_garbage(
+    cache_dir: pathlib.Path,
+    workspace: pathlib.Path,
+    executor: concurrent.futures.Executor,
+    max_size: int | None,
+    min_age: datetime.timedelta,
+    dry_run: bool,
+):
+    trash_dir = cache_dir / _TRASH_DIR_NAME
+    # Leftovers from an interrupted collection.
+    if not dry_run:
+        empty_trash(trash_dir, executor)
+
+    entries = scan(cache_dir, workspace, executor)
+    victims = select_victims(entries, max_size, min_age, time.time())
+
+    removed_size = 0
+    for entry in victims:
+        reason = entry.stale_reason or "least recently used"
+        if _is_in_use(entry):
+            print(f"INFO: Skipping {entry.path} in use", file=sys.stderr)
+            continue
+        print(f"INFO: {'Would remove' if dry_run else 'Removing'} "
+              f"{entry.path} ({format_size(entry.size)}, "
+              f"{entry.target}): {reason}", file=sys.stderr)
+        if dry_run:
+            continue
+        move_to_trash(entry.path, trash_dir)
+        for symlink in entry.symlinks:
+            symlink_path = cache_dir / symlink
+            # A build may have pointed the symlink elsewhere since scan().
+            try:
+                if os.readlink(symlink_path) == entry.path.name:
+                    symlink_path.unlink()
+            except FileNotFoundError:
+                pass
+        removed_size += entry.size
+
+    if not dry_run:
+        empty_trash(trash_dir, executor)
+        print(f"INFO: Removed {format_size(removed_size)} from {cache_dir}",
+              file=sys.stderr)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument(
+        "--cache_dir", type=pathlib.Path,
+        default=pathlib.Path("out/cache"),
+        help="The --cache_dir given to tools/bazel. Default: out/cache")
+    parser.add_argument(
+        "--workspace", type=pathlib.Path, default=pathlib.Path("."),
+        help="""Root of the workspace, to detect entries for targets and
+            defconfig fragments that no longer exist. Default: current
+            directory""")
+    parser.add_argument(
+        "--jobs", type=int, default=os.cpu_count(),
+        help="Number of directories to measure or delete in parallel.")
+    subparsers = parser.add_subparsers(dest="subcommand", required=True)
+
+    subparsers.add_parser("report", help="List entries and their sizes.")
+
+    gc_parser = subparsers.add_parser(
+        "gc", help="Remove stale and least recently used entries.",
+        description="""Remove stale and least recently used entries.
+            Entries used within --min_age_hours are kept. A build that is
+            still running is only detected if it runs with
+            --debug_cache_dir_conflict; otherwise, an entry that a build
+            has used for longer than --min_age_hours may be removed while
+            the build is using it.""")
+    gc_parser.add_argument(
+        "--max_size", type=parse_size,
+        help="If set, also remove least recently used entries until the "
+             "cache directory is at most this size, e.g. 100G.")
+    gc_parser.add_argument(
+        "--min_age_hours", type=float,
+        default=_DEFAULT_MIN_AGE.total_seconds() / 3600,
+        help="Never remove entries used within this number of hours.")
+    gc_parser.add_argument(
+        "--dry_run", action="store_true",
+        help="Only print what would be removed.")
+    gc_parser.add_argument(
+        "--wait_pid", type=int,
+        help="Wait for the given process to exit before removing entries.")
+
+    subparsers.add_parser(
+        "empty_trash",
+        help="Delete entries removed by `tools/bazel clean` or by an "
+             "interrupted gc.")
+
+    args = parser.parse_args()
+    match args.subcommand:
+        case "report":
+            report(cache_dir=args.cache_dir, workspace=args.workspace,
+                   jobs=args.jobs)
+        case "gc":
+            gc(cache_dir=args.cache_dir, workspace=args.workspace,
+               jobs=args.jobs, max_size=args.max_size,
+               min_age=datetime.timedelta(hours=args.min_age_hours),
+               dry_run=args.dry_run, wait_pid=args.wait_pid)
+        case "empty_trash":
+            with concurrent.futures.ThreadPoolExecutor(
+                    max_workers=args.jobs) as executor:
+                empty_trash(args.cache_dir / _TRASH_DIR_NAME, executor)
@@ -0,0 +1,136 @@
+# Copyright (C) 2024 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import concurrent.futures
+import datetime
+import json
+import os
+import pathlib
+import tempfile
+import unittest
+from unittest import mock
+
+from absl.testing import absltest
+import cache_dir_manager
+
+_HOUR = 3600
+
+
+class CacheDirManagerTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = pathlib.Path(
+            self.enterContext(tempfile.TemporaryDirectory()))
+        self.cache_dir = self.temp_dir / "cache"
+        self.workspace = self.temp_dir / "workspace"
+        (self.workspace / "common").mkdir(parents=True)
+        (self.workspace / "common/BUILD.bazel").touch()
+        self.executor = self.enterContext(
+            concurrent.futures.ThreadPoolExecutor())
+        self.now = 1_000_000
+
+    def _add_entry(self, name: str, config_tags: dict, size: int,
+                   age_hours: float):
+        path = self.cache_dir / name
+        (path / "common").mkdir(parents=True)
+        (path / cache_dir_manager.CONFIG_TAGS_FILE_NAME).write_text(
+            json.dumps(config_tags))
+        (path / "common/vmlinux").write_bytes(b"\0" * size)
+        mtime = self.now - age_hours * _HOUR
+        for file in (path / "common/vmlinux", path / "common",
+                     path / cache_dir_manager.CONFIG_TAGS_FILE_NAME, path):
+            os.utime(file, (mtime, mtime))
+
+    def _victims(self, max_size: int | None) -> list[str]:
+        entries = cache_dir_manager.scan(self.cache_dir, self.workspace,
+                                         self.executor)
+        victims = cache_dir_manager.select_victims(
+            entries, max_size, datetime.timedelta(hours=1), self.now)
+        return [entry.path.name for entry in victims]
+
+    def test_parse_size(self):
+        self.assertEqual(cache_dir_manager.parse_size("100"), 100)
+        self.assertEqual(cache_dir_manager.parse_size("1.5K"), 1536)
+        self.assertEqual(cache_dir_manager.parse_size("100G"), 100 * 2**30)
+        self.assertEqual(cache_dir_manager.parse_size("2tb"), 2 * 2**40)
+
+    def test_stale(self):
+        self._add_entry("a", {"_target": "//common:kernel"}, 0, 2)
+        self._add_entry("b", {"_target": "//gone:kernel"}, 0, 2)
+        self._add_entry("c", {"_target": "//common:kernel",
+                              "_defconfig_fragments": ["common/gone.config"]},
+                        0, 2)
+        self._add_entry("d", {"_target": "@other//gone:kernel"}, 0, 2)
+        self.assertCountEqual(self._victims(max_size=None), ["b", "c"])
+
+    def test_lru(self):
+        self._add_entry("a", {"_target": "//common:a"}, 2**20, 2)
+        self._add_entry("b", {"_target": "//common:b"}, 2**20, 3)
+        self._add_entry("c", {"_target": "//common:c"}, 2**20, 4)
+        self.assertEqual(self._victims(max_size=int(2.5 * 2**20)), ["c"])
+        self.assertEqual(self._victims(max_size=int(1.5 * 2**20)), ["c", "b"])
+
+    def test_recently_used_kept(self):
+        self._add_entry("a", {"_target": "//gone:a"}, 2**20, 0)
+        self._add_entry("b", {"_target": "//common:b"}, 2**20, 0.5)
+        self.assertEqual(self._victims(max_size=0), [])
+
+    def test_last_symlink_counts_as_use(self):
+        self._add_entry("a", {"_target": "//common:a"}, 2**20, 2)
+        self._add_entry("b", {"_target": "//common:b"}, 2**20, 3)
+        symlink = self.cache_dir / "last_build"
+        symlink.symlink_to("b")
+        os.utime(symlink, (self.now, self.now), follow_symlinks=False)
+        self.assertEqual(self._victims(max_size=int(1.5 * 2**20)), ["a"])
+
+    def test_remove_trees(self):
+        self._add_entry("a", {"_target": "//common:a"}, 10, 2)
+        for i in range(100):
+            (self.cache_dir / f"a/common/dir{i}/sub").mkdir(parents=True)
+            (self.cache_dir / f"a/common/dir{i}/sub/file").touch()
+        trash_dir = self.temp_dir / "trash"
+        cache_dir_manager.move_to_trash(self.cache_dir / "a", trash_dir)
+        self.assertFalse((self.cache_dir / "a").exists())
+        cache_dir_manager.empty_trash(trash_dir, self.executor)
+        self.assertFalse(trash_dir.exists())
+
+    def test_remove_trees_keeps_going(self):
+        root = self.temp_dir / "trash"
+        for i in range(100):
+            (root / f"dir{i}").mkdir(parents=True)
+            (root / f"file{i}").touch()
+        unlink = os.unlink
+
+        def unlink_or_fail(path, *args, **kwargs):
+            if os.path.basename(path) == "file0":
+                raise PermissionError(path)
+            unlink(path, *args, **kwargs)
+
+        with mock.patch.object(os, "unlink", side_effect=unlink_or_fail):
+            cache_dir_manager.remove_trees([root], self.executor)
+        self.assertEqual(list(root.iterdir()), [root / "file0"])
+
+    def test_move_all_to_trash(self):
+        self._add_entry("a", {"_target": "//common:a"}, 10, 2)
+        (self.cache_dir / "last_build").symlink_to("a")
+        self.assertTrue(cache_dir_manager.move_all_to_trash(self.cache_dir))
+        self.assertEqual([path.name for path in self.cache_dir.iterdir()],
+                         [".kleaf_trash"])
+        cache_dir_manager.empty_trash(self.cache_dir / ".kleaf_trash",
+                                      self.executor)
+        self.assertEqual(list(self.cache_dir.iterdir()), [])
+        self.assertFalse(cache_dir_manager.move_all_to_trash(self.cache_dir))
+
+
+if __name__ == "__main__":
+    absltest.main()
@@ -39,17 +39,44 @@ _analyze_inputs_transition = transition(
     ],
 )
 
+def _index_gen_files_archives(ctx):
+    """Indexes names of files in gen_files_archives.
+
+    The indexes are only rebuilt when the archives change, so AnalyzeInputs
+    does not need to decompress the archives."""
+    gen_files_archives = depset(transitive = [t.files for t in ctx.attr.gen_files_archives])
+    indexes = []
+    for index, archive in enumerate(gen_files_archives.to_list()):
+        index_file = ctx.actions.declare_file("{}/gen_files_archive_indexes/{}_{}.names".format(
+            ctx.label.name,
+            index,
+            archive.basename,
+        ))
+        args = ctx.actions.args()
+        args.add("--index_archive", archive)
+        args.add("--out", index_file)
+        ctx.actions.run(
+            mnemonic = "AnalyzeInputsIndexArchive",
+            inputs = [archive],
+            outputs = [index_file],
+            executable = ctx.executable._analyze_inputs,
+            arguments = [args],
+            progress_message = "Indexing {} {}".format(archive.short_path, ctx.label),
+        )
+        indexes.append(index_file)
+    return indexes
+
 def _analyze_to_raw_paths(ctx):
     dirs = depset(transitive = [target[KernelCmdsInfo].directories for target in ctx.attr.deps])
     module_srcs = depset(transitive = [target[KernelCmdsInfo].srcs for target in ctx.attr.deps])
-    gen_files_archives = depset(transitive = [t.files for t in ctx.attr.gen_files_archives])
+    gen_files_archive_indexes = _index_gen_files_archives(ctx)
 
     raw_output = ctx.actions.declare_directory("{}/raw_output".format(ctx.label.name))
 
     args = ctx.actions.args()
     args.add_all("--include_filters", ctx.attr.include_filters)
     args.add_all("--exclude_filters", ctx.attr.exclude_filters)
-    args.add_all("--gen_files_archives", gen_files_archives)
+    args.add_all("--gen_files_archive_indexes", gen_files_archive_indexes)
     args.add("--out", raw_output.path)
     args.add_all("--dirs", dirs, expand_directories = False)
 
@@ -57,9 +84,13 @@ def _analyze_to_raw_paths(ctx):
     # not their content, for header analysis.
     args.add_all("--module_srcs", module_srcs)
 
+    # Bazel schedules the action as if it uses one CPU, so don't start more
+    # worker processes than that.
+    args.add("--jobs", "1")
+
     ctx.actions.run(
         mnemonic = "AnalyzeInputs",
-        inputs = depset(transitive = [dirs, gen_files_archives]),
+        inputs = depset(gen_files_archive_indexes, transitive = [dirs]),
         outputs = [raw_output],
         executable = ctx.executable._analyze_inputs,
         arguments = [args],
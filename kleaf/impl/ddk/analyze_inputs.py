@@ -14,8 +14,8 @@
 
 """Analyze the inputs from `.cmd` files"""
 import argparse
-import asyncio
 import collections
+import concurrent.futures
 import dataclasses
 import fnmatch
 import functools
@@ -24,16 +24,159 @@ import logging
 import operator
 import pathlib
 import os
-import shlex
 import re
 import tarfile
 from typing import Iterable, Optional, Any
 
+import sharding
+
 # Regex to parse .cmd files. Each section has the format of:
 # dep_foo := \
 #   a.h \
 #   b.h
 _RE = r"^(?P<key>\S*?)\s*:=(?P<values>((\\\n| |\t)+(\S*))*)"
+_CMD_FILE_RE = re.compile(_RE, re.MULTILINE)
+
+# A word of a command line, split as shlex.split() does.
+_CMD_WORD_RE = re.compile(r"""(?:[^ \t\r\n'"\\]+|'[^']*'|"(?:[^"\\]|\\.)*"|\\.)+""",
+                          re.DOTALL)
+_CMD_WHITESPACE_RE = re.compile(r"[ \t\r\n]*")
+# A quoted or escaped part of a word.
+_CMD_QUOTED_RE = re.compile(r"""'([^']*)'|"((?:[^"\\]|\\.)*)"|\\(.)""", re.DOTALL)
+# In double quotes, only quotes and backslashes are escaped.
+_CMD_DOUBLE_QUOTED_ESCAPE_RE = re.compile(r'\\(["\\])')
+
+# The AnalyzeInputs object of a worker process.
+_worker_analyze_inputs: Optional["AnalyzeInputs"] = None
+
+
+def _compile_filters(filters: list[str]) -> Optional[re.Pattern]:
+    """Compiles glob patterns into one regex that matches any of them.
+
+    Returns None if there are no patterns, which matches nothing.
+    """
+    if not filters:
+        return None
+    return re.compile("|".join(fnmatch.translate(f) for f in filters))
+
+
+def _unquote(mo: re.Match) -> str:
+    single_quoted, double_quoted, escaped = mo.groups()
+    if single_quoted is not None:
+        return single_quoted
+    if double_quoted is not None:
+        return _CMD_DOUBLE_QUOTED_ESCAPE_RE.sub(r"\1", double_quoted)
+    return escaped
+
+
+def _split_cmd(cmd: str) -> list[str]:
+    """Splits a command line into words like shlex.split(), in linear time."""
+    words = []
+    pos = _CMD_WHITESPACE_RE.match(cmd).end()
+    while pos < len(cmd):
+        mo = _CMD_WORD_RE.match(cmd, pos)
+        if mo is None:
+            raise ValueError(f"No closing quotation or escaped character: {cmd}")
+        word = mo.group()
+        if "'" in word or '"' in word or "\\" in word:
+            word = _CMD_QUOTED_RE.sub(_unquote, word)
+        words.append(word)
+        pos = _CMD_WHITESPACE_RE.match(cmd, mo.end()).end()
+    return words
+
+
+@dataclasses.dataclass
+class _IncludeFlags(object):
+    """Include flags of a compiler command line."""
+    include_dirs: list[str] = dataclasses.field(default_factory=list)
+    system_include_dirs: list[str] = dataclasses.field(default_factory=list)
+    include_files: list[str] = dataclasses.field(default_factory=list)
+    sysroot: Optional[str] = None
+
+
+def _get_include_flags(args: list[str]) -> _IncludeFlags:
+    """Returns -I, -isystem, -include and --sysroot in compiler arguments.
+
+    Values may be separate arguments, or joined with the flag as
+    -I<dir>, -isystem<dir>, -I=<dir>, -include=<file> or --sysroot=<dir>.
+    """
+    ret = _IncludeFlags()
+    args_iter = iter(args)
+    for arg in args_iter:
+        if not arg.startswith("-"):
+            continue
+        if arg == "--":
+            break
+        if arg in ("-I", "-isystem", "-include", "--sysroot"):
+            flag, value = arg, next(args_iter, None)
+            if value is None:
+                break
+        elif arg.startswith("-I"):
+            flag, value = "-I", arg[2:].removeprefix("=")
+        elif arg.startswith("-isystem"):
+            flag, value = "-isystem", arg[len("-isystem"):]
+        elif arg.startswith("-include="):
+            flag, value = "-include", arg[len("-include="):]
+        elif arg.startswith("--sysroot="):
+            flag, value = "--sysroot", arg[len("--sysroot="):]
+        else:
+            continue
+
+        if flag == "-include":
+            ret.include_files.append(value)
+        elif flag == "--sysroot":
+            ret.sysroot = value
+        elif flag == "-isystem":
+            ret.system_include_dirs.append(value)
+        else:
+            ret.include_dirs.append(value)
+    return ret
+
+
+def write_archive_index(archive: pathlib.Path, index: pathlib.Path):
+    """Writes the sorted, normalized names of files in an archive to index.
+
+    The index has one name per line.
+    """
+    with tarfile.open(archive) as tar:
+        names = sorted(set(os.path.normpath(name) for name in tar.getnames()))
+    tmp_index = index.with_name(f"{index.name}.{os.getpid()}.tmp")
+    with open(tmp_index, "w") as f:
+        for name in names:
+            f.write(f"{name}\n")
+    os.replace(tmp_index, index)
+
+
+def read_archive_index(index: pathlib.Path) -> frozenset[pathlib.Path]:
+    """Returns the names of files in an index from write_archive_index."""
+    with open(index) as f:
+        return frozenset(pathlib.Path(name) for name in f.read().splitlines())
+
+
+def get_archive_index_path(archive: pathlib.Path) -> pathlib.Path:
+    return archive.with_name(f"{archive.name}.names")
+
+
+def load_archive_names(archive: pathlib.Path) -> frozenset[pathlib.Path]:
+    """Returns the names of files in an archive.
+
+    The names are cached in an index beside the archive, so later calls
+    don't decompress it, until the archive is modified.
+    """
+    index = get_archive_index_path(archive)
+    try:
+        if index.stat().st_mtime_ns >= archive.stat().st_mtime_ns:
+            return read_archive_index(index)
+    except FileNotFoundError:
+        pass
+    try:
+        write_archive_index(archive, index)
+        return read_archive_index(index)
+    except OSError:
+        # The directory of the archive is read-only.
+        with tarfile.open(archive) as tar:
+            return frozenset(pathlib.Path(os.path.normpath(name))
+                             for name in tar.getnames())
 
 
 def _make_rel(path: pathlib.Path):
@@ -48,11 +191,15 @@ class IncludeData(object):
     include_dirs: set[pathlib.Path] = dataclasses.field(default_factory=set)
     include_files: set[pathlib.Path] = dataclasses.field(default_factory=set)
     unresolved: set[pathlib.Path] = dataclasses.field(default_factory=set)
+    # From -isystem, e.g. the builtin headers of the compiler. They are not
+    # in ddk_headers, so gen_ddk_headers ignores them.
+    system_include_dirs: set[pathlib.Path] = dataclasses.field(default_factory=set)
 
     def __ior__(self, other):
         self.include_dirs |= other.include_dirs
         self.include_files |= other.include_files
         self.unresolved |= other.unresolved
+        self.system_include_dirs |= other.system_include_dirs
         return self
 
     def to_dict(self) -> dict[str, list[str]]:
@@ -67,43 +214,58 @@ class AnalyzeInputs(object):
     def __init__(self, out: pathlib.Path, dirs: list[pathlib.Path],
                  module_srcs: list[pathlib.Path],
                  include_filters: list[str], exclude_filters: list[str],
-                 gen_files_archives: list[tarfile.TarFile], **ignored):
+                 gen_files_archives: list[pathlib.Path],
+                 gen_files_archive_indexes: Iterable[pathlib.Path] = (),
+                 jobs: Optional[int] = None, **ignored):
         self._out = out
         self._dirs = dirs
-        self._include_filters = include_filters
-        self._exclude_filters = exclude_filters
+        self._include_re = _compile_filters(include_filters)
+        self._exclude_re = _compile_filters(exclude_filters)
+        # Many objects share the same headers, so memoize filtering.
+        self._filtered_deps: dict[str, Optional[pathlib.Path]] = {}
         self._module_srcs = set(module_srcs)
         self._unresolved: set[pathlib.Path] = set()
+        self._jobs = jobs or sharding.get_default_jobs()
 
-        self._cmd_parser = argparse.ArgumentParser()
-        self._cmd_parser.add_argument("-I", type=pathlib.Path, action="append", default=[])
-        self._cmd_parser.add_argument("-include", type=pathlib.Path, action="append", default=[])
-        self._cmd_parser.add_argument("--sysroot", type=pathlib.Path)
+        # Many objects share the same command line, so memoize parsing.
+        self._parsed_cmds: dict[str, IncludeData] = {}
 
-        self._archived_input_names: set[pathlib.Path] = set()
-        for archive in gen_files_archives:
-            names = archive.getnames()
-            paths = set(pathlib.Path(os.path.normpath(name)) for name in names)
-            self._archived_input_names.update(paths)
+        self._archived_input_names: frozenset[pathlib.Path] = frozenset().union(
+            *(read_archive_index(index) for index in gen_files_archive_indexes),
+            *(load_archive_names(archive) for archive in gen_files_archives))
 
-    async def run(self):
+    def run(self):
         self._out.mkdir(parents=True, exist_ok=True)
-        aws = []
+        paths = []
         for dir in self._dirs:
             for root, _, files in os.walk(dir):
                 root_path = pathlib.Path(root)
                 for filename in files:
-                    aws.append(self._write_deps(root_path / filename))
-
-        await asyncio.gather(*aws)
-
-    async def _write_deps(self, path: pathlib.Path):
-        deps = self._get_deps(path)
-        stem = self._out / _make_rel(path)
-        stem.parent.mkdir(parents=True, exist_ok=True)
-        with open(stem.with_suffix(".json"), "w") as file:
-            json.dump(deps.to_dict(), file, indent=2)
-
+                    paths.append(root_path / filename)
+
+        if self._jobs == 1 or len(paths) <= 1:
+            self._write_deps_of_shard(paths)
+            return
+
+        shards = [paths[shard] for shard in sharding.get_shards(len(paths), self._jobs)]
+        with concurrent.futures.ProcessPoolExecutor(
+                max_workers=self._jobs,
+                initializer=_init_worker,
+                initargs=(self, logging.getLogger().level)) as executor:
+            for future in [executor.submit(_write_deps_of_shard, shard)
+                           for shard in shards]:
+                future.result()
+
+    def _write_deps_of_shard(self, paths: list[pathlib.Path]):
+        created_dirs: set[pathlib.Path] = set()
+        for path in paths:
+            deps = self._get_deps(path)
+            stem = self._out / _make_rel(path)
+            if stem.parent not in created_dirs:
+                stem.parent.mkdir(parents=True, exist_ok=True)
+                created_dirs.add(stem.parent)
+            with open(stem.with_suffix(".json"), "w") as file:
+                file.write(json.dumps(deps.to_dict(), indent=2))
 
     def _get_deps(self, path: pathlib.Path) -> IncludeData:
         ret = IncludeData()
@@ -111,7 +273,7 @@ class AnalyzeInputs(object):
         deps = dict()
         cmds = dict()
         with open(path) as f:
-            for mo in re.finditer(_RE, f.read(), re.MULTILINE):
+            for mo in _CMD_FILE_RE.finditer(f.read()):
                 key = mo.group("key")
                 if key.startswith("deps_"):
                     deps[key.removeprefix("deps_")] = mo.group("values")
@@ -130,35 +292,55 @@ class AnalyzeInputs(object):
             dep_str = dep_str.strip()
             if not dep_str:
                 continue
-            if dep_str.startswith("$(wildcard") or dep_str.endswith(")"):
-                # Ignore wildcards; we don't need them for headers analysis
-                continue
-
-            for exclude_filter in self._exclude_filters:
-                if fnmatch.fnmatch(dep_str, exclude_filter):
-                    continue
-
-            should_include = any(fnmatch.fnmatch(dep_str, i) for i in self._include_filters)
-            should_exclude = any(fnmatch.fnmatch(dep_str, i) for i in self._exclude_filters)
-
-            if should_include and not should_exclude:
-                yield pathlib.Path(dep_str)
+            try:
+                dep = self._filtered_deps[dep_str]
+            except KeyError:
+                dep = self._filter_dep(dep_str)
+                self._filtered_deps[dep_str] = dep
+            if dep is not None:
+                yield dep
+
+    def _filter_dep(self, dep_str: str) -> Optional[pathlib.Path]:
+        if dep_str.startswith("$(wildcard") or dep_str.endswith(")"):
+            # Ignore wildcards; we don't need them for headers analysis
+            return None
+
+        should_include = self._include_re is not None and \
+            self._include_re.match(dep_str) is not None
+        should_exclude = self._exclude_re is not None and \
+            self._exclude_re.match(dep_str) is not None
+
+        if should_include and not should_exclude:
+            return pathlib.Path(dep_str)
+        return None
 
     def _parse_cmd(self, cmd: Optional[str]) -> IncludeData:
+        """Returns include flags of clang commands in cmd.
+
+        The returned object is shared between calls and must not be modified.
+        """
         if not cmd:
             return IncludeData()
 
+        ret = self._parsed_cmds.get(cmd)
+        if ret is not None:
+            return ret
+
         ret = IncludeData()
         # Simple cmd parser
         for one_cmd in cmd.split(";"):
-            tokens = shlex.split(one_cmd)
+            tokens = _split_cmd(one_cmd)
             if not tokens or "clang" not in pathlib.Path(tokens[0]).name:
                 continue
-            known, _ = self._cmd_parser.parse_known_args(tokens[1:])
-            ret.include_files |= set(known.include)
-            ret.include_dirs |= set(AnalyzeInputs._resolve_path(dir) for dir in known.I)
-            if known.sysroot:
-                ret.include_dirs.add(AnalyzeInputs._resolve_path(known.sysroot))
+            flags = _get_include_flags(tokens[1:])
+            ret.include_files |= set(pathlib.Path(file) for file in flags.include_files)
+            ret.include_dirs |= set(AnalyzeInputs._resolve_path(pathlib.Path(dir))
+                                    for dir in flags.include_dirs)
+            ret.system_include_dirs |= set(AnalyzeInputs._resolve_path(pathlib.Path(dir))
+                                           for dir in flags.system_include_dirs)
+            if flags.sysroot:
+                ret.include_dirs.add(AnalyzeInputs._resolve_path(pathlib.Path(flags.sysroot)))
+        self._parsed_cmds[cmd] = ret
         return ret
 
     def _resolve_files(self, deps: Iterable[pathlib.Path], cmd: Optional[str],
@@ -191,9 +373,11 @@ class AnalyzeInputs(object):
 
                 logging.warning("%s: Unknown dep %s", cmd_file_path, dep)
                 unresolved.add(dep)
-        return IncludeData(cmd_parse_data.include_dirs, ret_deps, unresolved)
+        return IncludeData(cmd_parse_data.include_dirs, ret_deps, unresolved,
+                           system_include_dirs=cmd_parse_data.system_include_dirs)
 
     @staticmethod
+    @functools.lru_cache(maxsize=None)
     def _resolve_path(path: pathlib.Path):
         if path.parts[0] == "${ROOT_DIR}":
             path = pathlib.Path(*path.parts[1:]).resolve().relative_to(
@@ -201,20 +385,42 @@ class AnalyzeInputs(object):
         return path
 
 
+def _init_worker(analyze_inputs: AnalyzeInputs, log_level: int):
+    global _worker_analyze_inputs
+    _worker_analyze_inputs = analyze_inputs
+    logging.basicConfig(level=log_level, format="%(levelname)s: %(message)s")
+
+
+def _write_deps_of_shard(paths: list[pathlib.Path]):
+    _worker_analyze_inputs._write_deps_of_shard(paths)
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description=__doc__)
-    parser.add_argument("--out", type=pathlib.Path, required=True)
+    parser.add_argument("--out", type=pathlib.Path, required=True,
+                        help="Output directory; or with --index_archive, the index file.")
     parser.add_argument("--dirs", type=pathlib.Path, nargs="*", default=[])
     parser.add_argument("-v", "--verbose", action="store_true", default=False)
     parser.add_argument("--include_filters", nargs="*", default=["*"])
     parser.add_argument("--exclude_filters", nargs="*", default=[])
-    parser.add_argument("--gen_files_archives", type=tarfile.open, nargs="*", default=[],
+    parser.add_argument("--gen_files_archives", type=pathlib.Path, nargs="*", default=[],
                         help="List of tar of generated files. Generated files are not considered"
-                            "as inputs to a target.")
+                            "as inputs to a target. Names in each archive are cached in "
+                            "<archive>.names if possible.")
+    parser.add_argument("--gen_files_archive_indexes", type=pathlib.Path, nargs="*", default=[],
+                        help="Like --gen_files_archives, but indexes written by --index_archive.")
+    parser.add_argument("--index_archive", type=pathlib.Path,
+                        help="If set, only write the names of files in this archive to --out.")
     parser.add_argument("--module_srcs", type=pathlib.Path, nargs="*", default=[])
+    parser.add_argument("--jobs", type=int,
+                        help="Number of worker processes. Defaults to the number of CPUs "
+                             "this process may run on.")
 
     args = parser.parse_args()
     log_level = logging.DEBUG if args.verbose else logging.INFO
     logging.basicConfig(level=log_level, format="%(levelname)s: %(message)s")
 
-    asyncio.run(AnalyzeInputs(**vars(parser.parse_args())).run())
+    if args.index_archive:
+        write_archive_index(args.index_archive, args.out)
+    else:
+        AnalyzeInputs(**vars(args)).run()
@@ -0,0 +1,230 @@
+# Copyright (C) 2024 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for analyze_inputs."""
+
+import argparse
+import fnmatch
+import io
+import json
+import os
+import pathlib
+import random
+import shlex
+import tarfile
+import tempfile
+import unittest
+
+from absl.testing import absltest
+import analyze_inputs
+from analyze_inputs import AnalyzeInputs
+
+_CMD_FILE = """\
+cmd_{module}/{name}.o := clang -Wp,-MMD,{module}/.{name}.o.d -nostdinc \
+-I${{ROOT_DIR}}/common/include -I./include -isystem ${{ROOT_DIR}}/prebuilts/include \
+-include ${{ROOT_DIR}}/common/include/linux/kconfig.h \
+--sysroot=${{ROOT_DIR}}/prebuilts/sysroot '-DKBUILD_MODNAME="{name}"' \
+-c -o {module}/{name}.o ${{ROOT_DIR}}/{module}/{name}.c; \
+echo done
+
+source_{module}/{name}.o := ${{ROOT_DIR}}/{module}/{name}.c
+
+deps_{module}/{name}.o := \\
+  ${{ROOT_DIR}}/{module}/{name}.c \\
+  ${{ROOT_DIR}}/common/include/linux/kconfig.h \\
+    $(wildcard include/config/FOO) \\
+  ${{ROOT_DIR}}/{module}/{name}.h \\
+  include/generated/autoconf.h \\
+  arch/arm64/include/generated/asm/gen.h \\
+  /usr/include/stdio.h \\
+
+{module}/{name}.o: $(deps_{module}/{name}.o)
+
+$(deps_{module}/{name}.o):
+"""
+
+
+class AnalyzeInputsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = pathlib.Path(
+            self.enterContext(tempfile.TemporaryDirectory()))
+        self.cmd_dir = self.temp_dir / "cmds"
+        for module in ("vendor/a", "vendor/b"):
+            (self.cmd_dir / module).mkdir(parents=True)
+            for name in ("x", "y", "z"):
+                (self.cmd_dir / module / f".{name}.o.cmd").write_text(
+                    _CMD_FILE.format(module=module, name=name))
+
+    def _run(self, out: pathlib.Path, jobs: int,
+             **kwargs) -> dict[str, str]:
+        AnalyzeInputs(
+            out=out,
+            dirs=[self.cmd_dir],
+            module_srcs=[pathlib.Path("vendor/a/x.h"),
+                         pathlib.Path("common/include/linux/kconfig.h")],
+            include_filters=["*.h"],
+            exclude_filters=["include/generated/*"],
+            gen_files_archives=kwargs.pop("gen_files_archives", []),
+            jobs=jobs,
+            **kwargs,
+        ).run()
+        return {str(path.relative_to(out)): path.read_text()
+                for path in out.rglob("*.json")}
+
+    def test_deps(self):
+        with self.assertLogs(level="WARNING"):
+            outputs = self._run(self.temp_dir / "out", jobs=1)
+        prefix = str(self.cmd_dir.relative_to("/"))
+        self.assertEqual(json.loads(outputs[f"{prefix}/vendor/a/.x.o.json"]), {
+            "include_dirs": ["common/include", "include",
+                             "prebuilts/sysroot"],
+            "include_files": ["common/include/linux/kconfig.h",
+                              "vendor/a/x.h"],
+            "unresolved": ["/usr/include/stdio.h",
+                           "arch/arm64/include/generated/asm/gen.h"],
+            "system_include_dirs": ["prebuilts/include"],
+        })
+        self.assertEqual(
+            json.loads(outputs[f"{prefix}/vendor/b/.y.o.json"])["unresolved"],
+            ["${ROOT_DIR}/vendor/b/y.h", "/usr/include/stdio.h",
+             "arch/arm64/include/generated/asm/gen.h"])
+
+    def test_parallel_same_as_serial(self):
+        with self.assertLogs(level="WARNING"):
+            serial = self._run(self.temp_dir / "serial", jobs=1)
+        parallel = self._run(self.temp_dir / "parallel", jobs=3)
+        self.assertEqual(len(serial), 6)
+        self.assertEqual(serial, parallel)
+
+    def _write_archive(self, names: list[str]) -> pathlib.Path:
+        archive = self.temp_dir / "gen_files.tar.gz"
+        with tarfile.open(archive, "w:gz") as tar:
+            for name in names:
+                tar.addfile(tarfile.TarInfo(name), io.BytesIO())
+        return archive
+
+    def test_gen_files_archive_indexes(self):
+        archive = self._write_archive(
+            ["./arch/arm64/include/generated/asm/gen.h", "other.h"])
+        index = self.temp_dir / "gen_files.names"
+        analyze_inputs.write_archive_index(archive, index)
+        self.assertEqual(index.read_text(),
+                         "arch/arm64/include/generated/asm/gen.h\nother.h\n")
+
+        with self.assertLogs(level="WARNING"):
+            outputs = self._run(self.temp_dir / "out", jobs=1,
+                                gen_files_archive_indexes=[index])
+        prefix = str(self.cmd_dir.relative_to("/"))
+        self.assertEqual(
+            json.loads(outputs[f"{prefix}/vendor/a/.x.o.json"])["unresolved"],
+            ["/usr/include/stdio.h"])
+
+    def test_load_archive_names(self):
+        archive = self._write_archive(["a.h", "./dir/b.h"])
+        self.assertEqual(analyze_inputs.load_archive_names(archive),
+                         {pathlib.Path("a.h"), pathlib.Path("dir/b.h")})
+        index = analyze_inputs.get_archive_index_path(archive)
+        self.assertTrue(index.exists())
+
+        # The index is used while it is newer than the archive.
+        index.write_text("c.h\n")
+        self.assertEqual(analyze_inputs.load_archive_names(archive),
+                         {pathlib.Path("c.h")})
+
+        os.utime(index, ns=(0, 0))
+        self.assertEqual(analyze_inputs.load_archive_names(archive),
+                         {pathlib.Path("a.h"), pathlib.Path("dir/b.h")})
+
+    def test_filter_deps(self):
+        deps = ["a.h", "include/generated/a.h", "include/b.h", "c.c",
+                "include/x[1].h", "$(wildcard include/config/FOO)", "d.h)",
+                "  ", "include/generated/sub/e.hh"]
+        for include_filters, exclude_filters in (
+            (["*.h"], ["include/generated/*"]),
+            (["*.h", "*.c"], []),
+            (["include/?.h", "*[0-9]*"], ["*.c"]),
+            ([], ["*"]),
+            (["*"], []),
+        ):
+            analyzer = AnalyzeInputs(
+                out=self.temp_dir, dirs=[], module_srcs=[],
+                include_filters=include_filters,
+                exclude_filters=exclude_filters, gen_files_archives=[])
+            expected = [
+                pathlib.Path(dep) for dep in deps
+                if dep.strip() and not dep.startswith("$(wildcard") and
+                not dep.endswith(")") and
+                any(fnmatch.fnmatch(dep, f) for f in include_filters) and
+                not any(fnmatch.fnmatch(dep, f) for f in exclude_filters)
+            ]
+            # Twice, so that memoized results are also checked.
+            for _ in range(2):
+                self.assertEqual(list(analyzer._filter_deps(deps)),
+                                 expected, (include_filters, exclude_filters))
+
+
+class SplitCmdTest(unittest.TestCase):
+
+    def test_split_cmd(self):
+        for cmd in (
+            "",
+            "  ",
+            "clang -c -o a.o a.c",
+            " clang\t-I a \n-Ib  ",
+            "clang '-DKBUILD_MODNAME=\"a b\"' -DX=\\\"y\\\"",
+            "a '' \"\" b",
+            "a\\ b \"c\\d\" 'e\\f' \"g\\\"h\\\\i\"",
+            "a'b'\"c\"d 'x\"y' \"x'y\"",
+            "a\\\nb \"c\\\nd\"",
+        ):
+            self.assertEqual(analyze_inputs._split_cmd(cmd), shlex.split(cmd),
+                             cmd)
+
+    def test_split_cmd_random(self):
+        rand = random.Random(0)
+        for _ in range(2000):
+            cmd = "".join(rand.choice("ab -I=\\'\" \t\n") for _ in range(20))
+            try:
+                expected = shlex.split(cmd)
+            except ValueError:
+                with self.assertRaises(ValueError, msg=cmd):
+                    analyze_inputs._split_cmd(cmd)
+                continue
+            self.assertEqual(analyze_inputs._split_cmd(cmd), expected, cmd)
+
+    def test_include_flags(self):
+        # As parsed by argparse before.
+        parser = argparse.ArgumentParser()
+        parser.add_argument("-I", action="append", default=[])
+        parser.add_argument("-include", action="append", default=[])
+        parser.add_argument("--sysroot")
+        args = ["-I", "a", "-Ib", "-I=c", "-Id=e", "-include", "f.h",
+                "-include=g.h", "--sysroot", "h", "-Wp,-MMD,x.d", "-o", "x.o",
+                "-DI=1", "x.c", "--sysroot=i"]
+        flags = analyze_inputs._get_include_flags(args)
+        known, _ = parser.parse_known_args(args)
+        self.assertEqual(flags.include_dirs, known.I)
+        self.assertEqual(flags.include_files, known.include)
+        self.assertEqual(flags.sysroot, known.sysroot)
+
+    def test_isystem(self):
+        flags = analyze_inputs._get_include_flags(
+            ["-isystem", "a", "-isystemb", "-I", "c"])
+        self.assertEqual(flags.include_dirs, ["c"])
+        self.assertEqual(flags.system_include_dirs, ["a", "b"])
+
+
+if __name__ == "__main__":
+    absltest.main()
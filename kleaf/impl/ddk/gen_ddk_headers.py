@@ -14,21 +14,38 @@
 
 import argparse
 import collections
+import concurrent.futures
 import dataclasses
 import json
 import logging
 import os
 import pathlib
 import re
+import stat
 import sys
+import time
 from typing import Sequence, Optional, Iterable, Any, NoReturn, Callable
 
 from build.kernel.kleaf import buildozer_command_builder
+import sharding
 
 Paths = set[pathlib.Path]
 PathsWithCompUnitType = dict[pathlib.Path, Paths]
 PathsWithCompUnit = lambda: collections.defaultdict(set)
 
+# Kinds of paths in outputs of analyze_inputs. system_include_dirs, e.g. the
+# builtin headers of the compiler, are not in ddk_headers, so they are ignored.
+_KINDS = ("include_dirs", "include_files", "unresolved")
+
+_DEFAULT_CACHE = pathlib.Path("out/gen_ddk_headers/inputs_cache.json")
+
+# Bump when the format of the cache changes.
+_CACHE_VERSION = 1
+
+# Inputs modified this recently are not cached. See _RACY_MTIME_NS in
+# kleaf/kernel_sbom.py.
+_RACY_MTIME_NS = 2_000_000_000
+
 
 def merge_paths_with_sources(self: PathsWithCompUnitType, other: PathsWithCompUnitType) \
         -> PathsWithCompUnitType:
@@ -94,6 +111,40 @@ class Numfiles(object):
         return sum([len(files) for _, _, files in os.walk(self._path)])
 
 
+class _PathResolver(object):
+    """Resolves paths relative to a root directory, like resolve(strict=True).
+
+    Results are memoized for each path and its parent directories, so
+    directories shared by many paths are only looked up once.
+    """
+
+    def __init__(self, root: pathlib.Path):
+        self._resolved: dict[pathlib.Path, Optional[pathlib.Path]] = {
+            pathlib.Path(): root.resolve(strict=True),
+        }
+
+    def resolve(self, path: pathlib.Path) -> Optional[pathlib.Path]:
+        """Returns the real path of root / path, or None if it does not exist."""
+        if path in self._resolved:
+            return self._resolved[path]
+
+        parent = self.resolve(path.parent)
+        if parent is None:
+            ret = None
+        elif path.name == "..":
+            ret = parent.parent
+        else:
+            ret = parent / path.name
+            try:
+                if stat.S_ISLNK(os.lstat(ret).st_mode):
+                    ret = ret.resolve(strict=True)
+            except FileNotFoundError:
+                ret = None
+
+        self._resolved[path] = ret
+        return ret
+
+
 class GenDdkHeaders(buildozer_command_builder.BuildozerCommandBuilder):
     def __init__(self, include_data: IncludeDataWithSource,
                  *init_args, **init_kwargs):
@@ -115,14 +166,13 @@ class GenDdkHeaders(buildozer_command_builder.BuildozerCommandBuilder):
                 self._outside[dep] |= value
                 continue
 
-            try:
-                dep = (self._workspace_root() / dep).resolve(strict=True).relative_to(self._workspace_root())
-            except FileNotFoundError:
+            resolved = self._resolver.resolve(dep)
+            if resolved is None:
                 logging.debug("Missing dep: %s", dep)
                 self._missing[dep] |= value
                 continue
 
-            ret[dep] = value
+            ret[resolved.relative_to(self._workspace_root())] = value
         return ret
 
     def _calc(self):
@@ -141,6 +191,7 @@ class GenDdkHeaders(buildozer_command_builder.BuildozerCommandBuilder):
 
         self._outside: PathsWithCompUnitType = PathsWithCompUnit()
         self._missing: PathsWithCompUnitType = PathsWithCompUnit()
+        self._resolver = _PathResolver(self._workspace_root())
 
         self._handle_unresolved()
 
@@ -369,30 +420,128 @@ def parse_args(argv: Sequence[str]) -> argparse.Namespace:
                         choices=("aarch64", "x86_64"),
                         help="""Architecture of the target. This controls the name of the generated
                                 ddk_headers target.""")
+    parser.add_argument("--jobs", type=int,
+                        help="Number of worker processes to load --input with. Defaults to the "
+                             "number of CPUs this process may run on.")
+    parser.add_argument("--cache", type=pathlib.Path, default=_DEFAULT_CACHE,
+                        help="""JSON file to cache the merged --input across runs, relative to
+                                the workspace root. It is used if no file in --input has
+                                changed.""")
+    parser.add_argument("--nocache", dest="cache", action="store_const", const=None,
+                        help="Load --input without a cache.")
     return parser.parse_args(argv)
 
 
-def get_all_files_and_includes(path: pathlib.Path) -> IncludeDataWithSource:
-    """Merge all from args.input, tracking the source too. Return values are un-sanitized."""
+def _load_shard(files: list[str]) -> dict[str, dict[str, list[int]]]:
+    """Loads outputs of analyze_inputs.
+
+    Returns:
+        For each kind of paths, a dictionary from each path to the indexes
+        in files of the outputs that contain it.
+    """
+    ret = {kind: collections.defaultdict(list) for kind in _KINDS}
+    for index, file in enumerate(files):
+        with open(file) as f:
+            d = json.load(f)
+        for kind, sources in ret.items():
+            for item in d[kind]:
+                sources[item].append(index)
+    return ret
+
+
+def _load_all(files: list[str], jobs: int) -> dict[str, dict[str, list[int]]]:
+    """Like _load_shard, but loads shards of files in parallel."""
+    if jobs == 1 or len(files) <= 1:
+        return _load_shard(files)
+
+    shards = sharding.get_shards(len(files), jobs)
+    ret = {kind: dict() for kind in _KINDS}
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        loaded_shards = executor.map(_load_shard, [files[shard] for shard in shards])
+        for shard, loaded_shard in zip(shards, loaded_shards):
+            for kind, sources in loaded_shard.items():
+                merged = ret[kind]
+                for item, indexes in sources.items():
+                    merged.setdefault(item, []).extend(shard.start + index for index in indexes)
+    return ret
+
+
+def _load_cache(cache: pathlib.Path, stats: list[list]) -> Optional[dict[str, Any]]:
+    """Returns the merged inputs in cache if they are from the same files."""
+    try:
+        with open(cache) as f:
+            snapshot = json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return None
+    if not isinstance(snapshot, dict) or snapshot.get("version") != _CACHE_VERSION:
+        return None
+    if snapshot.get("files") != stats:
+        return None
+    return snapshot
+
+
+def _save_cache(cache: pathlib.Path, snapshot: dict[str, Any]):
+    cache.parent.mkdir(parents=True, exist_ok=True)
+    tmp_cache = cache.with_name(f"{cache.name}.{os.getpid()}")
+    with open(tmp_cache, "w") as f:
+        json.dump(snapshot, f)
+    os.replace(tmp_cache, cache)
+
+
+def get_all_files_and_includes(path: pathlib.Path, jobs: Optional[int] = None,
+                               cache: Optional[pathlib.Path] = None) -> IncludeDataWithSource:
+    """Merge all from args.input, tracking the source too. Return values are un-sanitized.
+
+    Args:
+        path: output file or directory of analyze_inputs
+        jobs: number of worker processes to load files with. Defaults to the number of CPUs
+          this process may run on.
+        cache: JSON file to cache the merged inputs across runs. It is used if the inode,
+          mtime and size of all files are unchanged. If None, nothing is cached.
+    """
     if path.is_file():
         with open(path) as f:
             return IncludeDataWithSource.from_dict(json.load(f), path)
-    if path.is_dir():
-        ret = IncludeDataWithSource()
-        for root, _, files in os.walk(path):
-            for file in files:
-                with open(pathlib.Path(root, file)) as f:
-                    ret |= IncludeDataWithSource.from_dict(json.load(f), pathlib.Path(root, file))
-        return ret
-
-    die("Unknown file %s", path)
+    if not path.is_dir():
+        die("Unknown file %s", path)
+
+    start_ns = time.time_ns()
+    files = sorted(os.path.join(root, file) for root, _, files in os.walk(path) for file in files)
+    stats = []
+    for file in files:
+        file_stat = os.stat(file)
+        stats.append([file, file_stat.st_ino, file_stat.st_mtime_ns, file_stat.st_size])
+
+    snapshot = _load_cache(cache, stats) if cache else None
+    if snapshot is None:
+        snapshot = _load_all(files, jobs or sharding.get_default_jobs())
+        snapshot["version"] = _CACHE_VERSION
+        snapshot["files"] = stats
+        if cache and all(file_stat[2] < start_ns - _RACY_MTIME_NS for file_stat in stats):
+            _save_cache(cache, snapshot)
+
+    # Many outputs share the same paths, so only create one Path for each.
+    paths: dict[str, pathlib.Path] = dict()
+    sources = [pathlib.Path(file) for file in files]
+    ret = IncludeDataWithSource()
+    for kind in _KINDS:
+        merged = getattr(ret, kind)
+        for item, indexes in snapshot[kind].items():
+            item_path = paths.get(item)
+            if item_path is None:
+                item_path = paths[item] = pathlib.Path(item)
+            merged[item_path].update(map(sources.__getitem__, indexes))
+    return ret
 
 
 def main(argv: Sequence[str]):
     args = parse_args(argv)
     log_level = logging.INFO if args.verbose else logging.WARNING
     logging.basicConfig(level=log_level, format="%(levelname)s: %(message)s")
-    include_data = get_all_files_and_includes(args.input)
+    # Under `bazel run`, the working directory is in runfiles.
+    workspace_root = pathlib.Path(os.environ.get("BUILD_WORKSPACE_DIRECTORY", os.getcwd()))
+    include_data = get_all_files_and_includes(
+        args.input, jobs=args.jobs, cache=args.cache and workspace_root / args.cache)
     GenDdkHeaders(args=args, include_data=include_data).run()
 
 
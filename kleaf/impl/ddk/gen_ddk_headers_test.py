@@ -0,0 +1,216 @@
+# Copyright (C) 2024 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for gen_ddk_headers."""
+
+import json
+import os
+import pathlib
+import tempfile
+import unittest
+from unittest import mock
+
+from absl.testing import absltest
+from analyze_inputs import AnalyzeInputs
+import gen_ddk_headers
+from gen_ddk_headers import IncludeDataWithSource
+
+
+def _merge_serially(path: pathlib.Path) -> IncludeDataWithSource:
+    """Merges outputs of analyze_inputs as gen_ddk_headers used to."""
+    ret = IncludeDataWithSource()
+    for root, _, files in os.walk(path):
+        for file in files:
+            with open(pathlib.Path(root, file)) as f:
+                ret |= IncludeDataWithSource.from_dict(json.load(f), pathlib.Path(root, file))
+    return ret
+
+
+# Like a .cmd file of a real kernel build, with the builtin headers of clang.
+_CMD_FILE = """\
+cmd_vendor/a/x.o := ${ROOT_DIR}/prebuilts/clang/host/linux-x86/clang-r510928/bin/clang \
+-Wp,-MMD,vendor/a/.x.o.d -nostdinc \
+-I${ROOT_DIR}/common/include \
+-isystem ${ROOT_DIR}/prebuilts/clang/host/linux-x86/clang-r510928/lib/clang/18/include \
+-include ${ROOT_DIR}/common/include/linux/kconfig.h \
+-c -o vendor/a/x.o ${ROOT_DIR}/vendor/a/x.c
+
+source_vendor/a/x.o := ${ROOT_DIR}/vendor/a/x.c
+
+deps_vendor/a/x.o := \\
+  ${ROOT_DIR}/vendor/a/x.c \\
+  ${ROOT_DIR}/common/include/linux/kconfig.h \\
+
+vendor/a/x.o: $(deps_vendor/a/x.o)
+
+$(deps_vendor/a/x.o):
+"""
+
+
+class GetAllFilesAndIncludesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = pathlib.Path(
+            self.enterContext(tempfile.TemporaryDirectory()))
+        self.input = self.temp_dir / "input"
+        for module in ("vendor/a", "vendor/b"):
+            (self.input / module).mkdir(parents=True)
+            for name in ("x", "y", "z"):
+                self._write(self.input / module / f".{name}.o.json", {
+                    "include_dirs": ["common/include", f"{module}/include"],
+                    "include_files": ["common/include/linux/kconfig.h",
+                                      f"{module}/{name}.h",
+                                      # Same path as above once normalized.
+                                      f"{module}//{name}.h"],
+                    "unresolved": [] if name == "x" else ["/usr/include/stdio.h"],
+                })
+
+    def _write(self, path: pathlib.Path, d: dict):
+        path.write_text(json.dumps(d))
+        os.utime(path, ns=(1_000_000_000, 1_000_000_000))
+
+    def test_same_as_serial(self):
+        expected = _merge_serially(self.input)
+        self.assertEqual(len(expected.include_files), 7)
+        for jobs in (1, 3):
+            self.assertEqual(
+                gen_ddk_headers.get_all_files_and_includes(self.input, jobs=jobs),
+                expected, jobs)
+
+    def test_cache(self):
+        cache = self.temp_dir / "cache/inputs_cache.json"
+        expected = _merge_serially(self.input)
+        self.assertEqual(
+            gen_ddk_headers.get_all_files_and_includes(self.input, jobs=1, cache=cache),
+            expected)
+        self.assertTrue(cache.exists())
+
+        # Same inode, size and mtime, so the cached inputs are used.
+        file = self.input / "vendor/a/.x.o.json"
+        content = file.read_text()
+        self._write(file, json.loads(content.replace("common", "kommon")))
+        self.assertEqual(
+            gen_ddk_headers.get_all_files_and_includes(self.input, jobs=1, cache=cache),
+            expected)
+
+        os.utime(file, ns=(2_000_000_000, 2_000_000_000))
+        self.assertEqual(
+            gen_ddk_headers.get_all_files_and_includes(self.input, jobs=1, cache=cache),
+            _merge_serially(self.input))
+
+    def test_cache_version(self):
+        cache = self.temp_dir / "inputs_cache.json"
+        expected = _merge_serially(self.input)
+        gen_ddk_headers.get_all_files_and_includes(self.input, jobs=1, cache=cache)
+
+        file = self.input / "vendor/a/.x.o.json"
+        self._write(file, json.loads(file.read_text().replace("common", "kommon")))
+        self.assertEqual(
+            gen_ddk_headers.get_all_files_and_includes(self.input, jobs=1, cache=cache),
+            expected)
+
+        # Same stats, but a cache in another format is not used.
+        with mock.patch.object(gen_ddk_headers, "_CACHE_VERSION",
+                               gen_ddk_headers._CACHE_VERSION + 1):
+            self.assertEqual(
+                gen_ddk_headers.get_all_files_and_includes(self.input, jobs=1, cache=cache),
+                _merge_serially(self.input))
+
+    def test_cache_skips_recently_modified(self):
+        (self.input / "vendor/a/.x.o.json").touch()
+        cache = self.temp_dir / "inputs_cache.json"
+        gen_ddk_headers.get_all_files_and_includes(self.input, jobs=1, cache=cache)
+        self.assertFalse(cache.exists())
+
+
+class PathResolverTest(unittest.TestCase):
+
+    def test_resolve(self):
+        root = pathlib.Path(self.enterContext(tempfile.TemporaryDirectory()))
+        (root / "common/include/linux").mkdir(parents=True)
+        (root / "common/include/linux/a.h").touch()
+        (root / "common/b.h").touch()
+        (root / "common/link.h").symlink_to("include/linux/a.h")
+        (root / "common/linux").symlink_to("include/linux")
+        (root / "common/broken.h").symlink_to("missing.h")
+
+        resolver = gen_ddk_headers._PathResolver(root)
+        for path in (
+            "common/include/linux/a.h",
+            "common/include/linux",
+            "common/b.h",
+            "common/link.h",
+            "common/linux/a.h",
+            "common/linux/../b.h",
+            "common/include/../b.h",
+            "common/broken.h",
+            "common/missing.h",
+            "common/missing/a.h",
+            "common/missing/../b.h",
+            ".",
+        ):
+            try:
+                expected = (root / path).resolve(strict=True)
+            except FileNotFoundError:
+                expected = None
+            # Twice, so that memoized results are also checked.
+            for _ in range(2):
+                self.assertEqual(resolver.resolve(pathlib.Path(path)), expected, path)
+
+
+class GenDdkHeadersTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = pathlib.Path(
+            self.enterContext(tempfile.TemporaryDirectory()))
+        self.workspace = self.temp_dir / "workspace"
+        (self.workspace / "common/include/linux").mkdir(parents=True)
+        (self.workspace / "common/include/linux/kconfig.h").touch()
+        # Under $HOME/go, so that GenDdkHeaders finds buildozer.
+        (self.temp_dir / "go/bin").mkdir(parents=True)
+        (self.temp_dir / "go/bin/buildozer").touch()
+
+    def test_ignores_system_include_dirs(self):
+        cmd_dir = self.temp_dir / "cmds"
+        (cmd_dir / "vendor/a").mkdir(parents=True)
+        (cmd_dir / "vendor/a/.x.o.cmd").write_text(_CMD_FILE)
+        out = self.temp_dir / "out"
+        AnalyzeInputs(
+            out=out,
+            dirs=[cmd_dir],
+            module_srcs=[pathlib.Path("common/include/linux/kconfig.h")],
+            include_filters=["*.h"],
+            exclude_filters=[],
+            gen_files_archives=[],
+            jobs=1,
+        ).run()
+
+        include_data = gen_ddk_headers.get_all_files_and_includes(out, jobs=1)
+        self.assertEqual(list(include_data.include_dirs), [pathlib.Path("common/include")])
+
+        # The toolchain is not in the workspace, but it is not reported as
+        # missing.
+        generator = gen_ddk_headers.GenDdkHeaders(
+            args=gen_ddk_headers.parse_args(["--input", str(out), "--package", "common"]),
+            include_data=include_data,
+            environ={"BUILD_WORKSPACE_DIRECTORY": str(self.workspace),
+                     "HOME": str(self.temp_dir)})
+        self.assertFalse(generator._missing)
+        self.assertFalse(generator._unknown_package)
+        self.assertEqual(generator._package_includes,
+                         {pathlib.Path("common"): {pathlib.Path("common/include")}})
+
+
+if __name__ == "__main__":
+    absltest.main()
@@ -0,0 +1,39 @@
+# Copyright (C) 2024 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Splits files into shards for worker processes of analyze_inputs and gen_ddk_headers."""
+
+import os
+
+# Number of shards per job, so that jobs finishing early can pick up more
+# work.
+_SHARDS_PER_JOB = 4
+
+
+def get_default_jobs() -> int:
+    """Returns the number of CPUs this process may run on."""
+    return len(os.sched_getaffinity(0))
+
+
+def get_shards(num_items: int, jobs: int) -> list[slice]:
+    """Splits num_items items into contiguous shards for jobs worker processes.
+
+    Contiguous shards keep files in the same directory in the same worker.
+
+    Returns:
+        The slice of the items in each shard.
+    """
+    num_shards = min(num_items, jobs * _SHARDS_PER_JOB)
+    bounds = [num_items * i // num_shards for i in range(num_shards + 1)]
+    return [slice(start, end) for start, end in zip(bounds, bounds[1:])]
@@ -14,7 +14,6 @@
 
 """Generate an SPDX SBOM."""
 
-load("@kernel_toolchain_info//:dict.bzl", "VARS")
 load(":common_providers.bzl", "KernelBuildUnameInfo")
 
 visibility("//build/kernel/kleaf/...")
@@ -29,11 +28,14 @@ def _kernel_sbom_impl(ctx):
     args.add("--output_file", output_file)
     args.add_all("--files", srcs_depset)
     args.add("--version_file", kernel_release)
-    args.add("--readelf", ctx.executable._readelf)
+
+    # Bazel schedules the action as if it uses one CPU, so don't start more
+    # threads than that.
+    args.add("--jobs", "1")
 
     ctx.actions.run(
         mnemonic = "KernelSbom",
-        inputs = depset([kernel_release, ctx.executable._readelf], transitive = [srcs_depset]),
+        inputs = depset([kernel_release], transitive = [srcs_depset]),
         outputs = [output_file],
         executable = ctx.executable._kernel_sbom,
         arguments = [args],
@@ -58,12 +60,5 @@ kernel_sbom = rule(
             cfg = "exec",
             executable = True,
         ),
-        "_readelf": attr.label(
-            default =
-                "//prebuilts/clang/host/linux-x86/clang-{}:bin/llvm-readelf".format(VARS["CLANG_VERSION"]),
-            cfg = "exec",
-            executable = True,
-            allow_files = True,
-        ),
     },
 )
@@ -21,8 +21,15 @@ Inputs:
               example: 5.15.110-android14-11-00098-gbdd2312e95c7-ab10365441
 2. --dist_dir: Output dir where all the kernel build artifacts are.
               example: out/kernel_aarch64/dist
-3. --output_file: File where SBOM should be written.
+3. --output_file: File where SBOM should be written. It is compressed if it
+              ends with .gz or .zst.
               example: kernel_sbom.spdx.json
+4. --previous_sbom: Optional SBOM from a previous run. Only files that
+              changed since then are hashed again.
+              example: kernel_sbom.spdx.json
+5. --manifest_file: File sizes and mtimes of the previous run. Required
+              with --previous_sbom, and rewritten for the next run.
+              example: kernel_sbom.spdx.json.manifest.json
 
 Examples:
 
@@ -31,19 +38,33 @@ Examples:
       --version "5.15.110-android14-11-00098-gbdd2312e95c7-ab10365441" \
       --dist_dir "out/kernel_aarch64/dist" \
       --output_file "kernel_sbom.spdx.json"
+
+    # Regenerate it after an incremental build.
+    build/kernel/kleaf/kernel_sbom.py \
+      --version "5.15.110-android14-11-00098-gbdd2312e95c7-ab10365441" \
+      --dist_dir "out/kernel_aarch64/dist" \
+      --output_file "kernel_sbom.spdx.json" \
+      --previous_sbom "kernel_sbom.spdx.json" \
+      --manifest_file "kernel_sbom.spdx.json.manifest.json"
 """
 
 import argparse
-from collections.abc import Iterable
+from collections.abc import Iterable, Iterator, Sequence
+import concurrent.futures
+import contextlib
 import dataclasses
 import datetime
+import gzip
 import hashlib
+import io
 import json
 import os
 import pathlib
 import re
+import struct
 import subprocess
-from typing import Any
+import time
+from typing import Any, BinaryIO, TextIO
 
 
 _SPDX_VERSION = "SPDX-2.3"
@@ -60,6 +81,33 @@ _GENERATED_FROM_RELATIONSHIP = "GENERATED_FROM"
 _VARIANT_OF_RELATIONSHIP = "VARIANT_OF"
 _SPDX_REF = "SPDXRef"
 
+# SPDX checksum algorithms and the corresponding hashlib names.
+# https://spdx.github.io/spdx-spec/v2.3/file-information/#84-file-checksum-field
+_CHECKSUM_ALGORITHMS = {
+    "SHA1": "sha1",
+    "SHA256": "sha256",
+    "SHA512": "sha512",
+}
+_DEFAULT_CHECKSUM_ALGORITHMS = ("SHA1", "SHA256")
+# The package verification code is always based on SHA1.
+# https://spdx.github.io/spdx-spec/v2.3/package-information/#79-package-verification-code-field
+_VERIFICATION_CODE_ALGORITHM = "SHA1"
+
+# ELF constants. See elf(5).
+_ELF_MAGIC = b"\x7fELF"
+_ELFCLASS32 = 1
+_ELFCLASS64 = 2
+_ELFDATA2LSB = 1
+_SHT_NOTE = 7
+_PT_NOTE = 4
+_NT_GNU_BUILD_ID = 3
+_GNU_NOTE_NAME = b"GNU\0"
+
+# Files modified this close to the start of the scan are not recorded in the
+# manifest. On file systems with coarse timestamps, they may be modified
+# again after they are hashed without changing their mtime.
+_RACY_MTIME_NS = 2_000_000_000
+
 
 def _spdx_id(identifier: str):
   # the id string is a "unique string containing letters, numbers, . and/or -."
@@ -68,13 +116,221 @@ def _spdx_id(identifier: str):
   return f"{_SPDX_REF}-{sanitized_identifier}"
 
 
+def _parse_notes(data: bytes, endian: str, align: int):
+  """Yields (name, type, desc) of each note in a note section or segment."""
+  # Notes are 4-byte aligned, except when the section or segment is 8-byte
+  # aligned. This is consistent with readelf.
+  align = 8 if align == 8 else 4
+  pos = 0
+  while pos + 12 <= len(data):
+    namesz, descsz, note_type = struct.unpack_from(f"{endian}III", data, pos)
+    pos += 12
+    name = data[pos:pos + namesz]
+    pos += -(-namesz // align) * align
+    desc = data[pos:pos + descsz]
+    pos += -(-descsz // align) * align
+    yield name, note_type, desc
+
+
+def _get_note_regions(
+    f: BinaryIO, file_path: pathlib.Path
+) -> tuple[str, list[tuple[int, int, int]]]:
+  """Returns the byte order and (offset, size, align) of each note region.
+
+  Like readelf --notes, note sections are used if there are section headers,
+  and PT_NOTE segments otherwise.
+  """
+  ident = f.read(16)
+  if len(ident) < 16 or ident[:4] != _ELF_MAGIC:
+    raise ValueError(f"{file_path}: not an ELF file")
+  endian = "<" if ident[5] == _ELFDATA2LSB else ">"
+  if ident[4] == _ELFCLASS64:
+    ehdr_format, shdr_format, phdr_format = "HHIQQQIHHHHHH", "IIQQQQIIQQ", \
+        "IIQQQQQQ"
+  elif ident[4] == _ELFCLASS32:
+    ehdr_format, shdr_format, phdr_format = "HHIIIIIHHHHHH", "IIIIIIIIII", \
+        "IIIIIIII"
+  else:
+    raise ValueError(f"{file_path}: unknown ELF class {ident[4]}")
+
+  ehdr_struct = struct.Struct(endian + ehdr_format)
+  (_, _, _, _, phoff, shoff, _, _, phentsize, phnum, shentsize, shnum,
+   _) = ehdr_struct.unpack(f.read(ehdr_struct.size))
+
+  def read_headers(offset: int, entsize: int, num: int, header_format: str):
+    header_struct = struct.Struct(endian + header_format)
+    f.seek(offset)
+    data = f.read(entsize * num)
+    return [header_struct.unpack_from(data, i * entsize) for i in range(num)]
+
+  if shoff:
+    if shnum == 0:
+      # The number of sections is in sh_size of the first section.
+      shnum = read_headers(shoff, shentsize, 1, shdr_format)[0][5]
+    sections = read_headers(shoff, shentsize, shnum, shdr_format)
+    return endian, [
+        (sh_offset, sh_size, sh_addralign)
+        for (_, sh_type, _, _, sh_offset, sh_size, _, _, sh_addralign,
+             _) in sections
+        if sh_type == _SHT_NOTE
+    ]
+
+  regions = []
+  for phdr in read_headers(phoff, phentsize, phnum, phdr_format):
+    if ident[4] == _ELFCLASS64:
+      p_type, _, p_offset, _, _, p_filesz, _, p_align = phdr
+    else:
+      p_type, p_offset, _, _, p_filesz, _, _, p_align = phdr
+    if p_type == _PT_NOTE:
+      regions.append((p_offset, p_filesz, p_align))
+  return endian, regions
+
+
+def read_build_id(file_path: pathlib.Path) -> str | None:
+  """Returns the GNU build ID of an ELF file, formatted like readelf --notes.
+
+  Raises:
+    ValueError: if the file is not an ELF file.
+  """
+  build_id = None
+  with file_path.open("rb") as f:
+    endian, regions = _get_note_regions(f, file_path)
+    for offset, size, align in regions:
+      f.seek(offset)
+      for name, note_type, desc in _parse_notes(f.read(size), endian, align):
+        if name == _GNU_NOTE_NAME and note_type == _NT_GNU_BUILD_ID:
+          assert build_id is None
+          build_id = f"Build ID: {desc.hex()}"
+  return build_id
+
+
 @dataclasses.dataclass(order=True)
 class File:
   id: str
   name: str
   path: pathlib.Path
-  checksum: str
+  # From SPDX algorithm names to hex digests.
+  checksums: dict[str, str] = dataclasses.field(compare=False)
   build_id: str | None
+  # Stat of the file before it was hashed. None if unknown.
+  size: int | None = dataclasses.field(default=None, compare=False)
+  mtime_ns: int | None = dataclasses.field(default=None, compare=False)
+
+
+@contextlib.contextmanager
+def _open_text(path: pathlib.Path, mode: str, zstd: str) -> Iterator[TextIO]:
+  """Opens a text file for reading or writing, compressed by its suffix.
+
+  Args:
+    path: The file. It is compressed if it ends with .gz or .zst.
+    mode: "r" or "w".
+    zstd: The zstd binary for .zst files.
+  """
+  if path.suffix == ".gz":
+    if mode == "r":
+      with gzip.open(path, "rt") as f:
+        yield f
+    else:
+      # Leave the mtime and file name out of the header so that the output
+      # is reproducible.
+      with path.open("wb") as raw, \
+          gzip.GzipFile(filename="", mode="wb", fileobj=raw, mtime=0) as gz, \
+          io.TextIOWrapper(gz) as f:
+        yield f
+  elif path.suffix == ".zst":
+    if mode == "r":
+      proc = subprocess.Popen([zstd, "-q", "-d", "-c", path],
+                              stdout=subprocess.PIPE)
+      with io.TextIOWrapper(proc.stdout) as f:
+        yield f
+    else:
+      with path.open("wb") as raw:
+        proc = subprocess.Popen([zstd, "-q", "-c"], stdin=subprocess.PIPE,
+                                stdout=raw)
+        with io.TextIOWrapper(proc.stdin) as f:
+          yield f
+    if proc.wait() != 0:
+      raise subprocess.CalledProcessError(proc.returncode, proc.args)
+  else:
+    with path.open(mode) as f:
+      yield f
+
+
+def _write_json_stream(doc: dict[str, Any], f: TextIO, indent: int | None):
+  """Writes a JSON object whose values may be iterators.
+
+  Iterators are written as arrays one item at a time, so the whole document
+  is never in memory. The output is the same as json.dump() with the same
+  indent, or with no whitespace at all if indent is None.
+  """
+  key_separator = ": " if indent is not None else ":"
+
+  def newline(level: int) -> str:
+    if indent is None:
+      return ""
+    return "\n" + " " * (indent * level)
+
+  def dumps(value: Any, level: int) -> str:
+    # Newlines can only be between tokens, as strings escape them.
+    return json.dumps(value, indent=indent,
+                      separators=(",", key_separator)).replace(
+                          "\n", newline(level))
+
+  f.write("{")
+  for i, (key, value) in enumerate(doc.items()):
+    if i:
+      f.write(",")
+    f.write(newline(1) + json.dumps(key) + key_separator)
+    if not isinstance(value, Iterator):
+      f.write(dumps(value, 1))
+      continue
+    empty = True
+    for item in value:
+      f.write("," if not empty else "[")
+      empty = False
+      f.write(newline(2) + dumps(item, 2))
+    f.write("[]" if empty else newline(1) + "]")
+  f.write(newline(0) + "}")
+
+
+def load_previous_files(sbom_path: pathlib.Path,
+                        manifest_path: pathlib.Path,
+                        zstd: str = "zstd") -> dict[str, File]:
+  """Loads files of a previous SBOM that are recorded in its manifest.
+
+  The manifest records the size and mtime of each file in the SBOM so that
+  checksums of unchanged files can be reused.
+
+  Returns:
+    A dictionary from file names to files. Empty if the SBOM or its
+    manifest can't be read, e.g. on the first build.
+  """
+  try:
+    with manifest_path.open() as f:
+      manifest = json.load(f)
+    with _open_text(sbom_path, "r", zstd) as f:
+      sbom = json.load(f)
+  except (OSError, EOFError, json.JSONDecodeError,
+          subprocess.CalledProcessError):
+    return {}
+
+  previous_files = {}
+  for file_dict in sbom.get("files", []):
+    name = file_dict["fileName"]
+    stat = manifest.get(name)
+    if stat is None:
+      continue
+    previous_files[name] = File(
+        id=file_dict["SPDXID"],
+        name=name,
+        path=pathlib.Path(name),
+        checksums={checksum["algorithm"]: checksum["checksumValue"]
+                   for checksum in file_dict.get("checksums", [])},
+        build_id=file_dict.get("comment"),
+        size=stat["size"],
+        mtime_ns=stat["mtime_ns"],
+    )
+  return previous_files
 
 
 class KernelSbom:
@@ -83,27 +339,45 @@ class KernelSbom:
       self,
       android_kernel_version: str,
       file_list: Iterable[pathlib.Path],
-      readelf: pathlib.Path,
+      max_workers: int | None = None,
+      previous_files: dict[str, File] | None = None,
+      checksum_algorithms: Sequence[str] = _DEFAULT_CHECKSUM_ALGORITHMS,
   ):
     self._android_kernel_version = android_kernel_version
+    self._checksum_algorithms = checksum_algorithms
     self._upstream_kernel_version = android_kernel_version.split("-")[0]
-    self._files = sorted(
-        [
-            File(
-                id=_spdx_id(file.name),
-                name=file.name,
-                path=file,
-                checksum=self._checksum(file),
-                build_id=self._build_id(file, readelf)
-            )
-            for file in file_list
-        ]
+    self._previous_files = previous_files or {}
+    self._start_ns = time.time_ns()
+    # hashlib releases the GIL while hashing large buffers, so threads hash
+    # files in parallel.
+    with concurrent.futures.ThreadPoolExecutor(max_workers) as executor:
+      self._files = sorted(executor.map(self._analyze_file, file_list))
+
+  def _analyze_file(self, file: pathlib.Path) -> File:
+    stat = file.stat()
+    previous = self._previous_files.get(file.name)
+    if (previous is not None and previous.size == stat.st_size and
+        previous.mtime_ns == stat.st_mtime_ns and
+        all(algorithm in previous.checksums
+            for algorithm in self._checksum_algorithms)):
+      return dataclasses.replace(previous, path=file, checksums={
+          algorithm: previous.checksums[algorithm]
+          for algorithm in self._checksum_algorithms
+      })
+    return File(
+        id=_spdx_id(file.name),
+        name=file.name,
+        path=file,
+        checksums=self._checksums(file),
+        build_id=self._build_id(file),
+        size=stat.st_size,
+        mtime_ns=stat.st_mtime_ns,
     )
-    self._sbom_doc = self._generate_sbom()
 
-  # replacement for 3.11 hashlib.file_digest(), adopted from upstream CPython
-  def _file_digest(self, fileobj, algorithm: str):
-    digestobj = hashlib.new(algorithm)
+  # Like 3.11 hashlib.file_digest(), adopted from upstream CPython, but
+  # feeds each chunk to several digests so that the file is read once.
+  def _file_digest(self, fileobj, algorithms: Sequence[str]):
+    digestobjs = [hashlib.new(algorithm) for algorithm in algorithms]
 
     # We only support binary file objects
     buf = bytearray(2**18)  # Reusable buffer to reduce allocations.
@@ -112,21 +386,26 @@ class KernelSbom:
       size = fileobj.readinto(buf)
       if size == 0:
         break  # EOF
-      digestobj.update(view[:size])
+      chunk = view[:size]
+      for digestobj in digestobjs:
+        digestobj.update(chunk)
 
-    return digestobj
+    return digestobjs
 
-  def _checksum(self, file_path: pathlib.Path) -> str:
-    with file_path.open("rb") as f:
-      if hasattr(hashlib, "file_digest"):
-        digest = hashlib.file_digest(f, "sha1")
-      else:
-        digest = self._file_digest(f, "sha1")
-      return str(digest.hexdigest())
+  def _checksums(self, file_path: pathlib.Path) -> dict[str, str]:
+    with file_path.open("rb", buffering=0) as f:
+      digests = self._file_digest(
+          f, [_CHECKSUM_ALGORITHMS[algorithm]
+              for algorithm in self._checksum_algorithms])
+    return {
+        algorithm: digest.hexdigest()
+        for algorithm, digest in zip(self._checksum_algorithms, digests)
+    }
 
   def _generate_package_verification_code(self, files: list[File]) -> str:
     combined_checksum = hashlib.sha1()
-    for checksum in sorted(f.checksum.encode() for f in files):
+    for checksum in sorted(f.checksums[_VERIFICATION_CODE_ALGORITHM].encode()
+                           for f in files):
       combined_checksum.update(checksum)
     return combined_checksum.hexdigest()
 
@@ -149,19 +428,10 @@ class KernelSbom:
     }
     return headers
 
-  def _build_id(
-      self, file_path: pathlib.Path, readelf: pathlib.Path
-  ) -> str | None:
+  def _build_id(self, file_path: pathlib.Path) -> str | None:
     if file_path.name != "vmlinux" and file_path.suffix != ".ko":
       return None
-
-    out = subprocess.check_output([readelf, "--notes", file_path]).decode()
-    build_id = None
-    for line in out.splitlines():
-      if "Build ID:" in line:
-        assert(build_id is None)
-        build_id = line.strip()
-    return build_id
+    return read_build_id(file_path)
 
   def _generate_package_dict(
       self,
@@ -194,9 +464,10 @@ class KernelSbom:
         "SPDXID": file.id,
         "checksums": [
             {
-                "algorithm": "SHA1",
-                "checksumValue": file.checksum,
-            },
+                "algorithm": algorithm,
+                "checksumValue": checksum_value,
+            }
+            for algorithm, checksum_value in file.checksums.items()
         ],
     }
     if file.build_id is not None:
@@ -214,6 +485,11 @@ class KernelSbom:
     }
 
   def _generate_sbom(self) -> dict[str, Any]:
+    """Returns the SPDX document.
+
+    Files and relationships are iterators, which scale with the number of
+    files.
+    """
     sbom = self._generate_doc_headers()
     sbom["packages"] = [
         self._generate_package_dict(
@@ -238,34 +514,55 @@ class KernelSbom:
             _LINUX_UPSTREAM_WEBSITE,
         ),
     ]
-    sbom["files"] = [self._generate_file_dict(f) for f in self._files]
-
-    sbom["relationships"] = [
-        self._generate_relationship_dict(
-            _spdx_id(_MAIN_PACKAGE_NAME),
-            _spdx_id(_SOURCE_CODE_PACKAGE_NAME),
-            _GENERATED_FROM_RELATIONSHIP,
-        ),
-        self._generate_relationship_dict(
-            _spdx_id(_SOURCE_CODE_PACKAGE_NAME),
-            _spdx_id(_LINUX_UPSTREAM_PACKAGE_NAME),
-            _VARIANT_OF_RELATIONSHIP,
-        ),
-    ] + [
-        self._generate_relationship_dict(
-            f.id,
-            _spdx_id(_SOURCE_CODE_PACKAGE_NAME),
-            _GENERATED_FROM_RELATIONSHIP,
-        )
-        for f in self._files
-    ]
-
+    sbom["files"] = (self._generate_file_dict(f) for f in self._files)
+    sbom["relationships"] = self._generate_relationships()
     return sbom
 
-  def write_sbom_file(self, output_path: pathlib.Path):
+  def _generate_relationships(self) -> Iterator[dict[str, str]]:
+    yield self._generate_relationship_dict(
+        _spdx_id(_MAIN_PACKAGE_NAME),
+        _spdx_id(_SOURCE_CODE_PACKAGE_NAME),
+        _GENERATED_FROM_RELATIONSHIP,
+    )
+    yield self._generate_relationship_dict(
+        _spdx_id(_SOURCE_CODE_PACKAGE_NAME),
+        _spdx_id(_LINUX_UPSTREAM_PACKAGE_NAME),
+        _VARIANT_OF_RELATIONSHIP,
+    )
+    for f in self._files:
+      yield self._generate_relationship_dict(
+          f.id,
+          _spdx_id(_SOURCE_CODE_PACKAGE_NAME),
+          _GENERATED_FROM_RELATIONSHIP,
+      )
+
+  def write_sbom_file(
+      self,
+      output_path: pathlib.Path,
+      compact: bool = False,
+      zstd: str = "zstd",
+  ):
+    """Writes the SBOM section by section.
+
+    Args:
+      output_path: The SBOM. It is compressed if it ends with .gz or .zst.
+      compact: Whether to omit indentation and whitespace.
+      zstd: The zstd binary for .zst output.
+    """
     # omit all error handling to fatally fail with stacktrace in that case
+    with _open_text(output_path, "w", zstd) as output_file:
+      _write_json_stream(self._generate_sbom(), output_file,
+                         None if compact else 4)
+
+  def write_manifest_file(self, output_path: pathlib.Path):
+    manifest = {
+        file.name: {"size": file.size, "mtime_ns": file.mtime_ns}
+        for file in self._files
+        if file.mtime_ns is not None and
+        file.mtime_ns < self._start_ns - _RACY_MTIME_NS
+    }
     with output_path.open("w") as output_file:
-      json.dump(self._sbom_doc, output_file, indent=4)
+      json.dump(manifest, output_file, indent=4, sort_keys=True)
 
 
 def get_args():
@@ -274,7 +571,8 @@ def get_args():
       "--output_file",
       required=True,
       type=pathlib.Path,
-      help="The generated SBOM file in SPDX format.",
+      help="The generated SBOM file in SPDX format. It is compressed if it"
+      " ends with .gz or .zst.",
   )
   dist_group = parser.add_mutually_exclusive_group(required=True)
   dist_group.add_argument(
@@ -296,11 +594,43 @@ def get_args():
       help="path to the kernel.release file",
   )
   parser.add_argument(
-      "--readelf",
-      required=True,
-      type=pathlib.Path, help="The readelf binary to process binaries.",
+      "--jobs",
+      type=int,
+      help="Number of files to process in parallel. Default is based on the"
+      " number of CPUs.",
+  )
+  parser.add_argument(
+      "--sha512",
+      action="store_true",
+      help="Also emit SHA512 checksums, in addition to SHA1 and SHA256.",
+  )
+  parser.add_argument(
+      "--compact",
+      action="store_true",
+      help="Write the SBOM without indentation and whitespace.",
+  )
+  parser.add_argument(
+      "--zstd",
+      default="zstd",
+      help="The zstd binary, if --output_file ends with .zst.",
+  )
+  parser.add_argument(
+      "--previous_sbom",
+      type=pathlib.Path,
+      help="SBOM from a previous run. Checksums and build IDs of files with"
+      " the same size and mtime as recorded in --manifest_file are reused."
+      " May be the same as --output_file.",
+  )
+  parser.add_argument(
+      "--manifest_file",
+      type=pathlib.Path,
+      help="Sizes and mtimes of files in --previous_sbom. It is rewritten"
+      " for files in --output_file. Required with --previous_sbom.",
   )
-  return parser.parse_args()
+  args = parser.parse_args()
+  if (args.previous_sbom is None) != (args.manifest_file is None):
+    parser.error("--previous_sbom and --manifest_file must be used together")
+  return args
 
 
 def get_file_list(dist_dir: pathlib.Path) -> Iterable[pathlib.Path]:
@@ -321,8 +651,18 @@ def main():
   args = get_args()
   files = args.files or get_file_list(args.dist_dir)
   version = args.version or read_version_from_file(args.version_file)
-  sbom = KernelSbom(version, files, args.readelf)
-  sbom.write_sbom_file(args.output_file)
+  previous_files = {}
+  if args.previous_sbom:
+    previous_files = load_previous_files(args.previous_sbom,
+                                         args.manifest_file, args.zstd)
+  checksum_algorithms = _DEFAULT_CHECKSUM_ALGORITHMS
+  if args.sha512:
+    checksum_algorithms += ("SHA512",)
+  sbom = KernelSbom(version, files, args.jobs, previous_files,
+                    checksum_algorithms)
+  sbom.write_sbom_file(args.output_file, args.compact, args.zstd)
+  if args.manifest_file:
+    sbom.write_manifest_file(args.manifest_file)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,305 @@
+# Copyright (C) 2024 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import gzip
+import hashlib
+import io
+import json
+import os
+import pathlib
+import struct
+import sys
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from absl.testing import absltest
+import kernel_sbom
+
+_BUILD_ID = bytes(range(20))
+_BUILD_ID_COMMENT = f"Build ID: {_BUILD_ID.hex()}"
+
+
+def _note(endian: str, name: bytes, note_type: int, desc: bytes) -> bytes:
+  def pad(data: bytes):
+    return data + b"\0" * (-len(data) % 4)
+  return struct.pack(f"{endian}III", len(name), len(desc), note_type) + \
+      pad(name) + pad(desc)
+
+
+def _elf32_with_note_segment(endian: str, notes: bytes) -> bytes:
+  """Returns an ELF32 file with PT_NOTE and no section headers."""
+  ei_data = 1 if endian == "<" else 2
+  ident = b"\x7fELF" + bytes([1, ei_data, 1]) + b"\0" * 9
+  ehdr = struct.pack(f"{endian}HHIIIIIHHHHHH", 2, 40, 1, 0, 52, 0, 0, 52, 32,
+                     1, 40, 0, 0)
+  notes_offset = 52 + 32
+  phdr = struct.pack(f"{endian}IIIIIIII", 4, notes_offset, 0, 0, len(notes),
+                     len(notes), 4, 4)
+  return ident + ehdr + phdr + notes
+
+
+def _elf64_with_note_sections(endian: str, sections: list[bytes]) -> bytes:
+  """Returns an ELF64 file with a SHT_NOTE section for each item."""
+  ei_data = 1 if endian == "<" else 2
+  ident = b"\x7fELF" + bytes([2, ei_data, 1]) + b"\0" * 9
+  body = b"".join(sections)
+  shoff = 64 + len(body)
+  shoff += -shoff % 8
+  ehdr = struct.pack(f"{endian}HHIQQQIHHHHHH", 1, 183, 1, 0, 0, shoff, 0, 64,
+                     0, 0, 64, len(sections) + 1, 0)
+  shdrs = b"\0" * 64
+  offset = 64
+  for section in sections:
+    shdrs += struct.pack(f"{endian}IIQQQQIIQQ", 0, 7, 2, 0, offset,
+                         len(section), 0, 0, 4, 0)
+    offset += len(section)
+  return ident + ehdr + body + b"\0" * (shoff - 64 - len(body)) + shdrs
+
+
+class KernelSbomTest(unittest.TestCase):
+
+  def setUp(self):
+    self.temp_dir = pathlib.Path(
+        self.enterContext(tempfile.TemporaryDirectory()))
+
+  def _write(self, name: str, content: bytes) -> pathlib.Path:
+    path = self.temp_dir / name
+    path.write_bytes(content)
+    return path
+
+  def _read_sbom(self, sbom: kernel_sbom.KernelSbom) -> dict:
+    sbom_path = self.temp_dir / "read_sbom.spdx.json"
+    sbom.write_sbom_file(sbom_path)
+    return json.loads(sbom_path.read_text())
+
+  def test_build_id_in_section(self):
+    path = self._write("a.ko", _elf64_with_note_sections("<", [
+        _note("<", b"Linux\0", 1, b"\0" * 6),
+        _note("<", b"GNU\0", 3, _BUILD_ID),
+    ]))
+    self.assertEqual(kernel_sbom.read_build_id(path), _BUILD_ID_COMMENT)
+
+  def test_build_id_big_endian(self):
+    path = self._write("a.ko", _elf64_with_note_sections(">", [
+        _note(">", b"GNU\0", 3, _BUILD_ID),
+    ]))
+    self.assertEqual(kernel_sbom.read_build_id(path), _BUILD_ID_COMMENT)
+
+  def test_build_id_in_segment(self):
+    path = self._write("vmlinux", _elf32_with_note_segment(
+        ">", _note(">", b"GNU\0", 1, b"\0" * 16) +
+        _note(">", b"GNU\0", 3, _BUILD_ID)))
+    self.assertEqual(kernel_sbom.read_build_id(path), _BUILD_ID_COMMENT)
+
+  def test_no_build_id(self):
+    path = self._write("a.ko", _elf64_with_note_sections("<", [
+        _note("<", b"Xen\0", 3, _BUILD_ID),
+    ]))
+    self.assertIsNone(kernel_sbom.read_build_id(path))
+
+  def test_not_elf(self):
+    path = self._write("a.ko", b"not an ELF file")
+    with self.assertRaises(ValueError):
+      kernel_sbom.read_build_id(path)
+
+  def test_files(self):
+    ko = self._write("a.ko", _elf64_with_note_sections("<", [
+        _note("<", b"GNU\0", 3, _BUILD_ID),
+    ]))
+    image = self._write("Image", b"image")
+    sbom = kernel_sbom.KernelSbom("6.1.0-android15", [ko, image])
+    files = {file.name: file for file in sbom._files}
+    self.assertEqual(files["a.ko"].build_id, _BUILD_ID_COMMENT)
+    self.assertEqual(files["a.ko"].checksums, {
+        "SHA1": hashlib.sha1(ko.read_bytes()).hexdigest(),
+        "SHA256": hashlib.sha256(ko.read_bytes()).hexdigest(),
+    })
+    self.assertIsNone(files["Image"].build_id)
+    self.assertEqual(files["Image"].checksums, {
+        "SHA1": hashlib.sha1(b"image").hexdigest(),
+        "SHA256": hashlib.sha256(b"image").hexdigest(),
+    })
+
+  def test_max_workers(self):
+    files = [self._write(f"{i}.ko", _elf64_with_note_sections("<", [
+        _note("<", b"GNU\0", 3, bytes([i]) * 20),
+    ])) for i in range(8)]
+    files += [self._write(f"{i}.img", b"x" * i * 1000) for i in range(8)]
+    expected = kernel_sbom.KernelSbom("6.1.0", files, max_workers=1)._files
+    self.assertEqual(len(expected), 16)
+    self.assertEqual(kernel_sbom.KernelSbom("6.1.0", files, max_workers=4)._files,
+                     expected)
+    # As if nothing changed since the previous SBOM.
+    previous_files = {file.name: file for file in expected}
+    self.assertEqual(
+        kernel_sbom.KernelSbom("6.1.0", files, max_workers=4,
+                               previous_files=previous_files)._files,
+        expected)
+
+  def test_sha512(self):
+    # Larger than the buffer of _file_digest.
+    content = bytes(range(256)) * 4096
+    image = self._write("Image", content)
+    sbom = kernel_sbom.KernelSbom(
+        "6.1.0", [image], checksum_algorithms=("SHA1", "SHA256", "SHA512"))
+    self.assertEqual(self._read_sbom(sbom)["files"][0]["checksums"], [
+        {"algorithm": "SHA1",
+         "checksumValue": hashlib.sha1(content).hexdigest()},
+        {"algorithm": "SHA256",
+         "checksumValue": hashlib.sha256(content).hexdigest()},
+        {"algorithm": "SHA512",
+         "checksumValue": hashlib.sha512(content).hexdigest()},
+    ])
+
+  def test_write_sbom_file(self):
+    files = [self._write(f"{i}.img", b"x" * i) for i in range(3)]
+    sbom = kernel_sbom.KernelSbom("6.1.0", files)
+
+    # Same as json.dump().
+    sbom_path = self.temp_dir / "sbom.spdx.json"
+    sbom.write_sbom_file(sbom_path)
+    content = sbom_path.read_text()
+    doc = json.loads(content)
+    self.assertEqual(len(doc["files"]), 3)
+    self.assertEqual(content, json.dumps(doc, indent=4))
+
+    sbom.write_sbom_file(sbom_path, compact=True)
+    content = sbom_path.read_text()
+    self.assertEqual(content,
+                     json.dumps(json.loads(content), separators=(",", ":")))
+
+    gzip_path = self.temp_dir / "sbom.spdx.json.gz"
+    sbom.write_sbom_file(gzip_path)
+    with gzip.open(gzip_path, "rt") as f:
+      content = f.read()
+    self.assertEqual(content, json.dumps(json.loads(content), indent=4))
+
+  def test_write_sbom_file_gzip_reproducible(self):
+    sbom = kernel_sbom.KernelSbom("6.1.0", [self._write("Image", b"image")])
+    sbom_path = self.temp_dir / "sbom.spdx.json.gz"
+    with mock.patch.object(time, "time", return_value=1_000_000_000):
+      sbom.write_sbom_file(sbom_path)
+    header = sbom_path.read_bytes()[:10]
+    # No FNAME flag and no MTIME.
+    self.assertEqual(header[3], 0)
+    self.assertEqual(header[4:8], b"\0\0\0\0")
+    with gzip.open(sbom_path, "rt") as f:
+      self.assertEqual(len(json.load(f)["files"]), 1)
+
+  def test_write_sbom_file_no_files(self):
+    sbom_path = self.temp_dir / "sbom.spdx.json"
+    kernel_sbom.KernelSbom("6.1.0", []).write_sbom_file(sbom_path)
+    sbom = json.loads(sbom_path.read_text())
+    self.assertEqual(sbom["files"], [])
+    self.assertEqual(len(sbom["relationships"]), 2)
+
+  def test_previous_sbom(self):
+    unchanged = self._write("unchanged", b"old")
+    touched = self._write("touched", b"old")
+    resized = self._write("resized", b"old")
+    for path in (unchanged, touched, resized):
+      os.utime(path, ns=(1_000_000_000, 1_000_000_000))
+    sbom_path = self.temp_dir / "sbom.spdx.json"
+    sbom = kernel_sbom.KernelSbom("6.1.0", [unchanged, touched, resized])
+    sbom.write_sbom_file(sbom_path)
+    manifest_path = self.temp_dir / "manifest.json"
+    sbom.write_manifest_file(manifest_path)
+
+    # Same size and mtime, so the previous checksum is reused even though
+    # the content changed.
+    unchanged.write_bytes(b"new")
+    os.utime(unchanged, ns=(1_000_000_000, 1_000_000_000))
+    touched.write_bytes(b"new")
+    resized.write_bytes(b"newer")
+    os.utime(resized, ns=(1_000_000_000, 1_000_000_000))
+
+    sbom = kernel_sbom.KernelSbom(
+        "6.1.0", [unchanged, touched, resized],
+        previous_files=kernel_sbom.load_previous_files(sbom_path, manifest_path))
+    checksums = {file.name: file.checksums["SHA1"] for file in sbom._files}
+    self.assertEqual(checksums, {
+        "unchanged": hashlib.sha1(b"old").hexdigest(),
+        "touched": hashlib.sha1(b"new").hexdigest(),
+        "resized": hashlib.sha1(b"newer").hexdigest(),
+    })
+    verification_code = hashlib.sha1(
+        "".join(sorted(checksums.values())).encode()).hexdigest()
+    self.assertEqual(
+        self._read_sbom(sbom)["packages"][0]["packageVerificationCode"],
+        {"packageVerificationCodeValue": verification_code})
+
+  def test_previous_sbom_without_algorithm(self):
+    image = self._write("Image", b"old")
+    os.utime(image, ns=(1_000_000_000, 1_000_000_000))
+    sbom_path = self.temp_dir / "sbom.spdx.json"
+    sbom = kernel_sbom.KernelSbom("6.1.0", [image],
+                                  checksum_algorithms=("SHA1",))
+    sbom.write_sbom_file(sbom_path)
+    manifest_path = self.temp_dir / "manifest.json"
+    sbom.write_manifest_file(manifest_path)
+
+    # SHA256 is not in the previous SBOM, so the file is hashed again.
+    image.write_bytes(b"new")
+    os.utime(image, ns=(1_000_000_000, 1_000_000_000))
+    sbom = kernel_sbom.KernelSbom(
+        "6.1.0", [image],
+        previous_files=kernel_sbom.load_previous_files(sbom_path, manifest_path))
+    self.assertEqual(sbom._files[0].checksums, {
+        "SHA1": hashlib.sha1(b"new").hexdigest(),
+        "SHA256": hashlib.sha256(b"new").hexdigest(),
+    })
+
+  def test_recently_modified_not_in_manifest(self):
+    path = self._write("Image", b"image")
+    sbom = kernel_sbom.KernelSbom("6.1.0", [path])
+    manifest_path = self.temp_dir / "manifest.json"
+    sbom.write_manifest_file(manifest_path)
+    self.assertEqual(json.loads(manifest_path.read_text()), {})
+
+  def test_previous_sbom_missing(self):
+    self.assertEqual(
+        kernel_sbom.load_previous_files(self.temp_dir / "missing.json",
+                                        self.temp_dir / "missing_manifest.json"),
+        {})
+
+  def _main(self, *args: str):
+    image = self._write("Image", b"image")
+    os.utime(image, ns=(1_000_000_000, 1_000_000_000))
+    argv = ["kernel_sbom.py", "--version", "6.1.0", "--files", str(image),
+            "--output_file", str(self.temp_dir / "sbom.spdx.json"), *args]
+    with mock.patch.object(sys, "argv", argv):
+      kernel_sbom.main()
+
+  def test_main_writes_only_declared_outputs(self):
+    self._main()
+    self.assertEqual(sorted(os.listdir(self.temp_dir)),
+                     ["Image", "sbom.spdx.json"])
+
+  def test_main_manifest_file(self):
+    sbom_path = self.temp_dir / "sbom.spdx.json"
+    manifest_path = self.temp_dir / "manifest.json"
+    self._main("--previous_sbom", str(sbom_path),
+               "--manifest_file", str(manifest_path))
+    self.assertEqual(list(json.loads(manifest_path.read_text())), ["Image"])
+
+  def test_main_previous_sbom_requires_manifest_file(self):
+    with mock.patch.object(sys, "stderr", io.StringIO()):
+      with self.assertRaises(SystemExit):
+        self._main("--previous_sbom", str(self.temp_dir / "sbom.spdx.json"))
+
+
+if __name__ == "__main__":
+  absltest.main()
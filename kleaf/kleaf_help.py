@@ -23,6 +23,7 @@ import re
 import textwrap
 
 _BAZEL_RC_DIR = "build/kernel/kleaf/bazelrc"
+# Sync with kleaf/bazel.py
 FLAGS_BAZEL_RC = "build/kernel/kleaf/bazelrc/flags.bazelrc"
 
 _FLAG_PATTERN = re.compile(
@@ -38,17 +39,29 @@ _CONFIG_PATTERN = re.compile(
 )
 
 
-class KleafHelpPrinter(object):
-    def __init__(self):
-        pass
+class _DedentRawTextHelpFormatter(argparse.RawTextHelpFormatter):
+    """Like RawTextHelpFormatter, but dedents help messages first.
 
-    def add_startup_option_to_parser(self, parser: argparse.ArgumentParser):
-        """Add startup options to the given ArgumentParser."""
-        raise NotImplementedError
+    This allows the Bazel wrapper to register indented help messages without
+    importing textwrap when help is not requested.
+    """
 
-    def add_command_args_to_parser(self, parser: argparse.ArgumentParser):
-        """Add command arguments to the given ArgumentParser."""
-        raise NotImplementedError
+    def _split_lines(self, text, width):
+        return super()._split_lines(textwrap.dedent(text), width)
+
+
+class KleafHelpPrinter(object):
+    def __init__(self, wrapper):
+        """Prints help for the given Bazel wrapper.
+
+        Args:
+            wrapper: An object that provides the following methods:
+              - add_startup_option_to_parser(parser): Add startup options to
+                the given ArgumentParser.
+              - add_command_args_to_parser(parser): Add command arguments to
+                the given ArgumentParser.
+        """
+        self._wrapper = wrapper
 
     def print_kleaf_help(self, kleaf_repo_dir: pathlib.Path):
         """Print Kleaf help menu to stdout."""
@@ -56,7 +69,7 @@ class KleafHelpPrinter(object):
             prog="bazel",
             add_help=False,
             usage="bazel [<startup options>] <command> [<args>] [--] [<target patterns>]",
-            formatter_class=argparse.RawTextHelpFormatter,
+            formatter_class=_DedentRawTextHelpFormatter,
         )
 
         parser.add_argument_group(
@@ -64,7 +77,7 @@ class KleafHelpPrinter(object):
             description=textwrap.dedent("""\
                 Consists of "Wrapper flags" and "Native flags".
                 """))
-        self.add_startup_option_to_parser(parser)
+        self._wrapper.add_startup_option_to_parser(parser)
         parser.add_argument_group(
             title="Startup options - Native flags",
             description="$ bazel help startup_options")
@@ -74,7 +87,7 @@ class KleafHelpPrinter(object):
             description="""$ bazel help""",
         )
 
-        self.add_command_args_to_parser(parser)
+        self._wrapper.add_command_args_to_parser(parser)
         bazelrc_parser = FlagsBazelrcParser(
             kleaf_repo_dir / FLAGS_BAZEL_RC)
         bazelrc_parser.add_to(parser, kleaf_repo_dir=kleaf_repo_dir)
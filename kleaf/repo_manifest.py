@@ -0,0 +1,99 @@
+# Copyright (C) 2024 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Streams elements of a repo manifest without building a DOM.
+
+Used by workspace_status_stamp.py and init_ddk.
+
+See https://gerrit.googlesource.com/git-repo/+/master/docs/manifest-format.md
+"""
+
+import os
+import pathlib
+import re
+import xml.etree.ElementTree as ET
+from typing import BinaryIO, Iterator, TextIO
+
+# Raised when the manifest is malformed.
+ParseError = ET.ParseError
+
+
+class ManifestStream(object):
+    """Iterates over the children of <manifest> one at a time.
+
+    Each child is complete, including its descendants, when it is yielded.
+    It is released when the iteration moves on, so memory usage does not
+    grow with the number of projects.
+
+    Example:
+
+        stream = ManifestStream(path)
+        for element in stream:
+            if element.tag == "project":
+                ...
+    """
+
+    def __init__(self, source: str | os.PathLike | TextIO | BinaryIO):
+        """Initializes the stream.
+
+        Args:
+            source: path to the manifest, or a file object.
+        """
+        self._source = source
+        # The <manifest> element without children. Set when iteration
+        # starts.
+        self.root: ET.Element | None = None
+
+    def __iter__(self) -> Iterator[ET.Element]:
+        depth = 0
+        for event, element in ET.iterparse(self._source,
+                                           events=("start", "end")):
+            if event == "start":
+                if depth == 0:
+                    self.root = element
+                depth += 1
+                continue
+            depth -= 1
+            if depth == 1:
+                yield element
+                # The only child of root is element.
+                del self.root[:]
+
+
+def get_project_path(project: ET.Element) -> pathlib.Path:
+    """Returns the path of a <project> below the repo root."""
+    # https://gerrit.googlesource.com/git-repo/+/master/docs/manifest-format.md#element-project
+    return pathlib.Path(project.get("path") or project.get("name"))
+
+
+def get_groups(project: ET.Element) -> set[str]:
+    """Returns the groups of a <project>."""
+    return set(re.split(r",| ", project.get("groups", "")))
+
+
+def match_groups(project: ET.Element, expect_groups: set[str] | None) -> bool:
+    """Returns whether a <project> is in any of expect_groups.
+
+    If expect_groups is None, all projects match.
+    """
+    if expect_groups is None:
+        return True
+    return bool(get_groups(project) & expect_groups)
+
+
+def iter_projects(source: str | os.PathLike | TextIO | BinaryIO) \
+        -> Iterator[ET.Element]:
+    """Yields all <project> elements, including nested ones, in order."""
+    for element in ManifestStream(source):
+        yield from element.iter("project")
@@ -0,0 +1,139 @@
+# Copyright (C) 2024 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for repo_manifest."""
+
+import io
+import pathlib
+import unittest
+import xml.dom.minidom
+import xml.etree.ElementTree as ET
+
+from absl.testing import absltest
+import repo_manifest
+
+_MANIFEST = """\
+<?xml version="1.0" encoding="UTF-8"?>
+<manifest>
+  <remote name="aosp" fetch=".." />
+  <default revision="main" remote="aosp" />
+  <project path="build/kernel" name="kernel/build" groups="ddk,pdk">
+    <linkfile src="kleaf/bazel.sh" dest="tools/bazel" />
+  </project>
+  <project name="kernel/common" groups="pdk sysui" />
+  <extend-project name="kernel/common" groups="extra" />
+  <submanifest name="sub">
+    <project path="sub/project" name="sub/project" />
+  </submanifest>
+</manifest>
+"""
+
+
+def _generate_manifest(num_projects: int) -> str:
+    lines = [
+        '<?xml version="1.0" encoding="UTF-8"?>',
+        "<manifest>",
+        '  <default revision="main" remote="aosp" />',
+    ]
+    for i in range(num_projects):
+        path = f' path="platform/dir{i // 100}/project{i}"' if i % 3 else ""
+        lines.append(f'  <project{path} name="platform/project{i}">')
+        if i % 50 == 0:
+            lines.append(f'    <linkfile src="file{i}" dest="link{i}" />')
+        lines.append("  </project>")
+    lines.append("</manifest>")
+    return "\n".join(lines) + "\n"
+
+
+class ManifestStreamTest(unittest.TestCase):
+
+    def test_children(self):
+        stream = repo_manifest.ManifestStream(io.StringIO(_MANIFEST))
+        tags = []
+        for element in stream:
+            tags.append(element.tag)
+            # Children are complete when yielded.
+            if element.tag == "project" and element.get("name") == "kernel/build":
+                self.assertEqual([child.tag for child in element], ["linkfile"])
+        self.assertEqual(tags, ["remote", "default", "project", "project",
+                                "extend-project", "submanifest"])
+        self.assertEqual(stream.root.tag, "manifest")
+
+    def test_releases_children(self):
+        stream = repo_manifest.ManifestStream(
+            io.StringIO(_generate_manifest(5000)))
+        max_children = 0
+        for _ in stream:
+            max_children = max(max_children, len(stream.root))
+        # The parser reads ahead by a chunk, but earlier children are
+        # released.
+        self.assertLess(max_children, 1000)
+        self.assertEqual(len(stream.root), 0)
+
+    def test_empty_manifest(self):
+        stream = repo_manifest.ManifestStream(io.StringIO("<manifest />"))
+        self.assertEqual(list(stream), [])
+        self.assertEqual(stream.root.tag, "manifest")
+
+    def test_malformed(self):
+        with self.assertRaises(repo_manifest.ParseError):
+            list(repo_manifest.ManifestStream(
+                io.StringIO("<manifest><project></manifest>")))
+
+
+class IterProjectsTest(unittest.TestCase):
+
+    def test_iter_projects(self):
+        self.assertEqual(
+            [repo_manifest.get_project_path(project)
+             for project in repo_manifest.iter_projects(io.StringIO(_MANIFEST))],
+            [pathlib.Path("build/kernel"), pathlib.Path("kernel/common"),
+             pathlib.Path("sub/project")])
+
+    def test_same_as_minidom(self):
+        manifest = _generate_manifest(500)
+        dom = xml.dom.minidom.parseString(manifest)
+        expected = [
+            pathlib.Path(project.getAttribute("path") or project.getAttribute("name"))
+            for project in dom.documentElement.getElementsByTagName("project")]
+        self.assertEqual(len(expected), 500)
+        self.assertEqual(
+            [repo_manifest.get_project_path(project)
+             for project in repo_manifest.iter_projects(io.StringIO(manifest))],
+            expected)
+
+
+class MatchGroupsTest(unittest.TestCase):
+
+    def test_get_groups(self):
+        self.assertEqual(
+            repo_manifest.get_groups(ET.Element("project", groups="a,b c")),
+            {"a", "b", "c"})
+
+    def test_match_groups(self):
+        project = ET.Element("project", groups="ddk,pdk sysui")
+        self.assertTrue(repo_manifest.match_groups(project, None))
+        self.assertTrue(repo_manifest.match_groups(project, {"ddk"}))
+        self.assertTrue(repo_manifest.match_groups(project, {"sysui", "x"}))
+        self.assertFalse(repo_manifest.match_groups(project, {"ddk-external"}))
+        self.assertFalse(repo_manifest.match_groups(project, set()))
+
+    def test_match_groups_no_groups(self):
+        project = ET.Element("project")
+        self.assertTrue(repo_manifest.match_groups(project, None))
+        self.assertFalse(repo_manifest.match_groups(project, {"ddk"}))
+
+
+if __name__ == "__main__":
+    absltest.main()
@@ -12,7 +12,10 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import concurrent.futures
 import dataclasses
+import hashlib
+import io
 import json
 import logging
 import os
@@ -20,11 +23,18 @@ import pathlib
 import shutil
 import subprocess
 import sys
-import xml.dom.minidom
-import xml.parsers.expat
+import tempfile
+import threading
+from typing import Callable, TextIO
+
+import repo_manifest
 
 _FAKE_KERNEL_VERSION = "99.99.99"
 
+# Set by the Bazel wrapper. If unset, nothing is cached.
+# Sync with kleaf/bazel.py
+_CACHE_DIR_ENV_VAR = "KLEAF_WORKSPACE_STATUS_CACHE_DIR"
+
 
 @dataclasses.dataclass
 class PathCollectible(object):
@@ -36,12 +46,12 @@ class PathCollectible(object):
 
 
 @dataclasses.dataclass
-class PathPopen(PathCollectible):
-    """Consists of a path and the result of a subprocess."""
-    popen: subprocess.Popen
+class PathFuture(PathCollectible):
+    """Consists of a path and the result of a task in an executor."""
+    future: concurrent.futures.Future[str]
 
     def collect(self) -> str:
-        return collect(self.popen)
+        return self.future.result()
 
 
 @dataclasses.dataclass
@@ -54,7 +64,7 @@ class PresetResult(PathCollectible):
 
 
 @dataclasses.dataclass
-class LocalversionResult(PathPopen):
+class LocalversionResult(PathFuture):
     """Consists of results of localversion."""
     removed_prefix: str | None
     suffix: str | None
@@ -68,11 +78,140 @@ class LocalversionResult(PathPopen):
         return ret
 
 
-def get_localversion_from_script(bin: pathlib.Path | None, project: pathlib.Path, *args) \
-        -> PathCollectible | None:
+def _get_git_dir(project: pathlib.Path) -> pathlib.Path | None:
+    """Returns the .git directory of a project."""
+    dot_git = project / ".git"
+    if dot_git.is_dir():
+        return dot_git
+    if dot_git.is_file():
+        # Worktrees and submodules: "gitdir: <path>"
+        content = dot_git.read_text()
+        if content.startswith("gitdir:"):
+            return project / content.removeprefix("gitdir:").strip()
+    return None
+
+
+def _get_head_key(project: pathlib.Path) -> str | None:
+    """Returns a string that changes whenever HEAD of a project moves.
+
+    This reads .git/HEAD and the ref it points to without calling git.
+
+    Returns:
+        The key, or None if it can't be determined.
+    """
+    git_dir = _get_git_dir(project)
+    if git_dir is None:
+        return None
+    try:
+        head = (git_dir / "HEAD").read_text()
+        key = [head]
+        if head.startswith("ref:"):
+            ref = head.removeprefix("ref:").strip()
+            common_dir = git_dir
+            commondir_file = git_dir / "commondir"
+            if commondir_file.is_file():
+                common_dir = git_dir / commondir_file.read_text().strip()
+            for ref_path in (git_dir / ref, common_dir / ref):
+                if ref_path.is_file():
+                    key.append(ref_path.read_text())
+                    break
+            else:
+                packed_refs = (common_dir / "packed-refs").stat()
+                key.append(f"{packed_refs.st_mtime_ns}:{packed_refs.st_size}")
+    except OSError:
+        return None
+    return json.dumps(key)
+
+
+class GitCache(object):
+    """Persistent cache of values that only depend on HEAD of a project.
+
+    Values are invalidated when .git/HEAD or the ref it points to changes.
+    """
+
+    def __init__(self, path: pathlib.Path | None):
+        """Loads the cache.
+
+        Args:
+            path: the JSON file. If None, nothing is cached.
+        """
+        self._path = path
+        self._lock = threading.Lock()
+        self._modified = False
+        # {str(project): {"key": head_key, name: value}}
+        self._entries: dict[str, dict[str, str]] = _load_json(path) or {}
+
+    def get(self, project: pathlib.Path, name: str,
+            compute: Callable[[], str]) -> str:
+        """Returns a cached value, or computes and caches it."""
+        if self._path is None:
+            return compute()
+        key = _get_head_key(project)
+        if key is None:
+            return compute()
+
+        with self._lock:
+            entry = self._entries.get(str(project), {})
+            if entry.get("key") == key and name in entry:
+                return entry[name]
+
+        value = compute()
+
+        # Don't cache the value if HEAD moved during compute().
+        if _get_head_key(project) != key:
+            return value
+        with self._lock:
+            entry = self._entries.get(str(project))
+            if entry is None or entry.get("key") != key:
+                entry = {"key": key}
+                self._entries[str(project)] = entry
+            entry[name] = value
+            self._modified = True
+        return value
+
+    def save(self):
+        if self._path is None or not self._modified:
+            return
+        _write_json_atomically(self._path, self._entries)
+
+
+def _get_cache_path(name: str) -> pathlib.Path | None:
+    """Returns the path to a file in the cache directory, if any."""
+    cache_dir = os.environ.get(_CACHE_DIR_ENV_VAR)
+    if not cache_dir:
+        return None
+    return pathlib.Path(cache_dir) / name
+
+
+def _load_json(path: pathlib.Path | None) -> dict | None:
+    if path is None:
+        return None
+    try:
+        with open(path) as file:
+            return json.load(file)
+    except (OSError, json.JSONDecodeError):
+        return None
+
+
+def _write_json_atomically(path: pathlib.Path, obj):
+    """Writes a JSON file so that concurrent readers never see partial
+    content."""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f"{path.name}.{os.getpid()}")
+    with open(tmp_path, "w") as file:
+        json.dump(obj, file, sort_keys=True, indent=2)
+    os.replace(tmp_path, path)
+
+
+def get_localversion_from_script(
+        executor: concurrent.futures.Executor,
+        bin: pathlib.Path | None,
+        project: pathlib.Path,
+        *args) -> PathCollectible | None:
     """Call setlocalversion.
 
     Args:
+      executor: executor to run setlocalversion
       bin: path to setlocalversion, or None if it does not exist.
       project: relative path to the project
       args: additional arguments
@@ -89,9 +228,7 @@ def get_localversion_from_script(bin: pathlib.Path | None, project: pathlib.Path
         env = dict(os.environ)
         env["KERNELVERSION"] = _FAKE_KERNEL_VERSION
         env.pop("BUILD_NUMBER", None)
-        popen = subprocess.Popen([bin, srctree] + list(args),
-                                 text=True,
-                                 stdout=subprocess.PIPE,
+        future = executor.submit(run, [bin, srctree] + list(args),
                                  cwd=working_dir,
                                  env=env)
 
@@ -100,7 +237,7 @@ def get_localversion_from_script(bin: pathlib.Path | None, project: pathlib.Path
             suffix = "-ab" + os.environ["BUILD_NUMBER"]
         return LocalversionResult(
             path=project,
-            popen=popen,
+            future=future,
             removed_prefix=_FAKE_KERNEL_VERSION,
             suffix=suffix
         )
@@ -108,10 +245,15 @@ def get_localversion_from_script(bin: pathlib.Path | None, project: pathlib.Path
     return None
 
 
-def get_localversion_from_git(project: pathlib.Path) -> PathCollectible | None:
+def get_localversion_from_git(
+        executor: concurrent.futures.Executor,
+        git_cache: GitCache,
+        project: pathlib.Path) -> PathCollectible | None:
     """Calculate localversion without calling setlocalversion script.
 
     Args:
+      executor: executor to run git
+      git_cache: cache of the HEAD commit
       project: relative path to the project
     Return:
       A PathCollectible object that resolves to the result, or None if bin or
@@ -121,14 +263,31 @@ def get_localversion_from_git(project: pathlib.Path) -> PathCollectible | None:
     if not project.is_dir():
         return None
 
+    suffix = None
+    if os.environ.get("BUILD_NUMBER"):
+        suffix = "-ab" + os.environ["BUILD_NUMBER"]
+    return LocalversionResult(
+        path=project,
+        future=executor.submit(_get_localversion_from_git, git_cache,
+                               project),
+        removed_prefix=None,
+        suffix=suffix
+    )
+
+
+def _get_localversion_from_git(git_cache: GitCache, project: pathlib.Path) \
+        -> str:
+    # The abbreviated HEAD only changes when HEAD moves, so it is cached.
+    # Whether the project is dirty depends on the working tree, so it is
+    # checked every time.
+    head = git_cache.get(project, "short_head",
+                         lambda: _get_short_head(project))
+
     # Note: To ensure hermeticity as much as possible, only get git from
     # host, then clear PATH.
     script = """
         GIT=$(command -v git)
         PATH=
-        if head=$($GIT rev-parse --verify --short=12 HEAD 2>/dev/null); then
-            echo -n -g"$head"
-        fi
         if {
             $GIT --no-optional-locks status -uno --porcelain 2>/dev/null ||
             $GIT diff-index --name-only HEAD
@@ -136,17 +295,24 @@ def get_localversion_from_git(project: pathlib.Path) -> PathCollectible | None:
             echo -n -dirty
         fi
     """
-    popen = subprocess.Popen(script, shell=True, text=True,
-                             stdout=subprocess.PIPE, cwd=project)
-    suffix = None
-    if os.environ.get("BUILD_NUMBER"):
-        suffix = "-ab" + os.environ["BUILD_NUMBER"]
-    return LocalversionResult(
-        path=project,
-        popen=popen,
-        removed_prefix=None,
-        suffix=suffix
-    )
+    dirty = run(script, shell=True, cwd=project)
+    if head:
+        return "-g" + head + dirty
+    return dirty
+
+
+def _get_short_head(project: pathlib.Path) -> str:
+    """Returns the abbreviated HEAD commit, or an empty string."""
+    git = shutil.which("git")
+    if not git:
+        return ""
+    result = subprocess.run(
+        [git, "rev-parse", "--verify", "--short=12", "HEAD"],
+        text=True, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+        cwd=project, env=dict(os.environ, PATH=""))
+    if result.returncode != 0:
+        return ""
+    return result.stdout.strip()
 
 
 def _find_repo(curdir: pathlib.Path) -> pathlib.Path | None:
@@ -165,7 +331,7 @@ def list_projects() -> list[pathlib.Path]:
     Returns:
         a list of Git projects relative to CWD.
     """
-    repo_root_s, repo_manifest = os.environ.get("KLEAF_REPO_MANIFEST", ":").split(":")
+    repo_root_s, repo_manifest_s = os.environ.get("KLEAF_REPO_MANIFEST", ":").split(":")
     if repo_root_s:
         repo_root = pathlib.Path(repo_root_s)
     else:
@@ -175,19 +341,70 @@ def list_projects() -> list[pathlib.Path]:
         logging.warning("Unable to determine repo root. Please specify --repo_manifest.")
         return []
 
-    if repo_manifest:
-        with open(repo_manifest) as repo_manifest_file:
-            return parse_repo_manifest(repo_root, repo_manifest_file.read())
+    if repo_manifest_s:
+        with open(repo_manifest_s) as repo_manifest_file:
+            return parse_repo_manifest(repo_root, repo_manifest_file)
 
-    try:
-        output = subprocess.check_output(["repo", "manifest", "-r"], text=True)
-        return parse_repo_manifest(repo_root, output)
-    except (subprocess.SubprocessError, FileNotFoundError) as e:
-        logging.warning("Unable to execute repo manifest -r: %s", e)
-        return []
+    cache_path = _get_cache_path("repo_manifest.json")
+    key = _get_repo_manifest_key(repo_root)
+    output = _load_repo_manifest_cache(cache_path, key)
+    if output is None:
+        try:
+            output = subprocess.check_output(["repo", "manifest", "-r"],
+                                             text=True)
+        except (subprocess.SubprocessError, FileNotFoundError) as e:
+            logging.warning("Unable to execute repo manifest -r: %s", e)
+            return []
+        # Don't cache the output if the manifest changed while repo ran.
+        if key == _get_repo_manifest_key(repo_root):
+            _save_repo_manifest_cache(cache_path, key, output)
+    return parse_repo_manifest(repo_root, io.StringIO(output))
 
 
-def parse_repo_manifest(repo_root: pathlib.Path, manifest: str) \
+def _get_repo_manifest_key(repo_root: pathlib.Path) -> str | None:
+    """Returns a string that changes whenever the projects in repo change.
+
+    Only paths of projects are used, so revisions in the output of
+    `repo manifest -r` may be stale.
+
+    Returns:
+        The key, or None if it can't be determined.
+    """
+    dot_repo = repo_root / ".repo"
+    manifests_head_key = _get_head_key(dot_repo / "manifests")
+    if manifests_head_key is None:
+        return None
+    key = [manifests_head_key]
+    # manifests/ is for files added or removed without a commit.
+    for name in ("manifests", "manifest.xml", "local_manifests",
+                 "project.list"):
+        try:
+            stat = (dot_repo / name).stat()
+            key.append(f"{stat.st_mtime_ns}:{stat.st_size}")
+        except OSError:
+            key.append(None)
+    return json.dumps(key)
+
+
+def _load_repo_manifest_cache(cache_path: pathlib.Path | None,
+                              key: str | None) -> str | None:
+    """Returns the cached output of `repo manifest -r` if it is up to date."""
+    if key is None:
+        return None
+    cache = _load_json(cache_path)
+    if cache is None or cache.get("key") != key:
+        return None
+    return cache.get("manifest")
+
+
+def _save_repo_manifest_cache(cache_path: pathlib.Path | None,
+                              key: str | None, output: str):
+    if cache_path is None or key is None:
+        return
+    _write_json_atomically(cache_path, {"key": key, "manifest": output})
+
+
+def parse_repo_manifest(repo_root: pathlib.Path, manifest: TextIO) \
         -> list[pathlib.Path]:
     """Parses a repo manifest file.
 
@@ -195,39 +412,84 @@ def parse_repo_manifest(repo_root: pathlib.Path, manifest: str) \
         a list of paths to all projects in the repository.
     """
     kleaf_repo_dir = pathlib.Path(".").resolve()
+    ret = list[pathlib.Path]()
     try:
-        dom = xml.dom.minidom.parseString(manifest)
-    except xml.parsers.expat.ExpatError as e:
+        for project in repo_manifest.iter_projects(manifest):
+            realpath = repo_root / repo_manifest.get_project_path(project)
+            if realpath.is_relative_to(kleaf_repo_dir):
+                ret.append(realpath.relative_to(kleaf_repo_dir))
+            else:
+                logging.warning(
+                    "Skipping project %s because it is not below %s",
+                    realpath, kleaf_repo_dir)
+    except repo_manifest.ParseError as e:
         logging.error("Unable to parse repo manifest: %s", e)
         return []
-    projects = dom.documentElement.getElementsByTagName("project")
-    ret = list[pathlib.Path]()
-    for project in projects:
-        # https://gerrit.googlesource.com/git-repo/+/master/docs/manifest-format.md#element-project
-        path_below_repo = pathlib.Path(project.getAttribute("path") or
-                                       project.getAttribute("name"))
-        realpath = repo_root / path_below_repo
-        if realpath.is_relative_to(kleaf_repo_dir):
-            ret.append(realpath.relative_to(kleaf_repo_dir))
-        else:
-            logging.warning("Skipping project %s because it is not below %s",
-                            realpath, kleaf_repo_dir)
     return ret
 
 
-def collect(popen_obj: subprocess.Popen) -> str:
-    """Collect the result of a Popen object.
+def run(args, **kwargs) -> str:
+    """Runs a subprocess and returns its stdout.
 
     Terminates the program if return code is non-zero.
 
     Return:
       stdout of the subprocess.
     """
-    stdout, _ = popen_obj.communicate()
-    if popen_obj.returncode != 0:
-        logging.error("return code is %d", popen_obj.returncode)
+    result = subprocess.run(args, text=True, stdout=subprocess.PIPE,
+                            **kwargs)
+    if result.returncode != 0:
+        logging.error("return code is %d", result.returncode)
         sys.exit(1)
-    return stdout.strip()
+    return result.stdout.strip()
+
+
+def _hash_file(path: str) -> str | None:
+    """Returns the SHA-256 of a file, or None if it can't be read."""
+    try:
+        with open(path, "rb") as file:
+            return hashlib.sha256(file.read()).hexdigest()
+    except OSError:
+        return None
+
+
+def _source_ext_modules() -> tuple[list[str], set[str]]:
+    """Sources the build config and returns EXT_MODULES.
+
+    Returns:
+        A tuple of EXT_MODULES and the files that were sourced.
+
+    Raises:
+        subprocess.CalledProcessError: if the build config can't be sourced.
+    """
+    # Each traced command is prefixed with the file it comes from. Files
+    # with no commands still show up as the argument of source or ".".
+    cmd = r"""
+            exec {trace_fd}>"$1"
+            BASH_XTRACEFD=$trace_fd
+            PS4=$'+${BASH_SOURCE}\t'
+            set -x
+            source build/build_utils.sh
+            source build/_setup_env.sh
+            set +x
+            echo $EXT_MODULES
+          """
+    with tempfile.NamedTemporaryFile("r") as trace:
+        out = subprocess.check_output(["/bin/bash", "-c", cmd, "bash",
+                                       trace.name],
+                                      text=True,
+                                      stderr=subprocess.PIPE)
+        files = {"build/build_utils.sh", "build/_setup_env.sh"}
+        for line in trace:
+            source, tab, command = line.lstrip("+").partition("\t")
+            if not tab:
+                continue
+            if source:
+                files.add(source)
+            words = command.split()
+            if len(words) > 1 and words[0] in ("source", "."):
+                files.add(words[1])
+    return out.split(), files
 
 
 class Stamp(object):
@@ -257,13 +519,21 @@ class Stamp(object):
         self.find_setlocalversion()
 
     def main(self) -> int:
-        scmversion_map = self.get_localversion_all()
+        self.git_cache = GitCache(_get_cache_path("git.json"))
+
+        # The default max_workers bounds the number of concurrent
+        # subprocesses, which are mostly I/O bound.
+        with concurrent.futures.ThreadPoolExecutor() as self.executor:
+            scmversion_map = self.get_localversion_all()
 
-        source_date_epoch_map = self.async_get_source_date_epoch_all()
+            source_date_epoch_map = self.async_get_source_date_epoch_all()
 
-        scmversion_result_map = self.collect_map(scmversion_map)
+            scmversion_result_map = self.collect_map(scmversion_map)
 
-        source_date_epoch_result_map = self.collect_map(source_date_epoch_map)
+            source_date_epoch_result_map = self.collect_map(
+                source_date_epoch_map)
+
+        self.git_cache.save()
 
         self.print_result(
             scmversion_result_map=scmversion_result_map,
@@ -324,31 +594,47 @@ class Stamp(object):
 
     def get_localversion(self, project: pathlib.Path) -> PathCollectible | None:
         if not self.use_kleaf_localversion:
-            return get_localversion_from_script(self.setlocalversion, project)
+            return get_localversion_from_script(self.executor,
+                                                self.setlocalversion, project)
 
-        return get_localversion_from_git(project)
+        return get_localversion_from_git(self.executor, self.git_cache,
+                                         project)
 
     def get_ext_modules(self) -> list[pathlib.Path]:
+        """Returns EXT_MODULES from the build config.
+
+        The result is cached, keyed by the whole environment and the content
+        of each file sourced. Other inputs of the build config, e.g. the
+        output of a command it runs, are not covered; delete
+        out/bazel/workspace_status after changing them.
+        """
         if not self.setlocalversion:
             return []
+        cache_path = _get_cache_path("ext_modules.json")
+        # Only a digest is stored so that the cache holds no secrets.
+        env = hashlib.sha256(json.dumps(dict(os.environ),
+                                        sort_keys=True).encode()).hexdigest()
+        cache = _load_json(cache_path)
+        if cache is not None and cache.get("env") == env and all(
+                _hash_file(file) == digest
+                for file, digest in cache.get("files", {}).items()):
+            return [pathlib.Path(path) for path in cache["ext_modules"]]
+
         try:
-            cmd = """
-                    source build/build_utils.sh
-                    source build/_setup_env.sh
-                    echo $EXT_MODULES
-                  """
-            out = subprocess.check_output(cmd,
-                                          shell=True,
-                                          text=True,
-                                          stderr=subprocess.PIPE,
-                                          executable="/bin/bash")
-            return [pathlib.Path(path) for path in out.split()]
+            ext_modules, files = _source_ext_modules()
         except subprocess.CalledProcessError as e:
             logging.warning(
                 "Unable to determine EXT_MODULES; scmversion "
                 "for external modules may be incorrect. "
                 "code=%d, stderr=%s", e.returncode, e.stderr.strip())
-        return []
+            return []
+        if cache_path is not None:
+            _write_json_atomically(cache_path, {
+                "env": env,
+                "files": {file: _hash_file(file) for file in files},
+                "ext_modules": ext_modules,
+            })
+        return [pathlib.Path(path) for path in ext_modules]
 
     def async_get_source_date_epoch_all(self) \
             -> dict[str, PathCollectible]:
@@ -375,8 +661,10 @@ class Stamp(object):
                 "git", "-C",
                 rel_path.resolve(), "log", "-1", "--pretty=%ct"
             ]
-            popen = subprocess.Popen(args, text=True, stdout=subprocess.PIPE)
-            return PathPopen(rel_path, popen)
+            future = self.executor.submit(
+                self.git_cache.get, rel_path, "source_date_epoch",
+                lambda: run(args))
+            return PathFuture(rel_path, future)
         return PresetResult(rel_path, "0")
 
     def collect_map(
@@ -0,0 +1,164 @@
+# Copyright (C) 2024 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for workspace_status_stamp."""
+
+import os
+import pathlib
+import subprocess
+import tempfile
+import unittest
+from unittest import mock
+
+from absl.testing import absltest
+import workspace_status_stamp
+
+
+class GitCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = pathlib.Path(
+            self.enterContext(tempfile.TemporaryDirectory()))
+        self.project = self.temp_dir / "common"
+        self.project.mkdir()
+        self.cache_path = self.temp_dir / "cache/git.json"
+        self._git("init", "-q", "-b", "main")
+        self._commit("first")
+
+    def _git(self, *args) -> str:
+        return subprocess.check_output(
+            ["git", "-c", "user.name=Kleaf", "-c", "user.email=kleaf@example.com",
+             *args],
+            cwd=self.project, text=True).strip()
+
+    def _commit(self, message: str):
+        self._git("commit", "-q", "--allow-empty", "-m", message)
+
+    def _get(self) -> tuple[str, bool]:
+        """Gets HEAD through a new cache, like a new build.
+
+        Returns:
+            A tuple of (the value, whether it was computed).
+        """
+        computed = False
+
+        def compute():
+            nonlocal computed
+            computed = True
+            return self._git("rev-parse", "HEAD")
+
+        cache = workspace_status_stamp.GitCache(self.cache_path)
+        value = cache.get(self.project, "head", compute)
+        cache.save()
+        return value, computed
+
+    def _check_invalidated(self):
+        self.assertEqual(self._get(), (self._git("rev-parse", "HEAD"), True))
+        self.assertEqual(self._get(), (self._git("rev-parse", "HEAD"), False))
+
+    def test_cached(self):
+        self._check_invalidated()
+
+    def test_new_commit(self):
+        self._check_invalidated()
+        self._commit("second")
+        self._check_invalidated()
+
+    def test_branch_switch(self):
+        self._git("branch", "other")
+        self._check_invalidated()
+        self._git("checkout", "-q", "other")
+        self._commit("second")
+        self._check_invalidated()
+        self._git("checkout", "-q", "main")
+        self._check_invalidated()
+
+    def test_detached_head(self):
+        self._commit("second")
+        self._check_invalidated()
+        self._git("checkout", "-q", "--detach", "HEAD~")
+        self._check_invalidated()
+
+    def test_packed_refs_change(self):
+        first = self._git("rev-parse", "HEAD")
+        self._commit("second")
+        second = self._git("rev-parse", "HEAD")
+        self._git("pack-refs", "--all")
+        self.assertFalse((self.project / ".git/refs/heads/main").exists())
+        self._check_invalidated()
+
+        # As if the branch is moved by another tool that rewrites
+        # packed-refs, keeping its size.
+        packed_refs = self.project / ".git/packed-refs"
+        packed_refs.write_text(packed_refs.read_text().replace(second, first))
+        stat = packed_refs.stat()
+        os.utime(packed_refs, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+        self.assertEqual(self._git("rev-parse", "HEAD"), first)
+        self._check_invalidated()
+
+    def test_no_cache_path(self):
+        cache = workspace_status_stamp.GitCache(None)
+        values = iter(["a", "b"])
+        self.assertEqual(cache.get(self.project, "head", lambda: next(values)), "a")
+        self.assertEqual(cache.get(self.project, "head", lambda: next(values)), "b")
+        cache.save()
+        self.assertFalse(self.cache_path.exists())
+
+
+
+class GetExtModulesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = pathlib.Path(
+            self.enterContext(tempfile.TemporaryDirectory()))
+        self.build_config = self.temp_dir / "build.config"
+        self.build_config.write_text("EXT_MODULES=a\n")
+        self.enterContext(mock.patch.dict(os.environ, {
+            "KLEAF_WORKSPACE_STATUS_CACHE_DIR": str(self.temp_dir / "cache"),
+        }))
+        self.source_ext_modules = self.enterContext(mock.patch.object(
+            workspace_status_stamp, "_source_ext_modules",
+            side_effect=lambda: (
+                self.build_config.read_text().strip()
+                .removeprefix("EXT_MODULES=").split(),
+                {str(self.build_config)})))
+
+    def _get_ext_modules(self) -> list[pathlib.Path]:
+        stamp = workspace_status_stamp.Stamp.__new__(workspace_status_stamp.Stamp)
+        stamp.setlocalversion = self.temp_dir / "setlocalversion"
+        return stamp.get_ext_modules()
+
+    def _check_invalidated(self, expected: list[str]):
+        expected = [pathlib.Path(path) for path in expected]
+        call_count = self.source_ext_modules.call_count
+        self.assertEqual(self._get_ext_modules(), expected)
+        self.assertEqual(self.source_ext_modules.call_count, call_count + 1)
+        self.assertEqual(self._get_ext_modules(), expected)
+        self.assertEqual(self.source_ext_modules.call_count, call_count + 1)
+
+    def test_sourced_file_changed(self):
+        self._check_invalidated(["a"])
+        self.build_config.write_text("EXT_MODULES=b\n")
+        self._check_invalidated(["b"])
+
+    def test_environment_changed(self):
+        self._check_invalidated(["a"])
+        # Any variable may be read by the build config.
+        with mock.patch.dict(os.environ, {"MY_EXT_MODULES": "b"}):
+            self._check_invalidated(["a"])
+        self._check_invalidated(["a"])
+
+
+if __name__ == "__main__":
+    absltest.main()